@@ -1,6 +1,17 @@
 from config import Config
 from services import databaseService
 from services import mapsService
+from services import materializationService
+from services import apiCacheService
+from services import admissionService
+from services import indexAdvisorService
+from services import benchmarkService
+from services import apiRetrieverService
+from services import enrichmentJobService
+from services import remoteDbService
+from services import remoteDbPoolService
+from services import federationService
+from services import s3Service
 
 class ServerStatus:
     _instance = None
@@ -24,6 +35,17 @@ class ServerStatus:
             print("Connecting to default database..." + cls.config.get_config.get("defaultDatabase"))
             databaseService.init(cls.config.get_secrets, cls.config.get_config)
             mapsService.init(cls.config.get_secrets)
+            materializationService.init(cls.config.get_config)
+            apiCacheService.init(cls.config.get_config)
+            admissionService.init(cls.config.get_config)
+            indexAdvisorService.init(cls.config.get_config)
+            benchmarkService.init(cls.config.get_config)
+            apiRetrieverService.init(cls.config.get_config)
+            enrichmentJobService.init(cls.config.get_config)
+            remoteDbService.init(cls.config.get_config)
+            remoteDbPoolService.init(cls.config.get_config)
+            federationService.init(cls.config.get_secrets, cls.config.get_config)
+            s3Service.init(cls.config.get_config)
             currentDatabase = cls.config.get_config.get("defaultDatabase")[:-3]
             cls._instance.serverStatus = {"databaseReady": True, "currentDatabase": currentDatabase}
 
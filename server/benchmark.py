@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+import logging as log
+
+# Load test published endpoints and recorded restConnector queries against an in process server.
+# Runs on the default database of config.yml, stop the server first (DuckDB files can't be shared)
+#   python benchmark.py --target endpoints --concurrency 16 --requests 1000 --label v1.2
+
+from server import app
+from services import benchmarkService
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test published endpoints and the restConnector")
+    parser.add_argument("--target", default="all", help="all, endpoints, restConnector or an endpoint name")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--label", default=None, help="Name stored with the results, e.g. a version")
+    parser.add_argument("--no-save", action="store_true", help="Don't store the results in __benchmark_results")
+    parser.add_argument("--history", action="store_true", help="Show stored results and exit")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+
+    if (args.history):
+        results = benchmarkService.listResults(None if args.target == "all" else args.target)
+        print("\n{:>4} {:<12} {:<9} {:<25} {:>5} {:>7} {:>10} {:>9} {:>9} {:>9} {:>10}".format("id", "label", "revision", "target", "conc", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "p95 change"))
+        for r in results:
+            print("{:>4} {:<12} {:<9} {:<25} {:>5} {:>7} {:>10} {:>9} {:>9} {:>9} {:>10}".format(r["id_benchmark"], str(r["label"]), str(r["revision"]), r["target"], r["concurrency"], r["errors"], r["throughput"], str(r["p50_ms"]), str(r["p95_ms"]), str(r["p99_ms"]), str(r["p95_change_ms"])))
+    else:
+        result = asyncio.run(benchmarkService.run(app, args.target, args.concurrency, args.requests, args.label, not args.no_save))
+        print("\n{:<25} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}".format("target", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+        for r in result["results"]:
+            print("{:<25} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}".format(r["target"], r["requests"], r["errors"], r["throughput"], str(r["p50Ms"]), str(r["p95Ms"]), str(r["p99Ms"]), str(r["maxMs"])))
@@ -0,0 +1,13 @@
+# models.py
+from pydantic import BaseModel
+from typing import Optional
+
+class MaterializeQueryRequestDTO(BaseModel):
+    id_query: int
+    tableName: Optional[str] = None
+    # MANUAL, INTERVAL or ON_CHANGE
+    refreshPolicy: str = "MANUAL"
+    intervalSeconds: Optional[int] = None
+    # If defined, refreshes only append rows newer than the max value already materialized. The source must be
+    # append-only, if rows already materialized change the refresh falls back to a full one
+    watermarkColumn: Optional[str] = None
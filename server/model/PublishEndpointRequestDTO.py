@@ -7,11 +7,14 @@ from typing import Optional
 class Parameter(BaseModel):
     name: str
     exampleValue: str
+    # integer, number, boolean, string or identifier. If not defined it is inferred from exampleValue
+    type: Optional[str] = None
 
     def to_dict(self):
         return {
             "name": self.name,
-            "exampleValue": self.exampleValue
+            "exampleValue": self.exampleValue,
+            "type": self.type
         }
 
 class PublishEndpointRequestDTO(BaseModel):
@@ -23,6 +26,8 @@ class PublishEndpointRequestDTO(BaseModel):
     query: str
     queryStringTest: Optional[str]
     status: str
+    # Seconds responses are cached. None uses the server default (apiCacheTtlSeconds), 0 disables the cache
+    cacheTtl: Optional[int] = None
 
     @classmethod
     def from_dataframe(cls, df: pd.DataFrame):
@@ -36,6 +41,9 @@ class PublishEndpointRequestDTO(BaseModel):
         query = df['query'].iloc[0]
         queryStringTest = df.get('queryStringTest', [None]).iloc[0]
         status = df['status'].iloc[0]
+        cacheTtl = df['cacheTtl'].iloc[0] if 'cacheTtl' in df.columns else None
+        if (cacheTtl is not None and pd.isna(cacheTtl)):
+            cacheTtl = None
 
         # parameters  are stored as a json string: ["marca", "marca_id"] convert to list
         # Asumiendo que 'parameters' es una cadena JSON de una lista de diccionarios
@@ -46,5 +54,5 @@ class PublishEndpointRequestDTO(BaseModel):
         else:
             parameters = None
 
-        return cls(id_query=id_query, id_endpoint=id_endpoint, endpoint=endpoint, parameters=parameters, description=description, query=query, queryStringTest=queryStringTest, status=status)
+        return cls(id_query=id_query, id_endpoint=id_endpoint, endpoint=endpoint, parameters=parameters, description=description, query=query, queryStringTest=queryStringTest, status=status, cacheTtl=cacheTtl)
     
\ No newline at end of file
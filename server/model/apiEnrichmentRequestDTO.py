@@ -1,6 +1,6 @@
 # models.py
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 class Mapping(BaseModel):
     jsonField: str
@@ -20,3 +20,13 @@ class ApiEnrichmentRequestDTO(BaseModel):
     method: Method
     url: str
     newTableName: str
+    # Body template of POST methods, ${column} is replaced by the row value
+    jsonBody: Optional[str] = None
+    # Override the apiEnrichment* settings of config.yml
+    concurrency: Optional[int] = None
+    batchSize: Optional[int] = None
+    timeoutSeconds: Optional[float] = None
+    maxRetries: Optional[int] = None
+    rateLimit: Optional[float] = None
+    # Seconds a cached response is reused, 0 calls the API again for every distinct request
+    cacheTtlSeconds: Optional[int] = None
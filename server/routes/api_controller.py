@@ -1,15 +1,21 @@
 from fastapi import APIRouter, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 
 from config import Config
 from services import databaseService
 from services import apiServerService
 from services import queriesService
+from services import apiCacheService
+from services import admissionService
 import json
 
 router = APIRouter(prefix="/api")
 
+# Supported formats and their media types
+STREAM_FORMATS = {"JSON": "application/json", "CSV": "text/csv", "NDJSON": "application/x-ndjson", "ARROW": "application/vnd.apache.arrow.stream"}
+
 @router.api_route("/{path:path}", methods=["GET", "POST"])
 async def catch_all(request: Request, path: str):
     print("Path: " + path)
@@ -17,7 +23,7 @@ async def catch_all(request: Request, path: str):
 
     # if path ends with /
     if (path.endswith("/")):
-        openapi_dict = apiServerService.getApiDefinition(path)
+        openapi_dict = await run_in_threadpool(apiServerService.getApiDefinition, path)
         # openapi_dict to json
         # openapi_json = json.dumps(openapi_dict)
         return JSONResponse(content=openapi_dict, status_code=200)
@@ -29,11 +35,11 @@ async def catch_all(request: Request, path: str):
         print("Query parameters: ", dict(query_params))
         if (query_params is not None):
             query_params = dict(query_params)
-            # get param format (CSV or JSON)
+            # get param format (JSON, CSV, NDJSON or ARROW)
             format = query_params.get("format")
             if (format is not None):
                 format = format.upper()
-                if (format == "CSV"):
+                if (format in STREAM_FORMATS):
                     query_params.pop("format")
                 else:
                     format = "JSON"
@@ -46,26 +52,83 @@ async def catch_all(request: Request, path: str):
             print("Body: ", body)
         else:
             body = None
-        
+
+        if (format is None):
+            format = "JSON"
+
+        # Requests with body are not cached
+        cacheKey = apiCacheService.getKey(path, query_params, format)
+
+        # Pagination and streaming parameters, unless the endpoint uses them as query parameters
+        registeredEndpoint = await run_in_threadpool(apiServerService.getRegisteredEndpoint, path)
+        placeholders = registeredEndpoint.placeholders if registeredEndpoint is not None else []
+        limit = query_params.pop("limit", None) if "limit" not in placeholders else None
+        cursor = query_params.pop("cursor", None) if "cursor" not in placeholders else None
+        stream = query_params.pop("stream", "false") if "stream" not in placeholders else "false"
         try:
-            df_result = apiServerService.getAndRunEndpoint(path, query_params, body)
+            limit = int(limit) if limit is not None else None
+            offset = apiServerService.decodeCursor(cursor) if cursor is not None else 0
+            if (limit is not None and limit <= 0):
+                raise Exception("limit must be greater than 0")
         except Exception as e:
-            print("Error running endpoint:" + str(e))
             return JSONResponse(content={"error": str(e)}, status_code=400)
 
+        # NDJSON and Arrow are always streamed, CSV when stream=true. Streamed responses are not cached
+        if (format in ["NDJSON", "ARROW"] or (format == "CSV" and stream.lower() == "true")):
+            try:
+                await run_in_threadpool(admissionService.acquire, "API", path)
+            except admissionService.AdmissionRejected as e:
+                return JSONResponse(content={"error": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+            try:
+                chunks = apiServerService.streamEndpoint(path, query_params, format, limit, offset)
+            except Exception as e:
+                admissionService.release("API", path)
+                print("Error running endpoint:" + str(e))
+                return JSONResponse(content={"error": str(e)}, status_code=400)
+            # Headers are sent before the rows, so whether there is a next page is unknown: a cursor is always returned
+            headers = {"X-Next-Cursor": apiServerService.encodeCursor(offset + limit)} if limit is not None else None
+            # The slot is kept until the whole result is sent
+            return StreamingResponse(admissionService.ReleasingIterator(chunks, "API", path), media_type=STREAM_FORMATS[format], headers=headers)
+
+        entry = apiCacheService.get(cacheKey) if body is None else None
 
-        
+        if (entry is None):
+            try:
+                # One extra row tells if there is a next page. Runs in the thread pool so waiting for a slot doesn't block the server
+                sourceTables, versions, df_result = await run_in_threadpool(runEndpoint, registeredEndpoint, path, query_params, body, limit + 1 if limit is not None else None, offset)
+            except admissionService.AdmissionRejected as e:
+                print("Endpoint rejected:" + str(e))
+                return JSONResponse(content={"error": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+            except Exception as e:
+                print("Error running endpoint:" + str(e))
+                return JSONResponse(content={"error": str(e)}, status_code=400)
 
-        if (df_result is not None):
-            if (format == "CSV"):
-                #return JSONResponse(content=result, status_code=200)
-                csv_data = df_result.to_csv(index=False)
-                return Response(content=csv_data, media_type="text/csv", status_code=200)
+            headers = {}
+            if (df_result is not None and limit is not None and len(df_result) > limit):
+                df_result = df_result.iloc[:limit]
+                headers["X-Next-Cursor"] = apiServerService.encodeCursor(offset + limit)
+
+            if (df_result is not None):
+                if (format == "CSV"):
+                    content = df_result.to_csv(index=False).encode("utf-8")
+                else:
+                    result = df_result.to_dict(orient="records")
+                    #print("Result:" + str(result))
+                    content = JSONResponse(content=result).body
             else:
-                result = df_result.to_dict(orient="records")
-                #print("Result:" + str(result))
-                return JSONResponse(content=result, status_code=200)
+                content = JSONResponse(content=[]).body
+
+            ttl = registeredEndpoint.getCacheTtl() if (registeredEndpoint is not None and body is None) else 0
+            entry = apiCacheService.put(cacheKey, content, STREAM_FORMATS[format], ttl, sourceTables, versions, headers)
         else:
-            return JSONResponse(content=[], status_code=200)
-    
+            print("Response served from cache")
+
+        return apiCacheService.toResponse(entry, request.headers.get("if-none-match"))
 
+####################################################
+# Returns the source tables and their versions before running, to cache the response, and the result
+def runEndpoint(registeredEndpoint, path, query_params, body, limit, offset):
+    sourceTables = registeredEndpoint.getSourceTables() if registeredEndpoint is not None else None
+    versions = apiCacheService.getVersions(sourceTables)
+    with admissionService.admit("API", path):
+        return sourceTables, versions, apiServerService.getAndRunEndpoint(path, query_params, body, limit, offset)
@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 import services.apiRetrieverService as apiRetrieverService
+from services import enrichmentJobService
 from config import Config
 from model.apiEnrichmentRequestDTO import ApiEnrichmentRequestDTO
 
@@ -56,11 +57,48 @@ def getMethodInfo(serviceName: str,
 
 ####################################################
 
+# Starts the enrichment in background, follow it with /getJob
 @router.post("/runApiEnrichment")
-async def runApiEnrichment(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+def runApiEnrichment(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
     print("Body: " + str(apiEnrichmentRequestDTO))
-    apiRetrieverService.runApiEnrichment(apiEnrichmentRequestDTO, Config.get_instance().get_secrets.get("api_domain"), "pro")
+    id_job = enrichmentJobService.startJob(apiEnrichmentRequestDTO)
 
-    return JSONResponse(content="OK", status_code=200)
+    return JSONResponse(content={"id_job": id_job}, status_code=200)
+
+####################################################
+@router.get("/listJobs")
+def listJobs():
+    return JSONResponse(content=enrichmentJobService.listJobs(), status_code=200)
 
+####################################################
+@router.get("/getJob")
+def getJob(id_job: int):
+    job = enrichmentJobService.getJob(id_job)
+    if (job is None):
+        return JSONResponse(content={"status": "error", "message": "Job not found"}, status_code=404)
+    return JSONResponse(content=job, status_code=200)
+
+####################################################
+@router.get("/pauseJob")
+def pauseJob(id_job: int):
+    return jobActionResponse(enrichmentJobService.pauseJob(id_job), "Only queued or running jobs can be paused")
 
+@router.get("/resumeJob")
+def resumeJob(id_job: int):
+    return jobActionResponse(enrichmentJobService.resumeJob(id_job), "Only paused or failed jobs can be resumed")
+
+@router.get("/cancelJob")
+def cancelJob(id_job: int):
+    return jobActionResponse(enrichmentJobService.cancelJob(id_job), "Job not found or already finished")
+
+def jobActionResponse(result, message):
+    if (result):
+        return JSONResponse(content="OK", status_code=200)
+    return JSONResponse(content={"status": "error", "message": message}, status_code=400)
+
+####################################################
+# Forget cached API responses, all or those of urls starting with url
+@router.get("/clearCache")
+def clearCache(url: str = None):
+    apiRetrieverService.clearCache(url)
+    return JSONResponse(content="OK", status_code=200)
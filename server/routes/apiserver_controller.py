@@ -1,10 +1,15 @@
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Request
 from fastapi.responses import JSONResponse
 import services.apiRetrieverService as apiRetrieverService
 from config import Config
 from services import databaseService
 from services import apiServerService
 from services import queriesService
+from services import materializationService
+from services import admissionService
+from services import apiCacheService
+from services import indexAdvisorService
+from services import benchmarkService
 
 from model.PublishEndpointRequestDTO import PublishEndpointRequestDTO
 
@@ -18,7 +23,12 @@ def getServices(id_query: int):
     # Get query as a dictionary
     query = queriesService.getQuery(id_query)
 
-    limitedQuery = "SELECT * FROM (" + query["query"] + ") LIMIT 10"
+    # Read precomputed results if the saved query is materialized
+    materializedTable = materializationService.getMaterializedTable(id_query)
+    if (materializedTable is not None):
+        limitedQuery = "SELECT * FROM " + materializedTable + " LIMIT 10"
+    else:
+        limitedQuery = "SELECT * FROM (" + query["query"] + ") LIMIT 10"
 
     print("Query:" + str(limitedQuery))
 
@@ -55,7 +65,13 @@ def create():
 @router.post("/update")
 def publish( publishEndpointRequestDTO: PublishEndpointRequestDTO ):
     print("Updating query " + str(publishEndpointRequestDTO))
-    apiServerService.update(publishEndpointRequestDTO)
+    if (not apiServerService.update(publishEndpointRequestDTO)):
+        response = {"status": "error", "message": "Endpoint " + publishEndpointRequestDTO.endpoint + " not updated"}
+        return JSONResponse(content=response, status_code=400)
+
+    # Index the filter columns in background, the result is available in /indexAdvice
+    if (indexAdvisorService.autoApply):
+        indexAdvisorService.applyInBackground(publishEndpointRequestDTO.endpoint, indexAdvisorService.autoCluster)
 
     if (True):
         result = "ok"
@@ -86,4 +102,49 @@ def deleteEndpoint(id_endpoint: int):
         print("Result:" + str(result))
         return JSONResponse(content=result, status_code=200)
     else:
-        return JSONResponse(content=[], status_code=200)
\ No newline at end of file
+        return JSONResponse(content=[], status_code=200)
+####################################################
+@router.get("/status")
+def status():
+    result = {"admission": admissionService.getStatus(), "cache": apiCacheService.getStats()}
+    return JSONResponse(content=result, status_code=200)
+####################################################
+@router.get("/indexAdvice")
+def indexAdvice(endpoint: str):
+    print("Getting index advice for endpoint " + endpoint)
+    try:
+        result = {"recommendations": indexAdvisorService.analyze(endpoint), "lastApplied": indexAdvisorService.lastResults.get(endpoint)}
+    except Exception as e:
+        print("Error getting index advice: " + str(e))
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content=result, status_code=200)
+####################################################
+@router.get("/applyIndexAdvice")
+def applyIndexAdvice(endpoint: str, clustered: bool = False):
+    print("Applying index advice for endpoint " + endpoint)
+    try:
+        with admissionService.admit("BACKGROUND"):
+            result = indexAdvisorService.apply(endpoint, clustered)
+    except admissionService.AdmissionRejected as e:
+        return JSONResponse(content={"error": str(e)}, status_code=e.status_code)
+    except Exception as e:
+        print("Error applying index advice: " + str(e))
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content=result, status_code=200)
+####################################################
+# Load test against this server, in process. target: all, endpoints, restConnector or an endpoint name
+@router.get("/benchmark")
+async def benchmark(request: Request, target: str = "all", concurrency: int = 8, requests: int = 200, label: str = None):
+    print("Running benchmark of " + target)
+    if (concurrency <= 0 or requests <= 0):
+        return JSONResponse(content={"error": "concurrency and requests must be greater than 0"}, status_code=400)
+    try:
+        result = await benchmarkService.run(request.app, target, concurrency, requests, label)
+    except Exception as e:
+        print("Error running benchmark: " + str(e))
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content=result, status_code=200)
+####################################################
+@router.get("/benchmarkResults")
+def benchmarkResults(target: str = None, limit: int = 50):
+    return JSONResponse(content=benchmarkService.listResults(target, limit), status_code=200)
@@ -1,6 +1,7 @@
 import shutil
 from fastapi import APIRouter, File, Form, UploadFile
-from services import databaseService, fileService
+from services import databaseService, fileService, apiServerService, admissionService, benchmarkService, federationService
+from fastapi.concurrency import run_in_threadpool
 from fastapi import Response, Request
 from fastapi.responses import JSONResponse, FileResponse
 from model.QueryRequestDTO import QueryRequest
@@ -96,7 +97,12 @@ def runQuery(queryRequest: QueryRequest):
         query = query[:-1]
 
     try:
-        databaseService.runQuery("CREATE TABLE __lastQuery as ("+ query +")")
+        with admissionService.admit("INTERACTIVE"):
+            # On the cursor of the thread, so interactive queries run in parallel up to the admission limit
+            databaseService.runQuery("CREATE TABLE __lastQuery as ("+ query +")", connection=databaseService.getThreadCursor())
+    except admissionService.AdmissionRejected as e:
+        response = {"status": "error", "message": str(e)}
+        return JSONResponse(content=response, status_code=e.status_code, headers={"Retry-After": "5"})
     except Exception as e:
         print("Error runing query::: " + str(e))
         response = {"status": "error", "message": "Error running query: " + str(e)}
@@ -145,7 +151,11 @@ def createTableFromQuery(query: str, tableName: str):
         print("Error dropping table: " + str(e))
 
     try:
-        databaseService.runQuery("CREATE TABLE "+ tableName +" as ("+ query +")")
+        with admissionService.admit("INTERACTIVE"):
+            databaseService.runQuery("CREATE TABLE "+ tableName +" as ("+ query +")", connection=databaseService.getThreadCursor())
+    except admissionService.AdmissionRejected as e:
+        response = {"status": "error", "message": str(e)}
+        return JSONResponse(content=response, status_code=e.status_code, headers={"Retry-After": "5"})
     except Exception as e:
         print("Error creating table: " + str(e))
         response = {"status": "error", "message": "Error creating table: " + str(e)}
@@ -249,6 +259,13 @@ def getDatabaseList():
 def changeDatabase(databaseName: str):
     databaseService.changeDatabase(serverStatus.getConfig(), databaseName)
     serverStatus.setCurrentDatabase(databaseName)
+    # Published endpoints live in the database, reload them from the new one
+    apiServerService.invalidateEndpointRegistry()
+    # Remote databases attached to it too, its live views need them
+    try:
+        federationService.ensureAttached()
+    except Exception as e:
+        print("Error attaching federated databases: " + str(e))
     return {"status": "ok"}
 
 ####################################################
@@ -268,20 +285,9 @@ async def handle_query(request: Request):
     command = query.get("type")
 
     try:
-        if command == "exec":
-            if (sql.strip().upper().startswith("CREATE TEMP TABLE IF NOT EXISTS CUBE_INDEX_")):
-                databaseService.runQuery(sql)
-
-            response = {"status": "ok"}
-        elif command == "arrow":
-            buffer = databaseService.retrieve_arrow_bytes(query)
-            response = Response(content=buffer, media_type="application/octet-stream")
-        elif command == "json":
-            json_data = databaseService.retrieve_json(query)
-            response = JSONResponse(content=json_data)
-        else:
-            raise ValueError(f"Unknown command {command}")
-
+        response = await run_in_threadpool(runRestConnectorCommand, command, sql, query)
+    except admissionService.AdmissionRejected as e:
+        response = JSONResponse(content={"status": "error", "message": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
     except Exception as e:
         log.exception("Error processing query")
         response = JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
@@ -294,6 +300,24 @@ async def handle_query(request: Request):
 
     return response
 
+def runRestConnectorCommand(command, sql, query):
+    # Kept to be replayed by the benchmark
+    benchmarkService.recordRestConnectorQuery(query)
+    with admissionService.admit("MOSAIC"):
+        if command == "exec":
+            if (sql.strip().upper().startswith("CREATE TEMP TABLE IF NOT EXISTS CUBE_INDEX_")):
+                databaseService.runQuery(sql)
+
+            return {"status": "ok"}
+        elif command == "arrow":
+            buffer = databaseService.retrieve_arrow_bytes(query)
+            return Response(content=buffer, media_type="application/octet-stream")
+        elif command == "json":
+            json_data = databaseService.retrieve_json(query)
+            return JSONResponse(content=json_data)
+        else:
+            raise ValueError(f"Unknown command {command}")
+
 @router.get("/dropCubes")
 def dropCubes():
     # Drop all cube tables
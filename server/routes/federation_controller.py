@@ -0,0 +1,79 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from services import federationService
+from model.QueryRequestDTO import QueryRequest
+
+router = APIRouter(prefix="/federation")
+
+# Remote PostgreSQL databases attached to DuckDB, their tables are queried in place (live) or cached
+
+####################################################
+@router.get("/attach")
+def attach(databaseName: str, alias: str = None):
+    try:
+        alias = federationService.attach(databaseName, alias)
+        return {"status": "ok", "alias": alias}
+    except Exception as e:
+        print("Error attaching database " + databaseName + ": " + str(e))
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+@router.get("/detach")
+def detach(alias: str):
+    try:
+        federationService.detach(alias)
+        return {"status": "ok"}
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+@router.get("/databases")
+def databases():
+    return JSONResponse(content=federationService.listDatabases(), status_code=200)
+
+@router.get("/remoteTables")
+def remoteTables(alias: str):
+    try:
+        return JSONResponse(content=federationService.listRemoteTables(alias), status_code=200)
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+####################################################
+# mode: live (view reading PostgreSQL) or cache (local copy)
+@router.get("/setTableMode")
+def setTableMode(alias: str, schema: str, table: str, mode: str = "live", localName: str = None):
+    try:
+        result = federationService.setTableMode(alias, schema, table, mode, localName)
+        return {"status": "ok", **result}
+    except Exception as e:
+        print("Error setting mode of " + alias + "." + schema + "." + table + ": " + str(e))
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+@router.get("/refreshCache")
+def refreshCache(localName: str):
+    try:
+        result = federationService.refreshCache(localName)
+        return {"status": "ok", **result}
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+@router.get("/tables")
+def tables():
+    return JSONResponse(content=federationService.listTables(), status_code=200)
+
+####################################################
+# Result as CSV and the rows transferred from every remote table
+@router.post("/runQuery")
+def runQuery(queryRequest: QueryRequest):
+    query = queryRequest.query.strip().rstrip(";")
+    if (queryRequest.rows):
+        query = "SELECT * FROM (" + query + ") LIMIT " + str(int(queryRequest.rows))
+    try:
+        df, stats = federationService.runQuery(query)
+    except Exception as e:
+        print("Error running federated query: " + str(e))
+        return JSONResponse(content={"status": "error", "message": "Error running query: " + str(e)}, status_code=400)
+    return {"status": "ok", "data": df.to_csv(index=False), **stats}
+
+@router.get("/stats")
+def stats():
+    return JSONResponse(content=federationService.getStats(), status_code=200)
@@ -2,7 +2,9 @@ from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 from config import Config
 from model.SaveQueryRequestDTO import SaveQueryRequestDTO
+from model.MaterializeQueryRequestDTO import MaterializeQueryRequestDTO
 from services import queriesService
+from services import materializationService
 
 router = APIRouter(prefix="/queries")
 
@@ -33,4 +35,42 @@ def deleteQuery(id_query: int):
 
     queriesService.deleteQuery(id_query)
     
-    return JSONResponse(content=[], status_code=200)
\ No newline at end of file
+    return JSONResponse(content=[], status_code=200)
+
+####################################################
+
+@router.post("/materialize")
+def materialize(materializeQueryRequestDTO: MaterializeQueryRequestDTO):
+    try:
+        tableName = materializationService.materialize(materializeQueryRequestDTO)
+    except Exception as e:
+        print("Error materializing query: " + str(e))
+        response = {"status": "error", "message": str(e)}
+        return JSONResponse(content=response, status_code=400)
+
+    return JSONResponse(content={"status": "ok", "tableName": tableName}, status_code=200)
+
+####################################################
+
+@router.get("/refreshMaterialization")
+def refreshMaterialization(id_query: int, full: bool = False):
+    if (materializationService.getMaterialization(id_query) is None):
+        response = {"status": "error", "message": "Query " + str(id_query) + " is not materialized"}
+        return JSONResponse(content=response, status_code=400)
+
+    scheduled = materializationService.scheduleRefresh(id_query, full)
+    return JSONResponse(content={"status": "ok", "scheduled": scheduled}, status_code=200)
+
+####################################################
+
+@router.get("/listMaterializations")
+def listMaterializations():
+    result = materializationService.listMaterializations()
+    return JSONResponse(content=result, status_code=200)
+
+####################################################
+
+@router.get("/deleteMaterialization")
+def deleteMaterialization(id_query: int, dropTable: bool = True):
+    result = materializationService.deleteMaterialization(id_query, dropTable)
+    return JSONResponse(content={"status": "ok" if result else "error"}, status_code=200)
@@ -1,13 +1,19 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header
 from services import databaseService
 from fastapi import Response
 from fastapi.responses import JSONResponse
 import services.remoteDbService as remoteDbService
+import services.remoteDbPoolService as remoteDbPoolService
+import services.remoteSyncService as remoteSyncService
+import time
 
 from config import Config
 
 router = APIRouter(prefix="/remotedb")
 
+# Every browser tab sends its own X-Session-Id, so each one has its active database.
+# Requests without it share the default session
+
 
 @router.get("/getDatabaseList")
 def getDatabaseList(databaseName: str):
@@ -19,70 +25,103 @@ def getDatabaseList(databaseName: str):
     return JSONResponse(content=databaseList, status_code=200)
 
 @router.get("/connectDatabase")
-def connectDatabase(databaseName: str):
-    global connection
-
+def connectDatabase(databaseName: str, sessionId: str = Header(None, alias="X-Session-Id")):
     if (databaseName is None):
         response = {"status": "error", "message": "databaseName is required"}
         return JSONResponse(content=response, status_code=400)
     print("Connecting to database '" + databaseName + "'")
-    connection = remoteDbService.connectDatabase(databaseName, Config.get_instance().get_secrets.get("pgpass_file"))
-    
-    if (connection is not None):
-        schemas = remoteDbService.getSchemas(connection)
-        response = {"status": "ok", "schemas": schemas}
-        return JSONResponse(content=response, status_code=200)
-    else:
-        return {"status": "error"}
+    parameters = remoteDbService.getConnectionParameters(databaseName, Config.get_instance().get_secrets.get("pgpass_file"))
+    if (parameters is None):
+        return {"status": "error", "message": "Database " + databaseName + " not found in pgpass file"}
 
-@router.get("/getSchemas")
-def getSchemas():
-    global connection
+    try:
+        remoteDbPoolService.getPool(databaseName, parameters).fill()
+        schemas = remoteDbPoolService.getCached(databaseName, "schemas", remoteDbService.getSchemas, refresh=True)
+    except Exception as e:
+        print("Error connecting to database:" + str(e))
+        return {"status": "error", "message": str(e)}
+    remoteDbPoolService.setActiveTarget(sessionId, databaseName)
+    response = {"status": "ok", "schemas": schemas}
+    return JSONResponse(content=response, status_code=200)
 
-    if (connection is None):
-        response = {"status": "error", "message": "You must connect to a database first"}
-        return JSONResponse(content=response, status_code=400)
+def notConnected():
+    response = {"status": "error", "message": "You must connect to a database first"}
+    return JSONResponse(content=response, status_code=400)
+
+@router.get("/getSchemas")
+def getSchemas(refresh: bool = False, sessionId: str = Header(None, alias="X-Session-Id")):
+    target = remoteDbPoolService.getActiveTarget(sessionId)
+    if (target is None):
+        return notConnected()
     print("Getting schemas")
-    schemas = remoteDbService.getSchemas(connection)
+    schemas = remoteDbPoolService.getCached(target, "schemas", remoteDbService.getSchemas, refresh)
     return JSONResponse(content=schemas, status_code=200)
 
 @router.get("/getTablesFromRemoteSchema")
-def getTablesFromSchema(schema: str):
-    global connection
-
-    if (connection is None):
-        response = {"status": "error", "message": "You must connect to a database first"}
-        return JSONResponse(content=response, status_code=400)
+def getTablesFromSchema(schema: str, refresh: bool = False, sessionId: str = Header(None, alias="X-Session-Id")):
+    target = remoteDbPoolService.getActiveTarget(sessionId)
+    if (target is None):
+        return notConnected()
     print("Getting tables from schema " + schema)
-    tables = remoteDbService.getTables(connection, schema)
+    tables = remoteDbPoolService.getCached(target, "tables." + schema, lambda connection: remoteDbService.getTables(connection, schema), refresh)
     response = {"status": "ok", "tables": tables}
     return JSONResponse(content=response, status_code=200)
 
 @router.get("/runRemoteQuery")
-def runRemoteQuery(query: str):
-    global connection
-
-    if (connection is None):
-        response = {"status": "error", "message": "You must connect to a database first"}
-        return JSONResponse(content=response, status_code=400)
+def runRemoteQuery(query: str, sessionId: str = Header(None, alias="X-Session-Id")):
+    target = remoteDbPoolService.getActiveTarget(sessionId)
+    if (target is None):
+        return notConnected()
     print("Running query " + query)
-    df = remoteDbService.runRemoteQuery(connection, query)
+    df = remoteDbPoolService.runWithConnection(target, lambda connection: remoteDbService.runRemoteQuery(connection, query))
     if (df is not None):
         return JSONResponse(content=df.to_csv(index=False), status_code=200)
     else:
         return JSONResponse(content=[], status_code=200)
 
+# watermarkColumn (e.g. updated_at) and primaryKey (columns separated by commas) allow syncing the table
+# incrementally with /syncRemoteTable
 @router.get("/createTableFromRemoteQuery")
-def createTableFromRemoteQuery(query: str, tableName: str):
-    global connection
-
-    if (connection is None):
-        response = {"status": "error", "message": "You must connect to a database first"}
-        return JSONResponse(content=response, status_code=400)
+def createTableFromRemoteQuery(query: str, tableName: str, parallelism: int = None, partitionColumn: str = None, method: str = None,
+                               watermarkColumn: str = None, primaryKey: str = None, detectDeletes: bool = False, sessionId: str = Header(None, alias="X-Session-Id")):
+    target = remoteDbPoolService.getActiveTarget(sessionId)
+    if (target is None):
+        return notConnected()
     print("Creating table " + tableName + " from query " + query)
-    dfRemoteDb = remoteDbService.runRemoteQuery(connection, query)
-    if (dfRemoteDb is not None):
-        databaseService.createTableFromDataFrame("dfRemoteDb", tableName)
-        return {"status": "ok"}
-    else:
-        return {"status": "error"}
\ No newline at end of file
+    try:
+        startedAt = time.time()
+        query = remoteDbService.getSelectQuery(query)
+        with remoteDbPoolService.pooledConnection(target) as connection:
+            rows = remoteDbService.importRemoteQuery(connection, query, tableName, parallelism=parallelism, partitionColumn=partitionColumn, method=method,
+                                                     pool=remoteDbPoolService.getPool(target))
+        remoteSyncService.registerImport(target, query, tableName, watermarkColumn, primaryKey, detectDeletes, startedAt, rows)
+        return {"status": "ok", "rows": rows}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+# Fetch the rows changed in the source since the last import or sync of the table
+@router.get("/syncRemoteTable")
+def syncRemoteTable(tableName: str):
+    try:
+        result = remoteSyncService.sync(tableName)
+        return {"status": "ok", **result}
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
+
+@router.get("/remoteImports")
+def remoteImports():
+    return JSONResponse(content=remoteSyncService.listImports(), status_code=200)
+
+@router.get("/syncHistory")
+def syncHistory(tableName: str = None):
+    return JSONResponse(content=remoteSyncService.getHistory(tableName), status_code=200)
+
+# Rows imported so far by createTableFromRemoteQuery
+@router.get("/importProgress")
+def importProgress(tableName: str = None):
+    return JSONResponse(content=remoteDbService.getImportProgress(tableName), status_code=200)
+
+# Connections open and in use by remote database
+@router.get("/poolStatus")
+def poolStatus():
+    return JSONResponse(content=remoteDbPoolService.getStatus(), status_code=200)
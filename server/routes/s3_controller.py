@@ -18,40 +18,44 @@ def s3Search(bucket: str, fileName: str):
     
     results = []
     if (len(fileName) >= 3):
-        results = s3Service.s3Search(bucket, fileName)
+        results = s3Service.s3Search(bucket, fileName, 10)
 
-    # If  results array is greter than 100 items, return first 10
-    if (len(results) > 10):
-        results = results[:10]
-    
     return {"results": results}
 
+# Buckets indexed and the changes found in their last refresh
+@router.get("/indexStatus")
+def indexStatus():
+    return JSONResponse(content=s3Service.getIndexStatus(), status_code=200)
+
 ############################################################################################################
 
+# Cached for s3ContentCacheSeconds, refresh=true lists the folder again
 @router.get("/getContent")
-def getContent(bucket: str, path: str):
+def getContent(bucket: str, path: str, refresh: bool = False):
     print("getContent bucket '" + bucket + "'" + " path '" + path + "'")
     if (bucket is None):
         response = {"status": "error", "message": "bucket is required"}
         return JSONResponse(content=response, status_code=400)
     
     result = {}
-    result = s3Service.getContent(bucket, path)
+    result = s3Service.getContent(bucket, path, refresh)
     
     return result
 
 ############################################################################################################
+# Schema and first rows of a Parquet, CSV or JSON file (first lines of other files), read with range requests
 @router.get("/getFilePreview")
-def getContent(bucket: str, path: str):
+def getFilePreview(bucket: str, path: str, rows: int = None):
     print("getFilePreview bucket '" + bucket + "'" + " path '" + path + "'")
     if (bucket is None):
         response = {"status": "error", "message": "bucket is required"}
         return JSONResponse(content=response, status_code=400)
-    
-    results = []
-    results = s3Service.getFilePreview(bucket, path)
-    
-    return results
+
+    try:
+        return s3Service.getFilePreview(bucket, path, rows)
+    except Exception as e:
+        print("Error getting preview of " + path + ": " + str(e))
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=400)
 
 ############################################################################################################
 @router.post("/updateMetadata")
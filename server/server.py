@@ -12,6 +12,7 @@ from routes import queries_controller
 from routes import apiserver_controller
 from routes import api_controller
 from routes import maps_controller
+from routes import federation_controller
 
 import logging as log
 
@@ -46,6 +47,7 @@ app.include_router(queries_controller.router)
 app.include_router(apiserver_controller.router)
 app.include_router(api_controller.router)
 app.include_router(maps_controller.router)
+app.include_router(federation_controller.router)
 
 
 if __name__ == "__main__":
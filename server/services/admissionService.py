@@ -0,0 +1,160 @@
+import threading
+import time
+import itertools
+from contextlib import contextmanager
+
+# Admission control for queries sent to DuckDB. Every query belongs to a class (API, INTERACTIVE, MOSAIC,
+# BACKGROUND) with its own concurrency limit, queue size, max wait and priority. Published endpoints are
+# also limited per endpoint. When a slot frees, the waiting query with the best priority that fits the
+# limits runs first, so API lookups jump ahead of long analyst scans.
+
+DEFAULT_CLASSES = {
+    "API": {"concurrency": 6, "queue": 200, "timeoutSeconds": 2, "priority": 0},
+    "INTERACTIVE": {"concurrency": 2, "queue": 20, "timeoutSeconds": 60, "priority": 1},
+    "MOSAIC": {"concurrency": 1, "queue": 100, "timeoutSeconds": 30, "priority": 2},
+    "BACKGROUND": {"concurrency": 1, "queue": 100, "timeoutSeconds": 3600, "priority": 3},
+}
+
+classes = DEFAULT_CLASSES
+maxConcurrency = 8
+endpointConcurrency = 4
+
+condition = threading.Condition()
+sequence = itertools.count()
+# Waiting tickets: (priority, sequence, queryClass, key)
+waiters = []
+running = {"total": 0}
+runningByKey = {}
+stats = {}
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+####################################################
+def init(config):
+    global classes
+    global maxConcurrency
+    global endpointConcurrency
+
+    classes = {name: dict(settings) for name, settings in DEFAULT_CLASSES.items()}
+    for name, settings in (config.get("admissionClasses") or {}).items():
+        classes.setdefault(name, dict(DEFAULT_CLASSES["INTERACTIVE"])).update(settings)
+    maxConcurrency = config.get("admissionMaxConcurrency", maxConcurrency)
+    endpointConcurrency = config.get("admissionEndpointConcurrency", endpointConcurrency)
+    print("Admission control: " + str(maxConcurrency) + " concurrent queries, classes " + str(classes))
+
+####################################################
+def canRun(queryClass, key):
+    if (running["total"] >= maxConcurrency):
+        return False
+    if (running.get(queryClass, 0) >= classes[queryClass]["concurrency"]):
+        return False
+    if (key is not None and runningByKey.get(key, 0) >= endpointConcurrency):
+        return False
+    return True
+
+####################################################
+# The ticket runs if it is the best waiting ticket that fits in the limits
+def isNext(ticket):
+    for waiter in sorted(waiters):
+        if (canRun(waiter[2], waiter[3])):
+            return waiter == ticket
+    return False
+
+####################################################
+def getStats(queryClass):
+    return stats.setdefault(queryClass, {"admitted": 0, "rejected": 0, "timeouts": 0, "waitMs": 0})
+
+####################################################
+def acquire(queryClass, key = None):
+    settings = classes[queryClass]
+    start = time.time()
+    with condition:
+        waiting = len([waiter for waiter in waiters if waiter[2] == queryClass])
+        if (waiting >= settings["queue"]):
+            getStats(queryClass)["rejected"] += 1
+            raise AdmissionRejected("Too many " + queryClass + " requests waiting, try again later", 429)
+
+        ticket = (settings["priority"], next(sequence), queryClass, key)
+        waiters.append(ticket)
+        deadline = start + settings["timeoutSeconds"]
+        try:
+            while not isNext(ticket):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    getStats(queryClass)["timeouts"] += 1
+                    raise AdmissionRejected(queryClass + " request waited more than " + str(settings["timeoutSeconds"]) + " seconds, server busy", 503)
+                condition.wait(remaining)
+        finally:
+            waiters.remove(ticket)
+            # Removing a ticket can make another one the next to run
+            condition.notify_all()
+
+        running["total"] += 1
+        running[queryClass] = running.get(queryClass, 0) + 1
+        if (key is not None):
+            runningByKey[key] = runningByKey.get(key, 0) + 1
+        getStats(queryClass)["admitted"] += 1
+        getStats(queryClass)["waitMs"] += int((time.time() - start) * 1000)
+
+####################################################
+def release(queryClass, key = None):
+    with condition:
+        running["total"] -= 1
+        running[queryClass] -= 1
+        if (key is not None):
+            runningByKey[key] -= 1
+            if (runningByKey[key] == 0):
+                del runningByKey[key]
+        condition.notify_all()
+
+####################################################
+@contextmanager
+def admit(queryClass, key = None):
+    acquire(queryClass, key)
+    try:
+        yield
+    finally:
+        release(queryClass, key)
+
+####################################################
+# Keep the slot while a streamed response is being sent. The slot must already be acquired, it is
+# released when the stream ends, fails or is discarded without being read
+class ReleasingIterator:
+    def __init__(self, iterator, queryClass, key = None):
+        self.iterator = iterator
+        self.queryClass = queryClass
+        self.key = key
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        if (not self.released):
+            self.released = True
+            release(self.queryClass, self.key)
+
+    def __del__(self):
+        self.release()
+
+####################################################
+def getStatus():
+    with condition:
+        return {
+            "maxConcurrency": maxConcurrency,
+            "endpointConcurrency": endpointConcurrency,
+            "classes": classes,
+            "running": dict(running),
+            "waiting": {queryClass: len([waiter for waiter in waiters if waiter[2] == queryClass]) for queryClass in classes},
+            "stats": stats,
+        }
@@ -0,0 +1,128 @@
+import threading
+import time
+import hashlib
+import duckdb
+from collections import OrderedDict
+from fastapi import Response
+
+from services import databaseService
+
+# Serialized responses of published endpoints, keyed by endpoint + parameters + format.
+# An entry is served while its TTL is not expired and the tables read by the query were not written
+cache = OrderedDict()
+cacheBytes = 0
+cacheLock = threading.Lock()
+
+defaultTtl = 60
+maxEntries = 1000
+maxBytes = 100 * 1024 * 1024
+
+class CachedResponse:
+    def __init__(self, content: bytes, mediaType, ttl, sourceTables, versions, headers = None):
+        self.content = content
+        self.mediaType = mediaType
+        self.headers = headers or {}
+        self.etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        self.expires = time.time() + ttl
+        self.sourceTables = sourceTables
+        self.versions = versions
+
+    def isValid(self):
+        if (time.time() > self.expires):
+            return False
+        return getVersions(self.sourceTables) == self.versions
+
+####################################################
+# Versions of the source tables. Taken before running the query so a write during the run invalidates
+# the response. If the tables are unknown (views, table functions...) any write invalidates it
+def getVersions(sourceTables):
+    if (sourceTables is None):
+        return databaseService.dataVersion
+    return (databaseService.writeEpoch, tuple([databaseService.tableVersions.get(table, 0) for table in sorted(sourceTables)]))
+
+####################################################
+def init(config):
+    global defaultTtl
+    global maxEntries
+    global maxBytes
+
+    defaultTtl = config.get("apiCacheTtlSeconds", defaultTtl)
+    maxEntries = config.get("apiCacheMaxEntries", maxEntries)
+    maxBytes = config.get("apiCacheMaxMegabytes", maxBytes // (1024 * 1024)) * 1024 * 1024
+    print("API response cache: ttl " + str(defaultTtl) + "s, " + str(maxEntries) + " entries, " + str(maxBytes // (1024 * 1024)) + " MB")
+
+####################################################
+# Parameter order doesn't matter: ?a=1&b=2 and ?b=2&a=1 share the entry
+def getKey(path, query_params, format):
+    params = tuple(sorted([(k, v) for k, v in (query_params or {}).items() if k != "format"]))
+    return (path, params, format)
+
+####################################################
+# Tables read by the query, or None if they can't be determined or a view is involved
+def getSourceTables(query):
+    try:
+        tables = set([databaseService.normalizeTableName(t) for t in duckdb.get_table_names(query)])
+        views = databaseService.runQuery("SELECT lower(view_name) view_name FROM duckdb_views() WHERE NOT internal", False)
+        if (len(tables.intersection(views["view_name"].to_list())) > 0):
+            return None
+        return tables
+    except Exception as e:
+        print("Could not get source tables: " + str(e))
+        return None
+
+####################################################
+def get(key):
+    global cacheBytes
+    with cacheLock:
+        entry = cache.get(key)
+        if (entry is None):
+            return None
+        if (not entry.isValid()):
+            del cache[key]
+            cacheBytes -= len(entry.content)
+            return None
+        cache.move_to_end(key)
+        return entry
+
+####################################################
+def put(key, content, mediaType, ttl, sourceTables, versions, headers = None):
+    global cacheBytes
+    entry = CachedResponse(content, mediaType, ttl, sourceTables, versions, headers)
+    if (ttl <= 0 or len(content) > maxBytes):
+        return entry
+
+    with cacheLock:
+        previous = cache.pop(key, None)
+        if (previous is not None):
+            cacheBytes -= len(previous.content)
+        cache[key] = entry
+        cacheBytes += len(content)
+        # Evict least recently used
+        while (len(cache) > maxEntries or cacheBytes > maxBytes):
+            _, evicted = cache.popitem(last=False)
+            cacheBytes -= len(evicted.content)
+    return entry
+
+####################################################
+def invalidate(path = None):
+    global cacheBytes
+    with cacheLock:
+        if (path is None):
+            cache.clear()
+            cacheBytes = 0
+        else:
+            for key in [key for key in cache if key[0] == path]:
+                cacheBytes -= len(cache.pop(key).content)
+
+####################################################
+def toResponse(entry: CachedResponse, ifNoneMatch = None):
+    headers = dict(entry.headers)
+    headers["ETag"] = entry.etag
+    if (ifNoneMatch is not None and (ifNoneMatch.strip() == "*" or entry.etag in [tag.strip().replace("W/", "") for tag in ifNoneMatch.split(",")])):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.content, media_type=entry.mediaType, status_code=200, headers=headers)
+
+####################################################
+def getStats():
+    with cacheLock:
+        return {"entries": len(cache), "bytes": cacheBytes, "maxEntries": maxEntries, "maxBytes": maxBytes, "defaultTtl": defaultTtl}
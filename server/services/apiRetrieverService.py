@@ -1,6 +1,13 @@
 import boto3
 import requests
 import json
+import time
+import threading
+import re
+import bisect
+import urllib.parse
+import hashlib
+import pyarrow as pa
 import pandas as pd
 
 from model.apiEnrichmentRequestDTO import ApiEnrichmentRequestDTO
@@ -20,103 +27,170 @@ class dotdict(dict):
     __delattr__ = dict.__delitem__
 
 ######################################################################
+# CodeCommit repositories, loaded with pagination and refreshed in background every repositoryRefreshSeconds.
+# Searches use the sorted list of names and the index of name tokens (split by - _ .) for prefixes
+repositoryRefreshSeconds = 600
+repositories = {"names": [], "sortedNames": [], "tokens": [], "loadedAt": 0}
+repositoriesLock = threading.Lock()
+REPOSITORY_TOKEN_PATTERN = re.compile(r"[-_.]")
+
+def loadRepositories():
+    global repositories
+    print("Loading CodeCommit repositories")
+    names = []
+    for page in client.get_paginator("list_repositories").paginate():
+        names.extend([repo["repositoryName"] for repo in page["repositories"]])
+    sortedNames = sorted([(name.lower(), name) for name in names])
+    tokens = sorted([(token, name) for name in names for token in REPOSITORY_TOKEN_PATTERN.split(name.lower()) if token != ""])
+    # Swap the whole index so searches never see a partial list
+    repositories = {"names": [name for _, name in sortedNames], "sortedNames": sortedNames, "tokens": tokens, "loadedAt": time.time()}
+    print("CodeCommit repositories loaded: " + str(len(names)))
+
+def repositoryRefreshLoop():
+    while True:
+        try:
+            loadRepositories()
+        except Exception as e:
+            print("Error loading CodeCommit repositories: " + str(e))
+        time.sleep(repositoryRefreshSeconds)
+
+# Entries of a sorted list of (key, name) whose key starts with prefix
+def findPrefix(sortedList, prefix):
+    result = []
+    for i in range(bisect.bisect_left(sortedList, (prefix,)), len(sortedList)):
+        if (not sortedList[i][0].startswith(prefix)):
+            break
+        result.append(sortedList[i][1])
+    return result
+
+######################################################################
+# Names containing serviceName: those starting with it first, then those with a word starting with it
 def getServices(serviceName = None):
     if (client is None):
         print("If you want to connect to your AWS Codecommit account you have to configure your AWS credentials in secrets.toml file")
         return []
     print("Getting services")
-    if (serviceName is not None):
-        return [repo['repositoryName'] for repo in client.list_repositories()['repositories'] if serviceName.lower() in repo['repositoryName'].lower()]
-    else:
-        return [repo['repositoryName'] for repo in client.list_repositories()['repositories']]
+    index = repositories
+    if (index["loadedAt"] == 0):
+        with repositoriesLock:
+            if (repositories["loadedAt"] == 0):
+                loadRepositories()
+        index = repositories
+    if (serviceName is None or serviceName == ""):
+        return list(index["names"])
+
+    search = serviceName.lower()
+    result = list(dict.fromkeys(findPrefix(index["sortedNames"], search) + sorted(findPrefix(index["tokens"], search))))
+    found = set(result)
+    return result + [name for lower, name in index["sortedNames"] if search in lower and name not in found]
 
 ######################################################################
+# Parsed swagger definitions by service, reused for definitionCacheTtlSeconds and then revalidated with a
+# conditional GET (ETag / Last-Modified). Each one has an index of its methods so lookups don't walk the document
+definitionCacheTtlSeconds = 300
+definitions = {}
+definitionLocks = {}
+
+class Definition:
+    def __init__(self, url, response):
+        self.url = url
+        self.data = json.loads(response.content)
+        self.etag = response.headers.get("ETag")
+        self.lastModified = response.headers.get("Last-Modified")
+        self.fetchedAt = time.time()
+        self.openapi = "openapi" in self.data
+        # [{"controller", "method", "path"}] of methods with tags, and {(path, method in lower case): details}
+        self.methodList = []
+        self.methods = {}
+        for path, pathMethods in self.data.get("paths", {}).items():
+            for method, details in pathMethods.items():
+                if (not isinstance(details, dict)):
+                    continue
+                self.methods[(path, method.lower())] = details
+                if "tags" in details and details["tags"]:
+                    self.methodList.append({"controller": details["tags"][0], "method": method.upper(), "path": path, "pathLower": path.lower()})
+
+def getDefinitionUrls(repositoryName, environment, api_domain, context):
+    return ["http://" + repositoryName + "." + environment + "." + api_domain + "/" + context + "/swagger/doc",
+            "http://" + repositoryName + "." + environment + "." + api_domain + "/v3/api-docs"]
+
+def getDefinitionEntry(repositoryName, environment, api_domain, context):
+    key = (repositoryName, environment, api_domain, context)
+    with sessionLock:
+        lock = definitionLocks.setdefault(key, threading.Lock())
+    # One request per service at a time, concurrent callers wait for it
+    with lock:
+        definition = definitions.get(key)
+        if (definition is not None and time.time() - definition.fetchedAt < definitionCacheTtlSeconds):
+            return definition
+
+        session = getSession(enrichmentSettings["concurrency"])
+        if (definition is not None):
+            headers = {}
+            if (definition.etag is not None):
+                headers["If-None-Match"] = definition.etag
+            if (definition.lastModified is not None):
+                headers["If-Modified-Since"] = definition.lastModified
+            try:
+                r = session.get(definition.url, headers=headers, timeout=enrichmentSettings["timeoutSeconds"])
+                if (r.status_code == 304):
+                    definition.fetchedAt = time.time()
+                    return definition
+                if (r.status_code == 200):
+                    definitions[key] = Definition(definition.url, r)
+                    return definitions[key]
+            except Exception as e:
+                print("Error revalidating swagger definition " + definition.url + ": " + str(e))
+
+        # The url that answered last time is tried first
+        urls = getDefinitionUrls(repositoryName, environment, api_domain, context)
+        if (definition is not None):
+            urls.remove(definition.url)
+            urls.insert(0, definition.url)
+        for url in urls:
+            print("Getting method list of repository " + repositoryName + ":" + url)
+            r = session.get(url, timeout=enrichmentSettings["timeoutSeconds"])
+            print("Status code: " + str(r.status_code))
+            if (r.status_code == 200 or url == urls[-1]):
+                definitions[key] = Definition(url, r)
+                return definitions[key]
+            print("Error getting swagger definition from " + url + ", trying next path")
+
 def getDefinition(repositoryName, environment, api_domain, context):
-    url = "http://" + repositoryName + "." + environment + "." + api_domain + "/" + context + "/swagger/doc"
-    print("Getting method list of repository " + repositoryName + ":" + url)
-    swaggerJson = requests.get(url)
-    print("Status code: " + str(swaggerJson.status_code))
-    if (swaggerJson.status_code != 200):
-        print("Error getting swagger definition from path /swagger/doc, trying with /v3/api-docs")
-        url = "http://" + repositoryName + "." + environment + "." + api_domain + "/v3/api-docs"
-        print("Getting method list of repository " + repositoryName + ":" + url)
-        swaggerJson = requests.get(url)
-        data=json.loads(swaggerJson.content)
-        return data
-    data=json.loads(swaggerJson.content)
-    return data
+    return getDefinitionEntry(repositoryName, environment, api_domain, context).data
+
 ######################################################################
 # Return dataframe with methods in a service 
 def getRepositoryMethodList(repositoryName, methodName, environment, api_domain, context):
-    data = getDefinition(repositoryName, environment, api_domain, context)
-    # Check if swagger definition has property "openapi": "3.0.1" or swagger: "2.0"
-    if ('openapi' in data):
-        print("Swagger 3.0")
-        result = []
-        for path, methods in data["paths"].items():
-            if (methodName is not None and methodName.lower() in path.lower()):
-                for method, details in methods.items():
-                    if "tags" in details and details["tags"]:
-                        result.append({
-                            "controller": details["tags"][0],
-                            "method": method.upper(),
-                            "path": path
-                        })
-        return result
-    else:
-        print("Swagger 2.0")
-        paths = data['paths']
-        result = []
-        for path, methods in data["paths"].items():
-            if methodName is None or methodName.lower() in path.lower():
-                for method, details in methods.items():
-                    if "tags" in details and details["tags"]:
-                        result.append({
-                            "controller": details["tags"][0],
-                            "method": method.upper(),
-                            "path": path
-                        })
-        return result
+    definition = getDefinitionEntry(repositoryName, environment, api_domain, context)
+    print("Swagger 3.0" if definition.openapi else "Swagger 2.0")
+    search = methodName.lower() if methodName is not None else None
+    return [{"controller": m["controller"], "method": m["method"], "path": m["path"]} for m in definition.methodList if search is None or search in m["pathLower"]]
+
 ######################################################################
 def getMethodInfo(serviceName, methodPath, methodMethod, environment, api_domain, context):
     
     try:
-        data = getDefinition(serviceName, environment, api_domain, context)
-        if ('openapi' in data):
+        definition = getDefinitionEntry(serviceName, environment, api_domain, context)
+        print("methodPath: " + methodPath)
+        print("methodMethod: " + methodMethod)
+        details = definition.methods[(methodPath, methodMethod.lower())]
+        result = {}
+        if (definition.openapi):
             print("Swagger 3.0")
-            paths = data['paths']
-            print("methodPath: " + methodPath)
-            print("methodMethod: " + methodMethod)
-            print("paths: " + str(paths))
-            methodInfo = paths[methodPath]
-            print("methodInfo: " + str(methodInfo))
-            result = {}
-            result['summary'] = methodInfo[methodMethod.lower()]['responses']['200']['description']
-            result['parameters'] = methodInfo[methodMethod.lower()]['parameters']
-            result['responses'] = methodInfo[methodMethod.lower()]['responses']
-            if (methodMethod.lower()=="get"):
-                result['method'] = "GET"
-            else:
-                result['method'] = "POST"
-            
-            
-            result['origin'] = "SWAGGER"
-            result['url'] = "http://" + serviceName + "." + environment + "." + api_domain + methodPath
+            result['summary'] = details['responses']['200']['description']
         else:
             print("Swagger 2.0")
-            paths = data['paths']
-            methodInfo = paths[methodPath]
-            result = {}
-            result['summary'] = methodInfo[methodMethod.lower()]['summary']
-            result['parameters'] = methodInfo[methodMethod.lower()]['parameters']
-            result['responses'] = methodInfo[methodMethod.lower()]['responses']
-            if (methodMethod=="get"):
-                result['method'] = "GET"
-            else:
-                result['method'] = "POST"
-            
-            result['origin'] = "SWAGGER"
-            result['url'] = "http://" + serviceName + "." + environment + "." + api_domain + methodPath
+            result['summary'] = details['summary']
+        result['parameters'] = details['parameters']
+        result['responses'] = details['responses']
+        if (methodMethod.lower()=="get"):
+            result['method'] = "GET"
+        else:
+            result['method'] = "POST"
+
+        result['origin'] = "SWAGGER"
+        result['url'] = "http://" + serviceName + "." + environment + "." + api_domain + methodPath
         return result
     except Exception as e:
         print("Error getting method info: " + str(e))
@@ -194,68 +268,271 @@ def getMethodInfoFromExample(url):
         return result
 '''
 
-        
-def runApiEnrichment(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO , api_domain, environment):
-    print("ApiEnrichmentRequestDTO: " + str(apiEnrichmentRequestDTO))
 
+
+######################################################################
+# HTTP settings of API enrichment, can be overridden per request
+enrichmentSettings = {
+    "concurrency": 16,       # requests in flight
+    "batchSize": 1000,       # rows submitted at once, progress is reported per batch
+    "timeoutSeconds": 30,
+    "maxRetries": 3,         # retries of connection errors, timeouts, 429 and 5xx
+    "backoffSeconds": 0.5,   # doubled on each retry
+    "rateLimit": 0,          # max requests per second per host, 0 is unlimited
+}
+hostRateLimits = {}
+cacheTtlSeconds = 86400
+RETRY_STATUS = [429, 500, 502, 503, 504]
+JSON_PATH_PART_PATTERN = re.compile(r"^(.*?)((?:\[(?:\d+|\*|#-\d+)\])*)$")
+
+session = None
+sessionPoolSize = 0
+sessionLock = threading.Lock()
+rateLimiters = {}
+
+def init(config):
+    global hostRateLimits
+    global cacheTtlSeconds
+    global definitionCacheTtlSeconds
+    global repositoryRefreshSeconds
+    for key in enrichmentSettings:
+        enrichmentSettings[key] = config.get("apiEnrichment" + key[0].upper() + key[1:], enrichmentSettings[key])
+    hostRateLimits = config.get("apiEnrichmentHostRateLimits") or {}
+    cacheTtlSeconds = config.get("apiEnrichmentCacheTtlSeconds", cacheTtlSeconds)
+    definitionCacheTtlSeconds = config.get("swaggerDefinitionCacheTtlSeconds", definitionCacheTtlSeconds)
+    repositoryRefreshSeconds = config.get("codeCommitRefreshSeconds", repositoryRefreshSeconds)
+    if (client is not None):
+        threading.Thread(target=repositoryRefreshLoop, name="codeCommitRefresh", daemon=True).start()
+    print("API enrichment settings: " + str(enrichmentSettings))
+
+######################################################################
+# Shared session so connections are kept alive and reused between rows and enrichments
+def getSession(poolSize):
+    global session
+    global sessionPoolSize
+    with sessionLock:
+        if (session is None or sessionPoolSize < poolSize):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessionPoolSize = poolSize
+        return session
+
+######################################################################
+# Spaces the requests to a host so there are at most `rate` per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.nextTime = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.nextTime - now
+            self.nextTime = max(now, self.nextTime) + self.interval
+        if (wait > 0):
+            time.sleep(wait)
+
+def getRateLimiter(host, rate):
+    rate = hostRateLimits.get(host, rate)
+    if (rate is None or rate <= 0):
+        return None
+    with sessionLock:
+        limiter = rateLimiters.get((host, rate))
+        if (limiter is None):
+            limiter = rateLimiters[(host, rate)] = RateLimiter(rate)
+        return limiter
+
+######################################################################
+def getEnrichmentSettings(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+    settings = dict(enrichmentSettings)
+    for key in settings:
+        value = getattr(apiEnrichmentRequestDTO, key, None)
+        if (value is not None):
+            settings[key] = value
+    settings["concurrency"] = max(1, int(settings["concurrency"]))
+    settings["batchSize"] = max(1, int(settings["batchSize"]))
+    return settings
+
+def getCacheTtl(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+    return apiEnrichmentRequestDTO.cacheTtlSeconds if apiEnrichmentRequestDTO.cacheTtlSeconds is not None else cacheTtlSeconds
+
+######################################################################
+# Method, url and body of the request for a row
+def buildRequest(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO, row):
+    if (apiEnrichmentRequestDTO.method.method == "POST"):
+        body = apiEnrichmentRequestDTO.jsonBody or "{}"
+        for col in row:
+            body = body.replace("${" + col + "}", str(row[col]))
+        return "POST", apiEnrichmentRequestDTO.url, body
+
+    queryString = {}
+    for param in (apiEnrichmentRequestDTO.parameters or {}).items():
+        # if param value is not none:
+        if (param[1] is not None and param[1] != ""):
+            queryString[param[0]] = str(row[param[1]])
+    return "GET", apiEnrichmentRequestDTO.url + "?" + urllib.parse.urlencode(queryString), None
+
+######################################################################
+# Call the API retrying errors with exponential backoff. Returns (status code, response text) or None.
+# The response is not parsed here, mappings are extracted in DuckDB
+def callApi(session, method, url, body, settings):
+    limiter = getRateLimiter(urllib.parse.urlparse(url).netloc, settings["rateLimit"])
+    for attempt in range(settings["maxRetries"] + 1):
+        if (limiter is not None):
+            limiter.acquire()
+        backoff = settings["backoffSeconds"] * (2 ** attempt)
+        try:
+            r = session.request(method, url, json=json.loads(body) if body is not None else None, timeout=settings["timeoutSeconds"])
+            if (r.status_code in RETRY_STATUS and attempt < settings["maxRetries"]):
+                retryAfter = r.headers.get("Retry-After")
+                time.sleep(float(retryAfter) if retryAfter is not None and retryAfter.isdigit() else backoff)
+                continue
+            return r.status_code, r.text
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if (attempt == settings["maxRetries"]):
+                print("Error calling API " + url + ": " + str(e))
+                return None
+            time.sleep(backoff)
+        except Exception as e:
+            print("Error calling API " + url + ": " + str(e))
+            return None
+
+######################################################################
+# Responses are cached in __api_cache by hash of method, url and body, for cacheTtlSeconds
+def createCacheTable():
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __api_cache (key VARCHAR PRIMARY KEY, method VARCHAR, url VARCHAR, body VARCHAR, status INTEGER, response VARCHAR, created_at TIMESTAMP)", False)
+
+def getCacheKey(method, url, body):
+    return hashlib.sha256((method + "\n" + url + "\n" + (body or "")).encode("utf-8")).hexdigest()
+
+# {key: (status, response)} of the keys cached less than ttl seconds ago
+def getCachedResponses(keys, ttl):
+    if (ttl is None or ttl <= 0 or len(keys) == 0):
+        return {}
+    createCacheTable()
+    df = databaseService.queryDataFrame(pd.DataFrame({"key": keys}), "__api_cache_keys",
+                                        "SELECT c.key, c.status, c.response FROM __api_cache c JOIN __api_cache_keys k ON c.key = k.key " +
+                                        "WHERE c.created_at > now()::TIMESTAMP - INTERVAL " + str(int(ttl)) + " SECOND")
+    return {key: (status, response) for key, status, response in zip(df["key"], df["status"], df["response"])}
+
+# Only successful responses are cached, errors are retried on the next run
+def saveCachedResponses(apiRequests, responses):
+    rows = []
+    for (key, method, url, body), response in zip(apiRequests, responses):
+        if (response is not None and response[0] < 400):
+            rows.append({"key": key, "method": method, "url": url, "body": body, "status": response[0], "response": response[1]})
+    if (len(rows) == 0):
+        return
+    createCacheTable()
+    databaseService.queryDataFrame(pd.DataFrame(rows), "__api_cache_rows",
+                                   "INSERT OR REPLACE INTO __api_cache SELECT key, method, url, body, status, response, now()::TIMESTAMP FROM __api_cache_rows")
+
+def clearCache(url = None):
+    createCacheTable()
+    where = "" if url is None else " WHERE url LIKE " + databaseService.toSqlLiteral(url + "%")
+    databaseService.runQuery("DELETE FROM __api_cache" + where)
+
+######################################################################
+# Columns of the rows used to build the request: the mapped parameters of GET methods, the ${column} of POST bodies
+def getRequestColumns(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO, columns):
+    if (apiEnrichmentRequestDTO.method.method == "POST"):
+        return [col for col in columns if "${" + col + "}" in (apiEnrichmentRequestDTO.jsonBody or "")]
+    return list(dict.fromkeys([col for col in (apiEnrichmentRequestDTO.parameters or {}).values() if col is not None and col != ""]))
+
+######################################################################
+# jsonField as a JSON path: "$..." is used as is, "a.b[0].c" becomes $.a.b[0].c and "items[*].id" returns a list
+def toJsonPath(jsonField):
+    if (jsonField.startswith("$")):
+        return jsonField
+    parts = []
+    for part in jsonField.split("."):
+        name, indexes = JSON_PATH_PART_PATTERN.match(part).groups()
+        if (not re.match(r"^\w+$", name)):
+            name = '"' + name.replace('"', '\\"') + '"'
+        parts.append(name + indexes)
+    return "$." + ".".join(parts)
+
+######################################################################
+# New columns extracted from the responses (r.__json) in SQL: the mapped json fields, or the whole response, and the status
+def getMappingExpressions(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+    expressions = {}
+    if (apiEnrichmentRequestDTO.mappings is not None):
+        for mapping in apiEnrichmentRequestDTO.mappings:
+            path = toJsonPath(mapping.jsonField) if (mapping.jsonField is not None and mapping.jsonField != "") else "$"
+            expressions[mapping.newFieldName] = "json_extract_string(r.__json, " + databaseService.toSqlLiteral(path) + ")"
+    else:
+        expressions["RESPONSE"] = "json_extract_string(r.__json, '$')"
+    expressions["RESPONSE_STATUS"] = "CAST(r.__status AS VARCHAR)"
+    return expressions
+
+######################################################################
+# Source query of the enrichment. It runs twice (distinct request values, then the assembly), with a limit
+# the rows are ordered so both runs read the same rows: the first ones in insertion order (rowid) for tables,
+# views have no rowid and are sorted by all columns
+def getSourceQuery(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
     query = "SELECT * FROM " + apiEnrichmentRequestDTO.tableName
     if (apiEnrichmentRequestDTO.recordsToProcess is not None and apiEnrichmentRequestDTO.recordsToProcess != ""):
-        query = "SELECT * FROM " + apiEnrichmentRequestDTO.tableName + " LIMIT " + str(apiEnrichmentRequestDTO.recordsToProcess)
+        tableName = databaseService.normalizeTableName(apiEnrichmentRequestDTO.tableName)
+        tables = databaseService.runQuery("SELECT table_name FROM duckdb_tables() WHERE lower(table_name) = " + databaseService.toSqlLiteral(tableName), False)
+        orderBy = " ORDER BY rowid" if len(tables) > 0 else " ORDER BY ALL"
+        query += orderBy + " LIMIT " + str(int(apiEnrichmentRequestDTO.recordsToProcess))
+    return query
+
+######################################################################
+# The API is called once per distinct combination of the request columns (computed in DuckDB). Returns the
+# source query and columns, the request columns, their distinct values and the request (key, method, url, body) of each
+def planEnrichment(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+    query = getSourceQuery(apiEnrichmentRequestDTO)
     print("Query: " + query)
-    
-    dfNew = databaseService.runQuery(query)
-    
-    if (dfNew is not None):
-        # For each row in the table
-        for index, row in dfNew.iterrows():
-            queryString=""
-            if (apiEnrichmentRequestDTO.method is not None and apiEnrichmentRequestDTO.parameters is not None):
-                for param in apiEnrichmentRequestDTO.parameters.items():
-                    # if param value is not none:
-                    if (param[1] is not None and param[1] != ""):
-                        queryString += param[0] + "=" + str(row[param[1]]) + "&"
-
-            if(apiEnrichmentRequestDTO.method.method=="GET"):
-                #url = "http://" + ses["service"] + "." + environment + "." + st.secrets["api_domain"] + ses["method"] + "?" + queryString
-                url = apiEnrichmentRequestDTO.url + "?" + queryString
-                r = getApi(url)
-            elif(apiEnrichmentRequestDTO.method.method=="POST"):
-                #if (apiEnrichmentRequestDTO.method == "SWAGGER"):
-                url = "http://" + apiEnrichmentRequestDTO.service + "." + environment + "." + api_domain + apiEnrichmentRequestDTO.method
-                #elif (apiEnrichmentRequestDTO.method == "EXAMPLE"):
-                #    url = apiEnrichmentRequestDTO.manualApiUrl
-                
-                bodyTemplate = apiEnrichmentRequestDTO.jsonBody
-                for col in dfFields:
-                    bodyTemplate = bodyTemplate.replace("${"+col+"}", str(row[col]))
-
-                r = postApi(url, bodyTemplate)
-                if (r is not None):
-                    if (r.status_code != 200):
-                        print("Error calling API: " + str(r.status_code))
-                    else:
-                        jsonString = json.dumps(r.json(), indent=4)
-
-            percent_complete = int((index+1) / len(dfNew) * 100)
-            #my_bar.progress(percent_complete, text="Processing file..." + str(percent_complete) + "%" + " (" + str(index+1) + "/" + str(len(dfNew)) + ")")
-            
-        
-            if (r is not None):
-                if (apiEnrichmentRequestDTO.mappings is not None):
-                    for mapping in apiEnrichmentRequestDTO.mappings:
-                        if (mapping.jsonField is not None and mapping.jsonField != ""):
-                            try:
-                                dfNew.loc[index, mapping.newFieldName] = str(r.json()[mapping.jsonField])
-                            except Exception as e:
-                                print("Error getting field " + mapping.jsonField + " from json: " + str(e))
-                            
-                        else:
-                            dfNew.loc[index, mapping.newFieldName] = str(r.json())
-                else:
-                    dfNew.loc[index, "RESPONSE"] = str(r.json())
-                dfNew.loc[index, "RESPONSE_STATUS"] = str(r.status_code)
-                
-    # Create table with the dataframe dfNew
+
+    columns = list(databaseService.runQuery("SELECT * FROM (" + query + ") LIMIT 0").columns)
+    requestColumns = getRequestColumns(apiEnrichmentRequestDTO, columns)
+    if (len(requestColumns) > 0):
+        distinct = databaseService.runQuery("SELECT DISTINCT " + ", ".join(['"' + c + '"' for c in requestColumns]) + " FROM (" + query + ")", format="arrow")
+        rows = distinct.to_pylist()
+    else:
+        distinct = None
+        rows = [{}]
+
+    apiRequests = []
+    for row in rows:
+        method, url, body = buildRequest(apiEnrichmentRequestDTO, row)
+        apiRequests.append((getCacheKey(method, url, body), method, url, body))
+    return {"query": query, "columns": columns, "requestColumns": requestColumns, "distinct": distinct, "rows": rows, "requests": apiRequests}
+
+######################################################################
+# Call the APIs of a batch of requests with the worker pool, caching the responses
+def callApis(apiRequests, settings, executor):
+    session = getSession(settings["concurrency"])
+    responses = list(executor.map(lambda r: callApi(session, *r[1:], settings), apiRequests))
+    saveCachedResponses(apiRequests, responses)
+    return responses
+
+######################################################################
+# Build the new table in one step: the responses (one per distinct request) are loaded as Arrow columns,
+# the mappings extracted with json_extract_string and the result joined to the source rows
+def assembleEnrichment(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO, plan, responses):
+    requestColumns = plan["requestColumns"]
+    statuses = pa.array([response[0] if response is not None else None for response in responses], pa.int32())
+    texts = pa.array([response[1] if response is not None else None for response in responses], pa.string())
+    if (plan["distinct"] is not None):
+        arrowResponses = plan["distinct"].append_column("__status", statuses).append_column("__response", texts)
+    else:
+        arrowResponses = pa.table({"__status": statuses, "__response": texts})
+
+    expressions = getMappingExpressions(apiEnrichmentRequestDTO)
+    # Keep the order of the rows. New columns replace source columns with the same name. Responses that
+    # are not JSON are kept as JSON strings
+    replaced = [c for c in plan["columns"] if c in expressions]
+    join = " AND ".join(['s."' + c + '" IS NOT DISTINCT FROM r."' + c + '"' for c in requestColumns]) or "TRUE"
     print("Creating table " + apiEnrichmentRequestDTO.newTableName + "...")
-    databaseService.createTableFromDataFrame("dfNew", apiEnrichmentRequestDTO.newTableName)
-    return dfNew
+    databaseService.queryDataFrame(arrowResponses, "__api_enrichment_responses",
+                                   "CREATE OR REPLACE TABLE " + apiEnrichmentRequestDTO.newTableName + " AS " +
+                                   "SELECT s.* EXCLUDE (__row" + "".join([', "' + c + '"' for c in replaced]) + "), " +
+                                   ", ".join([expression + ' AS "' + name + '"' for name, expression in expressions.items()]) + " " +
+                                   "FROM (SELECT *, row_number() OVER () __row FROM (" + plan["query"] + ")) s " +
+                                   "LEFT JOIN (SELECT * EXCLUDE (__response), CASE WHEN json_valid(__response) THEN __response::JSON ELSE to_json(__response) END __json FROM __api_enrichment_responses) r " +
+                                   "ON " + join + " ORDER BY s.__row")
@@ -1,10 +1,209 @@
 from services import databaseService
 from model.PublishEndpointRequestDTO import PublishEndpointRequestDTO
 from services import queriesService
+from services import apiCacheService
+from services import materializationService
 import json
 from fastapi.responses import JSONResponse
 import base64
 import requests
+import urllib.parse
+import re
+import io
+import threading
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+# Published endpoints keyed by path, loaded once from __endpoints and reloaded when an endpoint changes
+endpointRegistry = None
+registryLock = threading.Lock()
+PLACEHOLDER_PATTERN = re.compile(r"\{(\w+)\}")
+BOUND_PARAMETER_PATTERN = re.compile(r"\$(\w+)")
+INTEGER_PATTERN = re.compile(r"^-?(0|[1-9][0-9]*)$")
+NUMBER_PATTERN = re.compile(r"^-?[0-9]+(\.[0-9]+)?$")
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][\w.]*$")
+PARAMETER_TYPES = ["integer", "number", "boolean", "string", "identifier"]
+ORDER_BY_PATTERN = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+ORDER_BY_ALL_PATTERN = re.compile(r"^\s*ALL\b", re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r"\b(LIMIT|OFFSET)\b", re.IGNORECASE)
+NESTED_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|--[^\n]*")
+STREAM_BATCH_SIZE = 10000
+SAMPLE_ROWS = 3
+openApiDefinition = None
+
+class RegisteredEndpoint:
+    def __init__(self, endpoint: PublishEndpointRequestDTO):
+        self.endpoint = endpoint
+        # Parameter names used in the query as {param}, in order of appearance
+        self.placeholders = list(dict.fromkeys(PLACEHOLDER_PATTERN.findall(endpoint.query)))
+        self.statementName = "__endpoint_" + str(endpoint.id_endpoint)
+        self.sourceTables = None
+        self.sourceTablesLoaded = False
+        self.columnCounts = {}
+        self.parameterTypes = getParameterTypes(endpoint)
+        self.compiledQuery, stringParameters = compileQuery(endpoint.query, self.identifierParameters())
+        for param in stringParameters:
+            self.parameterTypes[param] = "string"
+
+        # Placeholders used where a value can't go (table or column names) can't be bound, substitute them as identifiers
+        try:
+            duckdb.extract_statements(self.compiledQuery.replace("{", "").replace("}", ""))
+        except duckdb.ParserException:
+            print("Query of endpoint " + endpoint.endpoint + " can't be prepared, parameters will be substituted as identifiers")
+            for param in self.placeholders:
+                if (param not in stringParameters):
+                    self.parameterTypes[param] = "identifier"
+            self.compiledQuery, _ = compileQuery(endpoint.query, self.identifierParameters())
+
+        # Endpoints publishing their saved query as is can read its materialization
+        self.publishesSavedQuery = len(self.placeholders) == 0 and isSavedQuery(endpoint)
+
+    def getCacheTtl(self):
+        if (self.endpoint.cacheTtl is not None):
+            return self.endpoint.cacheTtl
+        return apiCacheService.defaultTtl
+
+    # Computed once, the query can't change without reloading the registry. The materialized table is added so
+    # a refresh invalidates the cached responses
+    def getSourceTables(self):
+        if (not self.sourceTablesLoaded):
+            self.sourceTables = apiCacheService.getSourceTables(self.getParsableQuery())
+            self.sourceTablesLoaded = True
+        materializedTable = self.getMaterializedTable()
+        if (materializedTable is not None and self.sourceTables is not None):
+            return self.sourceTables | {databaseService.normalizeTableName(materializedTable)}
+        return self.sourceTables
+
+    def getMaterializedTable(self):
+        if (not self.publishesSavedQuery):
+            return None
+        return materializationService.getMaterializedTable(self.endpoint.id_query)
+
+    # Compiled query with NULL in place of the bound parameters, queries with $param can't be parsed alone
+    def getParsableQuery(self):
+        return BOUND_PARAMETER_PATTERN.sub("NULL", self.compiledQuery)
+
+    # Number of columns returned by the bound query, identifier parameters can change it
+    def getColumnCount(self, query, values):
+        if (query not in self.columnCounts):
+            self.columnCounts[query] = len(databaseService.describeQuery(query, values))
+        return self.columnCounts[query]
+
+    def identifierParameters(self):
+        return [param for param, type in self.parameterTypes.items() if type == "identifier"]
+
+    # Build the query and the typed values to bind from the request parameters
+    def bind(self, query_params):
+        materializedTable = self.getMaterializedTable()
+        if (materializedTable is not None):
+            return "SELECT * FROM " + materializedTable, {}
+
+        query = self.compiledQuery
+        values = {}
+        for param in self.placeholders:
+            value = convertParameter(param, query_params[param], self.parameterTypes.get(param, "string"))
+            if (self.parameterTypes.get(param) == "identifier"):
+                query = query.replace("{" + param + "}", value)
+            else:
+                values[param] = value
+        return query, values
+
+####################################################
+# True if the endpoint query is the text of its saved query
+def isSavedQuery(endpoint: PublishEndpointRequestDTO):
+    if (endpoint.id_query is None):
+        return False
+    try:
+        savedQuery = queriesService.getQuery(endpoint.id_query)
+    except Exception as e:
+        print("Error getting saved query of endpoint " + endpoint.endpoint + ": " + str(e))
+        return False
+    if (savedQuery is None):
+        return False
+    return normalizeQuery(savedQuery["query"]) == normalizeQuery(endpoint.query)
+
+def normalizeQuery(query):
+    return " ".join(query.split()).rstrip(";").strip()
+
+####################################################
+# Declared parameter types, or inferred from the example values. Numeric examples are inferred as number, "5"
+# doesn't tell whether 1.5 is valid, only a declared integer type rejects decimals
+def getParameterTypes(endpoint: PublishEndpointRequestDTO):
+    parameterTypes = {}
+    for param in (endpoint.parameters or []):
+        if (param.type is not None and param.type.lower() in PARAMETER_TYPES):
+            parameterTypes[param.name] = param.type.lower()
+        elif (param.exampleValue is not None and NUMBER_PATTERN.match(param.exampleValue)):
+            parameterTypes[param.name] = "number"
+        else:
+            parameterTypes[param.name] = "string"
+    return parameterTypes
+
+####################################################
+def convertParameter(name, value, type):
+    try:
+        if (type == "integer"):
+            return int(value)
+        elif (type == "number"):
+            # Integers are kept exact, large ids don't fit in a float
+            if (INTEGER_PATTERN.match(str(value))):
+                return int(value)
+            return float(value)
+        elif (type == "boolean"):
+            if (str(value).lower() not in ["true", "false", "1", "0"]):
+                raise ValueError(value)
+            return str(value).lower() in ["true", "1"]
+        elif (type == "identifier"):
+            if (not IDENTIFIER_PATTERN.match(str(value))):
+                raise ValueError(value)
+            return str(value)
+        return str(value)
+    except ValueError:
+        raise Exception("Parameter " + name + " must be of type " + type + ": " + str(value))
+
+####################################################
+# Replace {param} by $param so it can be bound in a prepared statement. Placeholders inside string
+# literals ('%{marca}%') become a concatenation ('%' || $marca || '%'). Returns the query and the
+# parameters found inside literals, which are always strings
+def compileQuery(query, identifierParameters):
+    result = ""
+    stringParameters = set()
+    i = 0
+    while i < len(query):
+        if (query[i] == "'"):
+            # Find the end of the literal, '' is an escaped quote
+            j = i + 1
+            while j < len(query):
+                if (query[j] == "'"):
+                    if (j + 1 < len(query) and query[j + 1] == "'"):
+                        j += 2
+                        continue
+                    break
+                j += 1
+            parts = PLACEHOLDER_PATTERN.split(query[i + 1:j])
+            if (len(parts) == 1):
+                result += query[i:j + 1]
+            else:
+                pieces = []
+                for k, part in enumerate(parts):
+                    if (k % 2 == 0):
+                        if (part != ""):
+                            pieces.append("'" + part + "'")
+                    else:
+                        pieces.append("$" + part)
+                        stringParameters.add(part)
+                result += "(" + " || ".join(pieces) + ")"
+            i = j + 1
+        else:
+            m = PLACEHOLDER_PATTERN.match(query, i)
+            if (m is not None and m.group(1) not in identifierParameters):
+                result += "$" + m.group(1)
+                i = m.end()
+            else:
+                result += query[i]
+                i += 1
+    return result, stringParameters
 
 def update(publishEndpointRequestDTO: PublishEndpointRequestDTO):
     print("Publishing query " + publishEndpointRequestDTO.endpoint + " with parameters " + str(publishEndpointRequestDTO.parameters) + " for query " + str(publishEndpointRequestDTO.id_query))
@@ -23,13 +222,16 @@ def update(publishEndpointRequestDTO: PublishEndpointRequestDTO):
     publishEndpointRequestDTO.query = publishEndpointRequestDTO.query.replace("'","''")                
 
     try:
+        # Databases created before cacheTtl don't have the column until the registry is loaded
+        migrateTable()
         updateQuery = "UPDATE __endpoints  SET id_query = " + str(publishEndpointRequestDTO.id_query) + ", \
                                endpoint = '" + publishEndpointRequestDTO.endpoint + "', \
                                parameters = '" + parametersJson + "', \
                                description = '" + publishEndpointRequestDTO.description + "', \
                                query = '" + publishEndpointRequestDTO.query + "', \
                                queryStringTest = '" + publishEndpointRequestDTO.queryStringTest + "', \
-                               status = '" + publishEndpointRequestDTO.status + "' \
+                               status = '" + publishEndpointRequestDTO.status + "', \
+                               cacheTtl = " + ("NULL" if publishEndpointRequestDTO.cacheTtl is None else str(int(publishEndpointRequestDTO.cacheTtl))) + " \
                                 WHERE id_endpoint = " + str(publishEndpointRequestDTO.id_endpoint)
         print("updateQuery: " + updateQuery)
         databaseService.runQuery(updateQuery)
@@ -37,58 +239,216 @@ def update(publishEndpointRequestDTO: PublishEndpointRequestDTO):
         print("Error updating endpoint:" + str(e))
         return False        
 
+    registry = reloadEndpointRegistry()
+    if (publishEndpointRequestDTO.endpoint in registry):
+        refreshEndpointSample(registry[publishEndpointRequestDTO.endpoint])
     return True
 
+####################################################
+def reloadEndpointRegistry():
+    global endpointRegistry
+    print("Loading endpoint registry")
+
+    try:
+        migrateTable()
+        df = databaseService.runQuery("SELECT * FROM __endpoints WHERE endpoint IS NOT NULL AND query IS NOT NULL", False)
+    except Exception as e:
+        print("Error loading endpoints: " + str(e))
+        df = None
+
+    registry = {}
+    if (df is not None):
+        for i in range(len(df)):
+            try:
+                endpoint = PublishEndpointRequestDTO.from_dataframe(df.iloc[[i]])
+                registry[endpoint.endpoint] = RegisteredEndpoint(endpoint)
+            except Exception as e:
+                print("Error loading endpoint " + str(df["endpoint"].iloc[i]) + ": " + str(e))
+
+    # Swap the whole dict so readers never see a partially loaded registry
+    endpointRegistry = registry
+    apiCacheService.invalidate()
+    invalidateApiDefinition()
+    print("Endpoints loaded: " + str(len(registry)))
+    return registry
+
+####################################################
+def invalidateApiDefinition():
+    global openApiDefinition
+    openApiDefinition = None
+
+####################################################
+# Forget loaded endpoints (e.g. when the database changes), they will be reloaded on next call
+def invalidateEndpointRegistry():
+    global endpointRegistry
+    endpointRegistry = None
+    invalidateApiDefinition()
+
+####################################################
+def getRegisteredEndpoint(path):
+    registry = endpointRegistry
+    if (registry is None):
+        with registryLock:
+            registry = endpointRegistry
+            if (registry is None):
+                registry = reloadEndpointRegistry()
+    return registry.get(path)
+
+####################################################
+def getRegisteredEndpoints():
+    getRegisteredEndpoint("")
+    registry = endpointRegistry
+    return list(registry.values()) if registry is not None else []
+
 ####################################################
 
 def getEndpointConfiguration(path):
     print("Getting endpoint " + path)
-    
-    # Search query into __queries table lower case
-    df = databaseService.runQuery("SELECT * FROM __endpoints WHERE endpoint = '" + path + "'")
-
-    # Map df to PublishEndpointRequestDTO object
-    endpoint = PublishEndpointRequestDTO.from_dataframe(df)
 
+    registeredEndpoint = getRegisteredEndpoint(path)
 
-    if (endpoint is not None):
-        return endpoint
+    if (registeredEndpoint is not None):
+        return registeredEndpoint.endpoint
     else:
         return None
 
 ####################################################
-def getAndRunEndpoint(path, query_params, body):
+def getAndRunEndpoint(path, query_params, body, limit = None, offset = 0):
     print("Getting and running endpoint " + path + " with query_params " + str(query_params) + " and body " + str(body))
 
-    endpoint = getEndpointConfiguration(path)
-    
-
-    if (endpoint is not None):
-        print("endpoint: ", endpoint)
+    registeredEndpoint, query, values = bindEndpoint(path, query_params)
+    statementName = registeredEndpoint.statementName
+    if (limit is not None):
+        query, values = paginate(registeredEndpoint, query, values, limit, offset)
+        statementName += "_page"
 
-        # Query contains expressoins like {marca} or {marca_id} replace with query_params
-        query = endpoint.query
-        if (query_params is not None):
-            for param in query_params:
-                query = query.replace("{" + param + "}", query_params[param])
+    # Run query
+    print("Running query: " + query + " with values " + str(values))
+    df = databaseService.runPrepared(statementName, query, values)
 
-        # Check if any parameter remains in query, if so raise exception
-        if ("{" in query):
-            raise Exception("Some needed parameters were not found: " + query)
-        
-        
-        # Run query
-        print("Running query: " + query)
-        df = databaseService.runQuery(query)
+    if (df is not None):
+        return df
+    else:
+        return None
 
-        if (df is not None):
-            return df
-        else:
-            return None
-    
+####################################################
+# Yield the endpoint result in format (NDJSON, CSV or ARROW) chunk by chunk, one per record batch
+def streamEndpoint(path, query_params, format, limit = None, offset = 0):
+    print("Streaming endpoint " + path + " with query_params " + str(query_params) + " as " + format)
+
+    # Bind before streaming so errors are returned as a normal response
+    registeredEndpoint, query, values = bindEndpoint(path, query_params)
+    statementName = registeredEndpoint.statementName
+    if (limit is not None):
+        query, values = paginate(registeredEndpoint, query, values, limit, offset)
+        statementName += "_page"
+
+    batches = databaseService.streamPrepared(statementName, query, values, STREAM_BATCH_SIZE)
+    if (format == "ARROW"):
+        return streamArrow(batches)
+    elif (format == "CSV"):
+        return streamCsv(batches)
     else:
+        return streamNdjson(batches)
+
+def streamNdjson(batches):
+    for batch in batches:
+        if (batch.num_rows > 0):
+            yield batch.to_pandas().to_json(orient="records", lines=True, date_format="iso").rstrip("\n") + "\n"
+
+def streamCsv(batches):
+    header = True
+    for batch in batches:
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(batch, sink, pacsv.WriteOptions(include_header=header))
+        header = False
+        yield sink.getvalue().to_pybytes()
+
+def streamArrow(batches):
+    sink = io.BytesIO()
+    writer = None
+    for batch in batches:
+        if (writer is None):
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate(0)
+    if (writer is not None):
+        writer.close()
+        yield sink.getvalue()
+
+####################################################
+def bindEndpoint(path, query_params):
+    registeredEndpoint = getRegisteredEndpoint(path)
+
+    if (registeredEndpoint is None):
         raise Exception("Endpoint not found: " + path)
 
+    print("endpoint: ", registeredEndpoint.endpoint)
+
+    # Check if any parameter is missing, if so raise exception
+    missing = [param for param in registeredEndpoint.placeholders if query_params is None or param not in query_params]
+    if (len(missing) > 0):
+        raise Exception("Some needed parameters were not found: " + ", ".join(missing))
+
+    # Query contains expressoins like {marca} or {marca_id}, bind them with query_params
+    query, values = registeredEndpoint.bind(query_params)
+    return registeredEndpoint, query, values
+
+####################################################
+# Return one page of the query. Pages are only stable if the order is total: the ORDER BY of the query is
+# completed with all its columns to break ties and the page is taken from it. Queries without ORDER BY, or
+# already limited, are wrapped and sorted by all columns
+def paginate(registeredEndpoint, query, values, limit, offset):
+    query = query.strip()
+    if (query.endswith(";")):
+        query = query[:-1]
+    values = dict(values)
+    values["__limit"] = int(limit)
+    values["__offset"] = int(offset)
+
+    # ORDER BY, LIMIT and OFFSET inside parentheses (subqueries, window functions) or strings are not the query's
+    topLevel = maskNested(query)
+    orderBy = None
+    for orderBy in ORDER_BY_PATTERN.finditer(topLevel):
+        pass
+    if (orderBy is not None):
+        limitClause = LIMIT_PATTERN.search(topLevel, orderBy.end())
+        end = limitClause.start() if limitClause is not None else len(query)
+        if (not ORDER_BY_ALL_PATTERN.match(query[orderBy.end():end])):
+            columnCount = registeredEndpoint.getColumnCount(query, {k: v for k, v in values.items() if not k.startswith("__")})
+            tieBreak = ", " + ", ".join(["#" + str(i + 1) for i in range(columnCount)])
+            query = query[:end].rstrip() + tieBreak + " " + query[end:]
+        if (limitClause is None):
+            return query.rstrip() + " LIMIT $__limit OFFSET $__offset", values
+
+    return "SELECT * FROM (" + query + ") AS __page ORDER BY ALL LIMIT $__limit OFFSET $__offset", values
+
+# Blank strings, comments and everything inside parentheses, keeping the positions
+def maskNested(query):
+    masked = NESTED_PATTERN.sub(lambda m: " " * len(m.group(0)), query)
+    result = []
+    depth = 0
+    for c in masked:
+        if (c == "("):
+            depth += 1
+        result.append(c if depth == 0 else " ")
+        if (c == ")" and depth > 0):
+            depth -= 1
+    return "".join(result)
+
+####################################################
+# Cursors are opaque to clients, they encode the offset of the next page
+def encodeCursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("utf-8")
+
+def decodeCursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))["offset"])
+    except Exception:
+        raise Exception("Invalid cursor: " + str(cursor))
+
 ####################################################
 def listEndpoints():
     print("Getting available endpoints")
@@ -127,6 +487,7 @@ def createEndpoint():
         print("Result:" + str(id))
         
         print("id:" + str(id_endpoint))
+        reloadEndpointRegistry()
         return id_endpoint
     else: 
         return None
@@ -143,6 +504,9 @@ def deleteEndpoint(id_endpoint: int):
         databaseService.runQuery("DELETE FROM __endpoints WHERE id_endpoint = " + str(id_endpoint))
         return False        
 
+    if "__endpoint_samples" in databaseService.getTableList(False):
+        databaseService.runQuery("DELETE FROM __endpoint_samples WHERE id_endpoint = " + str(id_endpoint))
+    reloadEndpointRegistry()
     return True
 
 ####################################################
@@ -151,125 +515,164 @@ def createTable():
     # check if meta data table __endpoints exists
     if "__endpoints" not in tableList:
         print("Creating table __endpoints")
-        databaseService.runQuery("CREATE TABLE __endpoints (id_endpoint INTEGER PRIMARY KEY, id_query INTEGER, endpoint VARCHAR(255), parameters VARCHAR(255), description VARCHAR(255), query VARCHAR(255), queryStringTest VARCHAR(255), status VARCHAR(10));CREATE SEQUENCE seq_id_endpoint START 1;")
+        databaseService.runQuery("CREATE TABLE __endpoints (id_endpoint INTEGER PRIMARY KEY, id_query INTEGER, endpoint VARCHAR(255), parameters VARCHAR(255), description VARCHAR(255), query VARCHAR(255), queryStringTest VARCHAR(255), status VARCHAR(10), cacheTtl INTEGER);CREATE SEQUENCE seq_id_endpoint START 1;")
+
+####################################################
+# Add columns introduced after __endpoints was created
+def migrateTable():
+    if "__endpoints" in databaseService.getTableList(False):
+        databaseService.runQuery("ALTER TABLE __endpoints ADD COLUMN IF NOT EXISTS cacheTtl INTEGER", False)
 
 ####################################################
 # Return True if endpoint exists        
 def checkIfEndPointExists(endpoint):
     print("Checking if endpoint exists " + str(endpoint))
     
-    # Search query into __queries table lower case
-    df = databaseService.runQuery("SELECT * FROM __endpoints WHERE endpoint = '" + endpoint + "'")
-
-    if (df is not None and len(df) > 0):
-        return True
-    else:
-        return False
+    return getRegisteredEndpoint(endpoint) is not None
 
 ####################################################
+# OpenAPI document built from the endpoint definitions and their result schemas, without running the
+# endpoints. Cached until an endpoint changes
 def getApiDefinition(path):
+    global openApiDefinition
     print("Getting API definition for " + path)
-    '''
-    
-    endpoints = [
-        {
-            "path": "/endpoint1",
-            "query": "param1=value1&param2=value2",
-            "response": {"key1": "value1", "key2": "value2"}
-        },
-        {
-            "path": "/endpoint2",
-            "query": "param3=value3",
-            "response": {"key3": "value3"}
-        }
-    ]
-    '''
-    endpoints = listEndpoints()
-
-    '''
-    [
-        {
-            "id_endpoint": 37,
-            "id_query": 11,
-            "endpoint": "buscarMarca",
-            "parameters": "[{\"name\": \"marca\", \"exampleValue\": \"FORD\"}]",
-            "description": "Busca una marca",
-            "query": "SELECT marca, marca_id \nFROM catalogoCoches\nWHERE marca LIKE '%{marca}%'\nGROUP BY marca, marca_id\nORDER BY marca_id asc",
-            "queryStringTest": "?marca=FORD",
-            "status": "DEV"
-        },
-        {
-            "id_endpoint": 33,
-            "id_query": 21,
-            "endpoint": "irisBySepalLength",
-            "parameters": "[{\"name\": \"max_length\", \"exampleValue\": \"5\"}, {\"name\": \"min_length\", \"exampleValue\": \"6\"}]",
-            "description": "Search by sepal length",
-            "query": "SELECT * FROM iris WHERE sepal_length>={max_length} and sepal_length<={min_length}  ",
-            "queryStringTest": "?max_length=5&min_length=6",
-            "status": "DEV"
-        }
-    ]
-    
-    '''
-    endpointsDefinition = []
-    #print("endpoints: ", endpoints)
-    for endpoint in endpoints:
-        endpointDict = {}
-        endpointDict["path"] = endpoint["endpoint"]
-        query = endpoint["queryStringTest"]
-        # Remove first ? from query string
-        endpointDict["query"] = endpoint["queryStringTest"][1:]
-        response = {}
-        res = getAndRunEndpoint(endpoint["endpoint"], query, None) 
-        #urlTest = "http://localhost:8000/api/" + endpoint["endpoint"]  + endpoint["queryStringTest"]
-        #print("urlTest: ", urlTest)
-        #response = requests.get(urlTest)
-        print("response: ", res)
-
-        endpointDict["response"] = res.to_dict(orient="records")
-        endpointsDefinition.append(endpointDict)
-        
 
+    definition = openApiDefinition
+    if (definition is not None):
+        return definition
 
+    registry = endpointRegistry
+    if (registry is None):
+        registry = reloadEndpointRegistry()
 
     openapi_dict = {
         "openapi": "3.0.0",
         "info": {
-            "title": "Mi API",
+            "title": "Datalake Studio API",
             "version": "1.0.0"
         },
+        "servers": [{"url": "/api"}],
         "paths": {}
     }
 
-    for endpoint in endpointsDefinition:
-        path = endpoint["path"]
-        query_params = endpoint["query"].split('&')
-        response = endpoint["response"]
+    for name in sorted(registry.keys()):
+        registeredEndpoint = registry[name]
+        endpoint = registeredEndpoint.endpoint
+        sample = getEndpointSample(registeredEndpoint)
 
         parameters = []
-        for param in query_params:
-            name, _ = param.split('=')
+        for param in registeredEndpoint.placeholders:
+            type = registeredEndpoint.parameterTypes.get(param, "string")
             parameters.append({
-                "name": name,
+                "name": param,
                 "in": "query",
                 "required": True,
-                "schema": {"type": "string"}
+                "schema": {"type": "string" if type == "identifier" else type}
             })
+        parameters.append({"name": "format", "in": "query", "required": False, "schema": {"type": "string", "enum": ["JSON", "CSV", "NDJSON", "ARROW"]}})
+        parameters.append({"name": "limit", "in": "query", "required": False, "schema": {"type": "integer"}, "description": "Page size. Streamed formats always return X-Next-Cursor, the page after the last one is empty"})
+        parameters.append({"name": "cursor", "in": "query", "required": False, "schema": {"type": "string"}, "description": "X-Next-Cursor header of the previous page"})
 
-        openapi_dict["paths"][path] = {
+        content = {"schema": {"type": "array", "items": sample["schema"]}}
+        if (sample["example"] is not None):
+            content["example"] = sample["example"]
+
+        openapi_dict["paths"]["/" + name] = {
             "get": {
+                "summary": endpoint.description,
                 "parameters": parameters,
                 "responses": {
                     "200": {
                         "description": "Éxito",
                         "content": {
-                            "application/json": {
-                                "example": response
-                            }
+                            "application/json": content
                         }
+                    },
+                    "400": {
+                        "description": "Missing or invalid parameters"
                     }
                 }
             }
         }
 
+    openApiDefinition = openapi_dict
     return openapi_dict
+
+####################################################
+def toOpenApiType(duckdbType):
+    duckdbType = duckdbType.upper()
+    if (duckdbType in ["TINYINT", "SMALLINT", "INTEGER", "UTINYINT", "USMALLINT"]):
+        return {"type": "integer", "format": "int32"}
+    if (duckdbType in ["BIGINT", "HUGEINT", "UINTEGER", "UBIGINT", "UHUGEINT"]):
+        return {"type": "integer", "format": "int64"}
+    if (duckdbType in ["FLOAT", "REAL"]):
+        return {"type": "number", "format": "float"}
+    if (duckdbType == "DOUBLE" or duckdbType.startswith("DECIMAL")):
+        return {"type": "number", "format": "double"}
+    if (duckdbType == "BOOLEAN"):
+        return {"type": "boolean"}
+    if (duckdbType == "DATE"):
+        return {"type": "string", "format": "date"}
+    if (duckdbType.startswith("TIMESTAMP")):
+        return {"type": "string", "format": "date-time"}
+    if (duckdbType.endswith("[]")):
+        return {"type": "array", "items": toOpenApiType(duckdbType[:-2])}
+    return {"type": "string"}
+
+####################################################
+# Parameter values used to document the endpoint: example values, completed with queryStringTest
+def getExampleParameters(endpoint: PublishEndpointRequestDTO):
+    example = {}
+    if (endpoint.queryStringTest is not None):
+        example.update(dict(urllib.parse.parse_qsl(endpoint.queryStringTest.lstrip("?"))))
+    for param in (endpoint.parameters or []):
+        if (param.exampleValue is not None and param.exampleValue != ""):
+            example[param.name] = param.exampleValue
+    return example
+
+####################################################
+# Result schema (DESCRIBE of the query) and a few example rows, persisted in __endpoint_samples and
+# recomputed only when the endpoint query changes
+def getEndpointSample(registeredEndpoint: RegisteredEndpoint):
+    endpoint = registeredEndpoint.endpoint
+    try:
+        createSamplesTable()
+        df = databaseService.runQuery("SELECT * FROM __endpoint_samples WHERE id_endpoint = " + str(int(endpoint.id_endpoint)), False)
+        if (len(df) > 0 and df["query"].iloc[0] == endpoint.query):
+            return {"schema": json.loads(df["response_schema"].iloc[0]), "example": json.loads(df["sample"].iloc[0])}
+    except Exception as e:
+        print("Error reading endpoint sample: " + str(e))
+
+    return refreshEndpointSample(registeredEndpoint)
+
+def refreshEndpointSample(registeredEndpoint: RegisteredEndpoint):
+    endpoint = registeredEndpoint.endpoint
+    print("Refreshing sample of endpoint " + endpoint.endpoint)
+    schema = {"type": "object"}
+    example = None
+    try:
+        _, query, values = bindEndpoint(endpoint.endpoint, getExampleParameters(endpoint))
+        columns = databaseService.describeQuery(query, values)
+        schema = {"type": "object", "properties": {column: toOpenApiType(type) for column, type in columns}}
+
+        df = getAndRunEndpoint(endpoint.endpoint, getExampleParameters(endpoint), None, SAMPLE_ROWS)
+        if (df is not None):
+            example = json.loads(df.to_json(orient="records", date_format="iso"))
+    except Exception as e:
+        print("Error getting sample of endpoint " + endpoint.endpoint + ": " + str(e))
+        return {"schema": schema, "example": example}
+
+    try:
+        createSamplesTable()
+        databaseService.runQuery("DELETE FROM __endpoint_samples WHERE id_endpoint = " + str(int(endpoint.id_endpoint)), False)
+        databaseService.runQuery("INSERT INTO __endpoint_samples VALUES (" + str(int(endpoint.id_endpoint)) + ", " + databaseService.toSqlLiteral(endpoint.query) + ", " +
+                                 databaseService.toSqlLiteral(json.dumps(schema)) + ", " + databaseService.toSqlLiteral(json.dumps(example)) + ")", False)
+    except Exception as e:
+        print("Error saving endpoint sample: " + str(e))
+    return {"schema": schema, "example": example}
+
+####################################################
+def createSamplesTable():
+    if "__endpoint_samples" not in databaseService.getTableList(False):
+        print("Creating table __endpoint_samples")
+        databaseService.runQuery("CREATE TABLE __endpoint_samples (id_endpoint INTEGER PRIMARY KEY, query VARCHAR, response_schema VARCHAR, sample VARCHAR)")
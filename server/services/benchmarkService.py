@@ -0,0 +1,248 @@
+import asyncio
+import json
+import time
+import threading
+import subprocess
+import urllib.parse
+from collections import OrderedDict
+
+from services import databaseService
+from services import apiServerService
+
+# Load test of published endpoints and Mosaic dashboards. Requests are sent to the FastAPI app in process
+# (through ASGI, no network), so they go through routing, admission control and the response cache like
+# real calls. Targets:
+#   endpoints: every published endpoint with a queryStringTest
+#   restConnector: the queries recorded from /database/restConnector
+#   <endpoint>: a single published endpoint
+# Results are stored in __benchmark_results to compare runs between versions.
+
+TARGETS = ["all", "endpoints", "restConnector"]
+
+# Distinct restConnector queries seen, saved to __benchmark_queries so the CLI can replay them. Off by default,
+# dashboard SQL is only persisted when recording is enabled
+recordQueries = False
+maxRecordedQueries = 500
+recordedQueries = OrderedDict()
+unsavedQueries = []
+recordLock = threading.Lock()
+SAVE_EVERY = 20
+
+####################################################
+def init(config):
+    global recordQueries
+    global maxRecordedQueries
+    recordQueries = config.get("benchmarkRecordQueries", recordQueries)
+    maxRecordedQueries = config.get("benchmarkMaxRecordedQueries", maxRecordedQueries)
+
+####################################################
+def createTables():
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __benchmark_queries (type VARCHAR, sql VARCHAR, recorded_at TIMESTAMP DEFAULT current_timestamp)", False)
+    databaseService.runQuery("CREATE SEQUENCE IF NOT EXISTS seq_id_benchmark START 1", False)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __benchmark_results (id_benchmark INTEGER, label VARCHAR, revision VARCHAR, started_at TIMESTAMP, target VARCHAR, concurrency INTEGER, requests INTEGER, errors INTEGER, error_rate DOUBLE, duration_s DOUBLE, throughput DOUBLE, p50_ms DOUBLE, p95_ms DOUBLE, p99_ms DOUBLE, max_ms DOUBLE)", False)
+
+####################################################
+# Called for every restConnector query. Only reads are replayed, exec commands create cube tables
+def recordRestConnectorQuery(query):
+    if (not recordQueries):
+        return
+    if (query.get("type") not in ["arrow", "json"] or query.get("sql") is None):
+        return
+    key = (query.get("type"), query.get("sql"))
+    with recordLock:
+        if (key in recordedQueries):
+            recordedQueries.move_to_end(key)
+            return
+        recordedQueries[key] = True
+        if (len(recordedQueries) > maxRecordedQueries):
+            recordedQueries.popitem(last=False)
+        unsavedQueries.append(key)
+        if (len(unsavedQueries) < SAVE_EVERY):
+            return
+        toSave = list(unsavedQueries)
+        unsavedQueries.clear()
+    saveRecordedQueries(toSave)
+
+####################################################
+def saveRecordedQueries(queries):
+    try:
+        createTables()
+        values = ", ".join(["(" + databaseService.toSqlLiteral(type) + ", " + databaseService.toSqlLiteral(sql) + ")" for type, sql in queries])
+        databaseService.runQuery("INSERT INTO __benchmark_queries (type, sql) " +
+                                 "SELECT v.type, v.sql FROM (VALUES " + values + ") v(type, sql) " +
+                                 "WHERE NOT EXISTS (SELECT 1 FROM __benchmark_queries q WHERE q.type = v.type AND q.sql = v.sql)", False)
+    except Exception as e:
+        print("Error saving recorded restConnector queries: " + str(e))
+
+####################################################
+def flushRecordedQueries():
+    with recordLock:
+        toSave = list(unsavedQueries)
+        unsavedQueries.clear()
+    if (len(toSave) > 0):
+        saveRecordedQueries(toSave)
+
+####################################################
+def getRecordedQueries():
+    flushRecordedQueries()
+    try:
+        createTables()
+        df = databaseService.runQuery("SELECT type, sql FROM __benchmark_queries ORDER BY recorded_at DESC LIMIT " + str(int(maxRecordedQueries)), False)
+        return [(row["type"], row["sql"]) for row in df.to_dict(orient="records")]
+    except Exception as e:
+        print("Error reading recorded restConnector queries: " + str(e))
+        return []
+
+####################################################
+# Requests to replay as (target, method, path, queryString, body)
+def getRequests(target):
+    requests = []
+    if (target in ["all", "endpoints"] or target not in TARGETS):
+        for registeredEndpoint in apiServerService.getRegisteredEndpoints():
+            endpoint = registeredEndpoint.endpoint
+            if (target not in TARGETS and endpoint.endpoint != target):
+                continue
+            queryString = urllib.parse.urlencode(apiServerService.getExampleParameters(endpoint))
+            if (target in TARGETS and (endpoint.queryStringTest is None or endpoint.queryStringTest == "")):
+                continue
+            requests.append((endpoint.endpoint, "GET", "/api/" + endpoint.endpoint, queryString, None))
+    if (target in ["all", "restConnector"]):
+        for type, sql in getRecordedQueries():
+            requests.append(("restConnector", "POST", "/database/restConnector", "", json.dumps({"type": type, "sql": sql}).encode("utf-8")))
+    return requests
+
+####################################################
+# Send one request to the ASGI app. Returns the status code and the size of the body
+async def callApp(app, method, path, queryString, body):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "query_string": queryString.encode("utf-8"),
+        "root_path": "",
+        "headers": [(b"host", b"benchmark"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    requestSent = False
+
+    async def receive():
+        nonlocal requestSent
+        if (not requestSent):
+            requestSent = True
+            return {"type": "http.request", "body": body or b"", "more_body": False}
+        # The client never disconnects, streamed responses are read to the end
+        await asyncio.Future()
+
+    response = {"status": 500, "bytes": 0}
+
+    async def send(message):
+        if (message["type"] == "http.response.start"):
+            response["status"] = message["status"]
+        elif (message["type"] == "http.response.body"):
+            response["bytes"] += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], response["bytes"]
+
+####################################################
+def percentile(values, p):
+    if (len(values) == 0):
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return round(values[index], 3)
+
+####################################################
+def summarize(target, timings, errors, duration, concurrency):
+    total = len(timings)
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "errorRate": round(errors / total, 4) if total > 0 else 0,
+        "durationSeconds": round(duration, 3),
+        "throughput": round(total / duration, 2) if duration > 0 else 0,
+        "p50Ms": percentile(timings, 50),
+        "p95Ms": percentile(timings, 95),
+        "p99Ms": percentile(timings, 99),
+        "maxMs": round(max(timings), 3) if total > 0 else None,
+    }
+
+####################################################
+# Replay the requests round robin with `concurrency` concurrent clients until `totalRequests` are sent
+async def run(app, target = "all", concurrency = 8, totalRequests = 200, label = None, save = True):
+    requests = getRequests(target)
+    if (len(requests) == 0):
+        raise Exception("Nothing to benchmark for target " + target + ": no published endpoints with queryStringTest or recorded restConnector queries")
+
+    print("Benchmark " + target + ": " + str(totalRequests) + " requests, " + str(concurrency) + " concurrent, " + str(len(requests)) + " distinct requests")
+    results = {}
+    nextRequest = iter(range(totalRequests))
+
+    async def client():
+        for i in nextRequest:
+            name, method, path, queryString, body = requests[i % len(requests)]
+            start = time.perf_counter()
+            try:
+                status, size = await callApp(app, method, path, queryString, body)
+                failed = status >= 400
+            except Exception as e:
+                print("Benchmark request failed: " + str(e))
+                failed = True
+            elapsed = (time.perf_counter() - start) * 1000
+            timings, errors = results.setdefault(name, ([], [0]))
+            timings.append(elapsed)
+            if (failed):
+                errors[0] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    duration = time.perf_counter() - start
+
+    summaries = [summarize(name, timings, errors[0], duration, concurrency) for name, (timings, errors) in results.items()]
+    allTimings = [t for timings, errors in results.values() for t in timings]
+    summaries.append(summarize("total", allTimings, sum([errors[0] for timings, errors in results.values()]), duration, concurrency))
+
+    result = {"target": target, "label": label, "revision": getRevision(), "results": summaries}
+    if (save):
+        result["id_benchmark"] = saveResults(result)
+    print("Benchmark finished: " + str(summaries[-1]))
+    return result
+
+####################################################
+# Current git commit, if the server runs from a repository
+def getRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+####################################################
+def saveResults(result):
+    createTables()
+    id_benchmark = int(databaseService.runQuery("SELECT nextval('seq_id_benchmark') id", False)["id"].values[0])
+    for r in result["results"]:
+        databaseService.runQuery("INSERT INTO __benchmark_results VALUES (" + ", ".join([
+            str(id_benchmark), databaseService.toSqlLiteral(result["label"]), databaseService.toSqlLiteral(result["revision"]), "current_timestamp",
+            databaseService.toSqlLiteral(r["target"]), str(r["concurrency"]), str(r["requests"]), str(r["errors"]), str(r["errorRate"]),
+            str(r["durationSeconds"]), str(r["throughput"]), databaseService.toSqlLiteral(r["p50Ms"]), databaseService.toSqlLiteral(r["p95Ms"]),
+            databaseService.toSqlLiteral(r["p99Ms"]), databaseService.toSqlLiteral(r["maxMs"])]) + ")", False)
+    return id_benchmark
+
+####################################################
+# Stored results, latest first, with the change against the previous run of the same target
+def listResults(target = None, limit = 50):
+    createTables()
+    where = "" if target is None else " WHERE target = " + databaseService.toSqlLiteral(target)
+    df = databaseService.runQuery("SELECT *, " +
+                                  "p95_ms - lag(p95_ms) OVER (PARTITION BY target, concurrency ORDER BY id_benchmark) p95_change_ms, " +
+                                  "throughput - lag(throughput) OVER (PARTITION BY target, concurrency ORDER BY id_benchmark) throughput_change " +
+                                  "FROM __benchmark_results" + where + " ORDER BY id_benchmark DESC, target LIMIT " + str(int(limit)), False)
+    df["started_at"] = df["started_at"].astype(str)
+    return json.loads(df.to_json(orient="records"))
@@ -1,5 +1,7 @@
 import duckdb
 import os
+import re
+import threading
 import logging as log
 from zipfile import ZipFile
 from pathlib import Path
@@ -12,6 +14,23 @@ import ujson
 configLoaded = False
 db = None
 
+threadCursors = threading.local()
+# Queries on the shared connection (db) fail intermittently when several threads run them at once, they
+# are serialized. Queries that must run in parallel use cursors (getCursor, getThreadCursor) instead
+dbLock = threading.RLock()
+
+# Prepared statements created on each connection: {(id(connection), name): sql}
+preparedStatements = {}
+
+# Write counters used to know if cached results are still valid: dataVersion changes on every write,
+# tableVersions on writes to a table and writeEpoch on writes whose target table can't be determined
+dataVersion = 0
+writeEpoch = 0
+tableVersions = {}
+versionLock = threading.Lock()
+WRITE_TARGET_PATTERN = re.compile(r'^\s*(?:CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP\s+|TEMPORARY\s+)?(?:TABLE|VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?|INSERT\s+(?:OR\s+\w+\s+)?INTO\s+|UPDATE\s+|DELETE\s+FROM\s+|DROP\s+(?:TABLE|VIEW)\s+(?:IF\s+EXISTS\s+)?|ALTER\s+TABLE\s+|COPY\s+(?=[\w."]+\s+FROM))([\w."]+)', re.IGNORECASE)
+READ_PATTERN = re.compile(r'^\s*(?:SELECT|WITH|FROM|VALUES|DESCRIBE|SHOW|SUMMARIZE|EXPLAIN|PRAGMA|SET|RESET|INSTALL|LOAD|CALL|EXECUTE|PREPARE|DEALLOCATE|CHECKPOINT|COPY\s*\(|\(|$)', re.IGNORECASE)
+
 BUNDLE_DIR = Path(".mosaic/bundle")
 
 
@@ -77,6 +96,7 @@ def loadTable(config, tableName, fileName):
     data_dir = config["downloadFolder"]
     print("Loading table " + tableName + " from " + fileName)
     db.query("DROP TABLE IF EXISTS "+ tableName )
+    registerWrite(tableName=tableName)
 
     extracted_files = []
     if fileName.endswith('.zip'):
@@ -124,7 +144,7 @@ def loadTable(config, tableName, fileName):
         return False
 
 ####################################################
-def runQuery(query, logQuery=True, format = "df"):
+def runQuery(query, logQuery=True, format = "df", connection = None):
     try:
         if (logQuery):
             print("Executing query: " + str(query))
@@ -132,12 +152,11 @@ def runQuery(query, logQuery=True, format = "df"):
         #    print("Executing query XXXXXXX")
 
 
-        r = db.query(query)
-        if (r is not None):
-            if (format == "arrow"):
-                return r.arrow()
-            else:
-                return r.df()
+        if (connection is None):
+            # The shared connection can't run queries from several threads at once, cursors can
+            with dbLock:
+                return fetchResult(db.query(query), query, format)
+        return fetchResult(connection.query(query), query, format)
     except Exception as e:
         if (logQuery):
             print("Error running query: " + str(e))
@@ -146,6 +165,128 @@ def runQuery(query, logQuery=True, format = "df"):
         # Raise exception to be handled by caller
         raise e
 ####################################################
+def fetchResult(r, query, format):
+    registerWrite(query)
+    if (r is not None):
+        if (format == "arrow"):
+            return r.arrow()
+        else:
+            return r.df()
+
+####################################################
+def normalizeTableName(tableName):
+    return tableName.replace('"', '').split(".")[-1].lower()
+
+####################################################
+# Bump the versions of the tables written by the statements in query. tableName can be given for writes
+# done without SQL text (e.g. loading files)
+def registerWrite(query = None, tableName = None):
+    global dataVersion
+    global writeEpoch
+
+    if (tableName is not None):
+        targets = [normalizeTableName(tableName)]
+    else:
+        targets = []
+        for statement in query.split(";"):
+            if (READ_PATTERN.match(statement)):
+                continue
+            m = WRITE_TARGET_PATTERN.match(statement)
+            if (m is not None):
+                targets.append(normalizeTableName(m.group(1)))
+            else:
+                targets.append(None)
+        if (len(targets) == 0):
+            return
+
+    with versionLock:
+        dataVersion += 1
+        for target in targets:
+            if (target is None):
+                writeEpoch += 1
+            else:
+                tableVersions[target] = tableVersions.get(target, 0) + 1
+
+####################################################
+# Values are rendered as typed SQL literals, strings with quotes escaped, so they can't inject SQL
+def toSqlLiteral(value):
+    if (value is None):
+        return "NULL"
+    if (isinstance(value, bool)):
+        return "TRUE" if value else "FALSE"
+    if (isinstance(value, int)):
+        return str(int(value))
+    if (isinstance(value, float)):
+        return repr(float(value))
+    return "'" + str(value).replace("'", "''") + "'"
+
+####################################################
+# Run a query with named parameters ($name) through a prepared statement. The statement is
+# prepared once per connection and reused while its SQL doesn't change
+def runPrepared(name, query, parameters, connection = None, format = "df"):
+    if (connection is None):
+        connection = getThreadCursor()
+
+    r = connection.query(prepareStatement(name, query, parameters, connection))
+    if (r is not None):
+        if (format == "arrow"):
+            return r.arrow()
+        else:
+            return r.df()
+
+####################################################
+# Prepare the statement if needed and return the EXECUTE statement binding the parameters
+def prepareStatement(name, query, parameters, connection):
+    key = (id(connection), name)
+    if (preparedStatements.get(key) != query):
+        print("Preparing statement " + name + ": " + query)
+        connection.execute("PREPARE " + name + " AS " + query)
+        preparedStatements[key] = query
+
+    execute = "EXECUTE " + name
+    if (parameters is not None and len(parameters) > 0):
+        execute += "(" + ", ".join([param + " := " + toSqlLiteral(value) for param, value in parameters.items()]) + ")"
+    return execute
+
+####################################################
+# Yield the result of a prepared statement as Arrow record batches as DuckDB produces them. Runs on its
+# own cursor so the shared connection is not blocked while the client reads
+def streamPrepared(name, query, parameters, batchSize = 10000):
+    connection = getCursor()
+    try:
+        reader = connection.execute(prepareStatement(name, query, parameters, connection)).fetch_record_batch(batchSize)
+        for batch in reader:
+            yield batch
+    finally:
+        closeCursor(connection)
+
+####################################################
+# Column names and types of the result of a query, without running it
+def describeQuery(query, parameters = None):
+    r = getThreadCursor().execute("DESCRIBE " + query, parameters or {}).fetchall()
+    return [(column[0], column[1]) for column in r]
+
+####################################################
+# Background workers must not share the main connection, each thread gets its own cursor
+def getCursor():
+    return db.cursor()
+
+# Cursor owned by the calling thread, so queries from different threads (e.g. published endpoints)
+# run in parallel. Reused by the thread, with its prepared statements, until the database changes
+def getThreadCursor():
+    cursor = getattr(threadCursors, "cursor", None)
+    if (cursor is None or threadCursors.db is not db):
+        cursor = db.cursor()
+        threadCursors.cursor = cursor
+        threadCursors.db = db
+    return cursor
+
+def closeCursor(connection):
+    # Forget statements prepared on it, the id of the connection can be reused
+    for key in [key for key in list(preparedStatements) if key[0] == id(connection)]:
+        preparedStatements.pop(key, None)
+    connection.close()
+####################################################
 def getTableList(hideMeta: bool = True):
     tableList = runQuery("SHOW TABLES")
     tableListArray = None
@@ -165,10 +306,26 @@ def getTableDescriptionForChatGpt(tableName):
     tableDescriptionForGPT = "One of the tables is called '"+ tableName +"' and has following fields:" + tableDescription[1:]
     return tableDescriptionForGPT
 ####################################################
+# df is a DataFrame (or Arrow table). Registered by name because DuckDB only finds variables of the calling function
 def createTableFromDataFrame(df, tableName):
     print("Creating table " + tableName)
-    db.query("DROP TABLE IF EXISTS "+ tableName )
-    db.query("CREATE TABLE "+ tableName +" AS (SELECT * FROM "+ df +")")
+    with dbLock:
+        db.register("__dataframe", df)
+        try:
+            db.query("DROP TABLE IF EXISTS "+ tableName )
+            db.query("CREATE TABLE "+ tableName +" AS (SELECT * FROM __dataframe)")
+        finally:
+            db.unregister("__dataframe")
+    registerWrite(tableName=tableName)
+####################################################
+# Run a query reading the DataFrame df as the table `name`
+def queryDataFrame(df, name, query):
+    with dbLock:
+        db.register(name, df)
+        try:
+            return fetchResult(db.query(query), query, "df")
+        finally:
+            db.unregister(name)
 ####################################################
 
 def exportData(tableName, format, fileName):
@@ -252,6 +409,8 @@ def changeDatabase(config, databaseName):
     global db
     log.info("Changing database to " + databaseName)
     db.close()
+    preparedStatements.clear()
+    registerWrite("CHANGE DATABASE")
     db = duckdb.connect(config["databasesFolder"] + "/" + databaseName + ".db")
     # Load extensions
     loadExtensions(secretsLoaded)
@@ -269,6 +428,14 @@ def retrieve_arrow_bytes(query):
     result = get_arrow_bytes(sql)
     return result
 
+# Rows as a list of records for the "json" command of the restConnector
+def retrieve_json(query):
+    sql = query.get("sql")
+    df = runQuery(sql, True)
+    if (df is None):
+        return []
+    return ujson.loads(df.to_json(orient="records", date_format="iso"))
+
 def get_arrow(sql):
     result = runQuery(sql, True, "arrow")
     return result
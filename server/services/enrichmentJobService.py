@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from services import databaseService
+from services import apiRetrieverService
+from model.apiEnrichmentRequestDTO import ApiEnrichmentRequestDTO
+
+# API enrichments run as background jobs (__enrichment_jobs). Responses are checkpointed after every batch
+# in a staging table (__enrichment_staging_<id_job>), so a paused, failed or interrupted job resumes
+# with the requests not answered yet. The new table is built from the staging table when all are done.
+#   QUEUED -> RUNNING -> DONE
+#                     -> PAUSED (pauseJob, server restart) -> resumeJob -> QUEUED
+#                     -> FAILED -> resumeJob -> QUEUED
+#                     -> CANCELLED (cancelJob, staging table dropped)
+
+executor = None
+# Requested actions for running jobs: {id_job: "PAUSE" | "CANCEL"}
+controls = {}
+# Live progress of running jobs: {id_job: {"done", "total", "startedAt", "doneAtStart"}}
+progress = {}
+jobsLock = threading.Lock()
+
+####################################################
+def init(config):
+    global executor
+
+    workers = config.get("apiEnrichmentJobWorkers", 1)
+    print("Starting API enrichment job executor with " + str(workers) + " workers")
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrichmentJob")
+
+    # Jobs running when the server stopped can be resumed
+    try:
+        createTable()
+        databaseService.runQuery("UPDATE __enrichment_jobs SET status = 'PAUSED', message = 'Interrupted by server restart' WHERE status IN ('QUEUED', 'RUNNING')", False)
+    except Exception as e:
+        print("Error checking interrupted enrichment jobs: " + str(e))
+
+####################################################
+def createTable():
+    databaseService.runQuery("CREATE SEQUENCE IF NOT EXISTS seq_id_enrichment_job START 1", False)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __enrichment_jobs (id_job INTEGER PRIMARY KEY, request VARCHAR, new_table_name VARCHAR, status VARCHAR, " +
+                             "total INTEGER, done INTEGER, failed INTEGER, cached INTEGER, created_at TIMESTAMP, updated_at TIMESTAMP, finished_at TIMESTAMP, message VARCHAR)", False)
+
+def getStagingTable(id_job):
+    return "__enrichment_staging_" + str(int(id_job))
+
+####################################################
+def startJob(apiEnrichmentRequestDTO: ApiEnrichmentRequestDTO):
+    createTable()
+    id_job = int(databaseService.runQuery("SELECT nextval('seq_id_enrichment_job') id", False)["id"].values[0])
+    databaseService.runQuery("INSERT INTO __enrichment_jobs (id_job, request, new_table_name, status, done, failed, cached, created_at, updated_at) VALUES (" +
+                             str(id_job) + ", " + databaseService.toSqlLiteral(apiEnrichmentRequestDTO.model_dump_json()) + ", " +
+                             databaseService.toSqlLiteral(apiEnrichmentRequestDTO.newTableName) + ", 'QUEUED', 0, 0, 0, now()::TIMESTAMP, now()::TIMESTAMP)", False)
+    print("API enrichment job " + str(id_job) + " created")
+    executor.submit(runJob, id_job)
+    return id_job
+
+####################################################
+def updateJob(id_job, **values):
+    assignments = ", ".join([name + " = " + databaseService.toSqlLiteral(value) for name, value in values.items()])
+    databaseService.runQuery("UPDATE __enrichment_jobs SET " + assignments + ", updated_at = now()::TIMESTAMP WHERE id_job = " + str(int(id_job)), False)
+
+def getJobRow(id_job):
+    createTable()
+    df = databaseService.runQuery("SELECT * FROM __enrichment_jobs WHERE id_job = " + str(int(id_job)), False)
+    if (len(df) == 0):
+        return None
+    return json.loads(df.to_json(orient="records", date_format="iso"))[0]
+
+####################################################
+# Job with throughput (requests/s) and ETA (seconds) while it runs
+def getJob(id_job):
+    job = getJobRow(id_job)
+    if (job is None):
+        return None
+    job.pop("request", None)
+    with jobsLock:
+        live = progress.get(id_job)
+        if (live is not None):
+            elapsed = time.time() - live["startedAt"]
+            sent = live["done"] - live["doneAtStart"]
+            job["done"] = live["done"]
+            job["throughput"] = round(sent / elapsed, 2) if elapsed > 0 else None
+            job["etaSeconds"] = round((live["total"] - live["done"]) / job["throughput"]) if job["throughput"] else None
+    job["percent"] = round(job["done"] * 100 / job["total"], 1) if job.get("total") else 0
+    return job
+
+def listJobs():
+    createTable()
+    df = databaseService.runQuery("SELECT id_job FROM __enrichment_jobs ORDER BY id_job DESC", False)
+    return [getJob(id_job) for id_job in df["id_job"].to_list()]
+
+####################################################
+def pauseJob(id_job):
+    return requestControl(id_job, "PAUSE", ["QUEUED", "RUNNING"])
+
+def cancelJob(id_job):
+    job = getJobRow(id_job)
+    if (job is None or job["status"] in ["DONE", "CANCELLED"]):
+        return False
+    if (job["status"] in ["QUEUED", "RUNNING"]):
+        return requestControl(id_job, "CANCEL", ["QUEUED", "RUNNING"])
+    # Not running, cancel now
+    databaseService.runQuery("DROP TABLE IF EXISTS " + getStagingTable(id_job), False)
+    updateJob(id_job, status="CANCELLED", message=None)
+    return True
+
+# The job checks the control between batches
+def requestControl(id_job, action, statuses):
+    job = getJobRow(id_job)
+    if (job is None or job["status"] not in statuses):
+        return False
+    with jobsLock:
+        controls[id_job] = action
+    return True
+
+def resumeJob(id_job):
+    job = getJobRow(id_job)
+    if (job is None or job["status"] not in ["PAUSED", "FAILED"]):
+        return False
+    with jobsLock:
+        controls.pop(id_job, None)
+    updateJob(id_job, status="QUEUED", message=None)
+    executor.submit(runJob, id_job)
+    return True
+
+def takeControl(id_job):
+    with jobsLock:
+        return controls.pop(id_job, None)
+
+####################################################
+def runJob(id_job):
+    try:
+        runJobBatches(id_job)
+    except Exception as e:
+        print("Error running API enrichment job " + str(id_job) + ": " + str(e))
+        try:
+            updateJob(id_job, status="FAILED", message=str(e))
+        except Exception:
+            pass
+    finally:
+        with jobsLock:
+            progress.pop(id_job, None)
+
+####################################################
+def runJobBatches(id_job):
+    job = getJobRow(id_job)
+    if (job is None or job["status"] != "QUEUED"):
+        return
+    if (stopRequested(id_job)):
+        return
+    apiEnrichmentRequestDTO = ApiEnrichmentRequestDTO.model_validate_json(job["request"])
+    settings = apiRetrieverService.getEnrichmentSettings(apiEnrichmentRequestDTO)
+    updateJob(id_job, status="RUNNING", message=None)
+
+    plan = apiRetrieverService.planEnrichment(apiEnrichmentRequestDTO)
+    apiRequests = plan["requests"]
+    keys = list(set([r[0] for r in apiRequests]))
+
+    # Responses already checkpointed by a previous run, or cached by other enrichments
+    stagingTable = getStagingTable(id_job)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS " + stagingTable + " (key VARCHAR PRIMARY KEY, status INTEGER, response VARCHAR)", False)
+    staged = set(databaseService.runQuery("SELECT key FROM " + stagingTable, False)["key"].to_list())
+    cached = apiRetrieverService.getCachedResponses([key for key in keys if key not in staged], apiRetrieverService.getCacheTtl(apiEnrichmentRequestDTO))
+    checkpoint(stagingTable, [(key, response) for key, response in cached.items()])
+
+    pending = list({r[0]: r for r in apiRequests if r[0] not in staged and r[0] not in cached}.values())
+    done = len(keys) - len(pending)
+    updateJob(id_job, total=len(keys), done=done, cached=int(job["cached"] or 0) + len(cached), failed=0)
+    print("API enrichment job " + str(id_job) + ": " + str(len(keys)) + " distinct requests, " + str(len(pending)) + " pending")
+    with jobsLock:
+        progress[id_job] = {"done": done, "total": len(keys), "startedAt": time.time(), "doneAtStart": done}
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=settings["concurrency"], thread_name_prefix="apiEnrichment") as workers:
+        for batchStart in range(0, len(pending), settings["batchSize"]):
+            if (stopRequested(id_job)):
+                return
+            batch = pending[batchStart:batchStart + settings["batchSize"]]
+            responses = apiRetrieverService.callApis(batch, settings, workers)
+            # Failed requests are not checkpointed, resuming the job retries them
+            checkpoint(stagingTable, [(r[0], response) for r, response in zip(batch, responses) if response is not None])
+            failed += len([response for response in responses if response is None])
+            done += len(batch)
+            with jobsLock:
+                progress[id_job]["done"] = done
+            updateJob(id_job, done=done, failed=failed)
+
+    if (stopRequested(id_job)):
+        return
+
+    # Build the new table in one step from the checkpointed responses
+    df = databaseService.runQuery("SELECT key, status, response FROM " + stagingTable, False)
+    responses = {key: (status, response) for key, status, response in zip(df["key"], df["status"], df["response"])}
+    apiRetrieverService.assembleEnrichment(apiEnrichmentRequestDTO, plan, [responses.get(r[0]) for r in apiRequests])
+    databaseService.runQuery("DROP TABLE IF EXISTS " + stagingTable, False)
+    databaseService.runQuery("UPDATE __enrichment_jobs SET status = 'DONE', message = " + databaseService.toSqlLiteral(str(failed) + " requests failed" if failed > 0 else None) +
+                             ", finished_at = now()::TIMESTAMP, updated_at = now()::TIMESTAMP WHERE id_job = " + str(int(id_job)), False)
+    print("API enrichment job " + str(id_job) + " finished, table " + apiEnrichmentRequestDTO.newTableName + " created")
+
+####################################################
+def checkpoint(stagingTable, responses):
+    if (len(responses) == 0):
+        return
+    df = pd.DataFrame([{"key": key, "status": response[0], "response": response[1]} for key, response in responses])
+    databaseService.queryDataFrame(df, "__enrichment_checkpoint", "INSERT OR REPLACE INTO " + stagingTable + " SELECT key, status, response FROM __enrichment_checkpoint")
+
+####################################################
+# Pause or cancel the job if requested. Returns True if the job must stop
+def stopRequested(id_job):
+    action = takeControl(id_job)
+    if (action == "PAUSE"):
+        print("API enrichment job " + str(id_job) + " paused")
+        updateJob(id_job, status="PAUSED", message=None)
+        return True
+    if (action == "CANCEL"):
+        print("API enrichment job " + str(id_job) + " cancelled")
+        databaseService.runQuery("DROP TABLE IF EXISTS " + getStagingTable(id_job), False)
+        updateJob(id_job, status="CANCELLED", message=None)
+        return True
+    return False
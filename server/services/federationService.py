@@ -0,0 +1,228 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from services import databaseService
+from services import remoteDbService
+
+# Remote PostgreSQL databases attached to DuckDB (postgres extension, read only), to query their tables in place.
+# DuckDB pushes projections and filters down to PostgreSQL, so joins with local tables only transfer the
+# matching rows. Every remote table can be used from the local database:
+#   live: view over the remote table, every query reads PostgreSQL
+#   cache: local copy of the table, refreshed with refreshCache
+# Attached databases (__federated_databases) are attached again when the server starts and when the
+# database changes (changeDatabase), before other queries can read their live views. Unreachable databases
+# delay it CONNECT_TIMEOUT_SECONDS. Rows read from each remote table by runQuery are counted in transferStats.
+
+MODES = ["live", "cache"]
+CONNECT_TIMEOUT_SECONDS = 10
+pgpassFile = None
+attachLock = threading.Lock()
+# {remote table: {"queries", "rows"}}
+transferStats = {}
+statsLock = threading.Lock()
+
+####################################################
+def init(secrets, config):
+    global pgpassFile
+    pgpassFile = secrets.get("pgpass_file")
+    try:
+        ensureAttached()
+    except Exception as e:
+        print("Error attaching federated databases: " + str(e))
+
+####################################################
+def createTables():
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __federated_databases (alias VARCHAR PRIMARY KEY, target VARCHAR, attached_at TIMESTAMP)", False)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __federated_tables (local_name VARCHAR PRIMARY KEY, alias VARCHAR, schema_name VARCHAR, table_name VARCHAR, " +
+                             "mode VARCHAR, rows_cached BIGINT, updated_at TIMESTAMP)", False)
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# libpq connection string, values quoted
+def toConninfo(parameters):
+    return " ".join([name + "='" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'" for name, value in parameters.items()])
+
+####################################################
+def getAttachedAliases():
+    df = databaseService.runQuery("SELECT database_name FROM duckdb_databases()", False)
+    return set(df["database_name"].to_list())
+
+def attachDatabase(alias, target):
+    parameters = remoteDbService.getConnectionParameters(target, pgpassFile)
+    if (parameters is None):
+        raise Exception("Database " + target + " not found in pgpass file")
+    parameters = dict(parameters, connect_timeout=CONNECT_TIMEOUT_SECONDS)
+    databaseService.runQuery("INSTALL postgres;LOAD postgres", False)
+    # Not logged, the connection string has the password
+    databaseService.runQuery("ATTACH " + databaseService.toSqlLiteral(toConninfo(parameters)) + " AS " + quote(alias) + " (TYPE POSTGRES, READ_ONLY)", False)
+    try:
+        databaseService.runQuery("SET pg_experimental_filter_pushdown = true", False)
+    except Exception as e:
+        print("Filter pushdown not available in the postgres extension: " + str(e))
+    print("Attached remote database " + target + " as " + alias)
+
+# Attach the recorded databases not attached yet, e.g. after a restart or a change of database
+def ensureAttached():
+    createTables()
+    with attachLock:
+        attachedAliases = getAttachedAliases()
+        for row in databaseService.runQuery("SELECT alias, target FROM __federated_databases", False).to_dict(orient="records"):
+            if (row["alias"] not in attachedAliases):
+                try:
+                    attachDatabase(row["alias"], row["target"])
+                except Exception as e:
+                    print("Could not attach " + row["target"] + " as " + row["alias"] + ": " + str(e))
+
+####################################################
+# Attach the pgpass entry target ("host - port - db - user"). Returns its alias
+def attach(target, alias = None):
+    createTables()
+    with attachLock:
+        df = databaseService.runQuery("SELECT alias FROM __federated_databases WHERE target = " + databaseService.toSqlLiteral(target), False)
+        if (len(df) > 0):
+            alias = df["alias"].values[0]
+        else:
+            alias = alias or getNewAlias(target)
+        if (alias not in getAttachedAliases()):
+            attachDatabase(alias, target)
+        databaseService.runQuery("INSERT OR REPLACE INTO __federated_databases VALUES (" + databaseService.toSqlLiteral(alias) + ", " +
+                                 databaseService.toSqlLiteral(target) + ", now()::TIMESTAMP)", False)
+    return alias
+
+# pg_<db>, with a number if another database has the same name
+def getNewAlias(target):
+    host, port, db, user = target.split(" - ")
+    base = "pg_" + re.sub(r"\W+", "_", db).lower()
+    used = getAttachedAliases() | set(databaseService.runQuery("SELECT alias FROM __federated_databases", False)["alias"].to_list())
+    alias = base
+    suffix = 1
+    while (alias in used):
+        suffix += 1
+        alias = base + "_" + str(suffix)
+    return alias
+
+def detach(alias):
+    createTables()
+    with attachLock:
+        for localName in databaseService.runQuery("SELECT local_name FROM __federated_tables WHERE mode = 'live' AND alias = " + databaseService.toSqlLiteral(alias), False)["local_name"].to_list():
+            databaseService.runQuery("DROP VIEW IF EXISTS " + quote(localName), False)
+        databaseService.runQuery("DELETE FROM __federated_tables WHERE mode = 'live' AND alias = " + databaseService.toSqlLiteral(alias), False)
+        databaseService.runQuery("DELETE FROM __federated_databases WHERE alias = " + databaseService.toSqlLiteral(alias), False)
+        if (alias in getAttachedAliases()):
+            databaseService.runQuery("DETACH " + quote(alias), False)
+
+def listDatabases():
+    createTables()
+    attachedAliases = getAttachedAliases()
+    df = databaseService.runQuery("SELECT alias, target, attached_at::VARCHAR attached_at FROM __federated_databases ORDER BY alias", False)
+    return [dict(row, attached=row["alias"] in attachedAliases) for row in df.to_dict(orient="records")]
+
+def listRemoteTables(alias):
+    ensureAttached()
+    df = databaseService.runQuery("SELECT schema_name, table_name FROM duckdb_tables() WHERE database_name = " + databaseService.toSqlLiteral(alias) +
+                                  " UNION ALL SELECT schema_name, view_name FROM duckdb_views() WHERE NOT internal AND database_name = " + databaseService.toSqlLiteral(alias) +
+                                  " ORDER BY 1, 2", False)
+    return df.to_dict(orient="records")
+
+####################################################
+# Make the remote table available as localName, live (view) or cached (local table)
+def setTableMode(alias, schema, table, mode, localName = None):
+    if (mode not in MODES):
+        raise Exception("Unknown mode " + mode + ", it must be one of " + str(MODES))
+    ensureAttached()
+    createTables()
+    localName = localName or table
+    source = quote(alias) + "." + quote(schema) + "." + quote(table)
+
+    # A view can't replace a table and the other way round
+    existing = databaseService.runQuery("SELECT 'TABLE' AS type FROM duckdb_tables() WHERE database_name = current_database() AND schema_name = 'main' AND table_name = " + databaseService.toSqlLiteral(localName) +
+                                        " UNION ALL SELECT 'VIEW' FROM duckdb_views() WHERE database_name = current_database() AND schema_name = 'main' AND view_name = " + databaseService.toSqlLiteral(localName), False)
+    for existingType in existing["type"].to_list():
+        if ((existingType == "TABLE") != (mode == "cache")):
+            databaseService.runQuery("DROP " + existingType + " " + quote(localName))
+
+    rows = None
+    if (mode == "live"):
+        databaseService.runQuery("CREATE OR REPLACE VIEW " + quote(localName) + " AS SELECT * FROM " + source)
+    else:
+        rows = cacheTable(localName, source, alias + "." + schema + "." + table)
+    databaseService.registerWrite(tableName=localName)
+    databaseService.runQuery("INSERT OR REPLACE INTO __federated_tables VALUES (" + ", ".join([
+        databaseService.toSqlLiteral(localName), databaseService.toSqlLiteral(alias), databaseService.toSqlLiteral(schema), databaseService.toSqlLiteral(table),
+        databaseService.toSqlLiteral(mode), databaseService.toSqlLiteral(rows), "now()::TIMESTAMP"]) + ")", False)
+    return {"localName": localName, "mode": mode, "rowsCached": rows}
+
+def cacheTable(localName, source, remoteTable):
+    start = time.time()
+    databaseService.runQuery("CREATE OR REPLACE TABLE " + quote(localName) + " AS SELECT * FROM " + source)
+    rows = int(databaseService.runQuery("SELECT COUNT(*) total FROM " + quote(localName), False)["total"].values[0])
+    addTransfer(remoteTable, rows)
+    print("Cached " + remoteTable + " as " + localName + ": " + str(rows) + " rows in " + str(round(time.time() - start, 1)) + "s")
+    return rows
+
+def refreshCache(localName):
+    createTables()
+    df = databaseService.runQuery("SELECT * FROM __federated_tables WHERE mode = 'cache' AND local_name = " + databaseService.toSqlLiteral(localName), False)
+    if (len(df) == 0):
+        raise Exception("Table " + localName + " is not a cached remote table")
+    row = df.to_dict(orient="records")[0]
+    return setTableMode(row["alias"], row["schema_name"], row["table_name"], "cache", localName)
+
+def listTables():
+    createTables()
+    df = databaseService.runQuery("SELECT local_name, alias, schema_name, table_name, mode, rows_cached, updated_at::VARCHAR updated_at FROM __federated_tables ORDER BY local_name", False)
+    return json.loads(df.to_json(orient="records"))
+
+####################################################
+# Run a query that may read remote tables. The query is profiled to count the rows each remote scan
+# returned, i.e. the rows transferred from PostgreSQL after pushing down filters
+def runQuery(query):
+    ensureAttached()
+    cursor = databaseService.getCursor()
+    fd, profileFile = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        cursor.execute("SET enable_profiling = 'json'")
+        cursor.execute("SET profiling_output = " + databaseService.toSqlLiteral(profileFile))
+        start = time.time()
+        df = cursor.execute(query).df()
+        seconds = round(time.time() - start, 3)
+        # Writes on the cursor (e.g. CREATE TABLE AS from a live table) invalidate cached responses
+        databaseService.registerWrite(query)
+        cursor.execute("PRAGMA disable_profiling")
+        with open(profileFile) as f:
+            transfers = getTransfers(json.load(f))
+        for table, rows in transfers.items():
+            addTransfer(table, rows)
+        return df, {"seconds": seconds, "rows": len(df), "transfers": [{"table": table, "rows": rows} for table, rows in transfers.items()]}
+    finally:
+        cursor.close()
+        os.remove(profileFile)
+
+# Rows returned by the postgres scans of a query profile, by remote table
+def getTransfers(node, transfers = None):
+    if (transfers is None):
+        transfers = {}
+    extraInfo = node.get("extra_info") or {}
+    function = str(extraInfo.get("Function", ""))
+    if (function.upper().startswith("POSTGRES")):
+        table = str(extraInfo.get("Table", function))
+        transfers[table] = transfers.get(table, 0) + int(node.get("operator_cardinality") or 0)
+    for child in node.get("children", []):
+        getTransfers(child, transfers)
+    return transfers
+
+def addTransfer(table, rows):
+    with statsLock:
+        stats = transferStats.setdefault(table, {"queries": 0, "rows": 0})
+        stats["queries"] += 1
+        stats["rows"] += rows
+
+def getStats():
+    with statsLock:
+        return [{"table": table, **stats} for table, stats in transferStats.items()]
@@ -0,0 +1,203 @@
+import re
+import time
+import threading
+import statistics
+import duckdb
+
+from services import databaseService
+from services import admissionService
+
+# Looks for predicates on parameterized columns in published endpoint queries and speeds them up:
+#   equality (col = {p}, col IN ({p}))  -> ART index on the column, point lookups skip the scan
+#   range (col >= {p}, BETWEEN) and prefix (col LIKE '{p}%') -> table sorted by the column, so zonemaps skip row groups
+#   contains (col LIKE '%{p}%') and pattern (col LIKE {p}, the value is the pattern) can't be accelerated
+
+COLUMN = r'((?:"?[A-Za-z_]\w*"?\.)?"?[A-Za-z_]\w*"?)'
+COLUMN_FIRST_PATTERN = re.compile(COLUMN + r"\s*(=|==|>=|<=|>|<|\bI?LIKE\b|\bIN\b)\s*\(?\s*('?)(%?)\{(\w+)\}(%?)", re.IGNORECASE)
+PARAMETER_FIRST_PATTERN = re.compile(r"\{(\w+)\}'?\s*(=|==|>=|<=|>|<)\s*" + COLUMN, re.IGNORECASE)
+BETWEEN_PATTERN = re.compile(COLUMN + r"\s+BETWEEN\s+'?\{(\w+)\}'?\s+AND\s+'?\{(\w+)\}'?", re.IGNORECASE)
+SQL_KEYWORDS = ["AND", "OR", "NOT", "WHERE", "ON", "WHEN", "THEN", "ELSE", "CASE"]
+
+BENCHMARK_RUNS = 5
+# Apply the advice automatically when an endpoint is saved, and allow rewriting tables sorted
+autoApply = False
+autoCluster = False
+# Last advice applied to each endpoint, e.g. automatically after /apiserver/update
+lastResults = {}
+
+####################################################
+def init(config):
+    global autoApply
+    global autoCluster
+
+    autoApply = config.get("autoIndexPublishedEndpoints", autoApply)
+    autoCluster = config.get("autoClusterPublishedEndpoints", autoCluster)
+
+####################################################
+def getPredicates(query):
+    predicates = []
+    for m in COLUMN_FIRST_PATTERN.finditer(query):
+        column, operator, quote, leading, parameter, trailing = m.groups()
+        operator = operator.upper()
+        if (operator in ["=", "==", "IN"]):
+            kind = "equality"
+        elif (operator in ["LIKE", "ILIKE"]):
+            if (leading == "%"):
+                kind = "contains"
+            elif (trailing == "%" and operator == "LIKE"):
+                kind = "prefix"
+            elif (trailing == "%"):
+                kind = "contains"
+            else:
+                # DuckDB doesn't use ART indexes for LIKE, even without wildcards
+                kind = "pattern"
+        else:
+            kind = "range"
+        predicates.append({"column": column, "parameter": parameter, "predicate": kind})
+    for m in PARAMETER_FIRST_PATTERN.finditer(query):
+        parameter, operator, column = m.groups()
+        predicates.append({"column": column, "parameter": parameter, "predicate": "equality" if operator in ["=", "=="] else "range"})
+    for m in BETWEEN_PATTERN.finditer(query):
+        predicates.append({"column": m.group(1), "parameter": m.group(2) + "," + m.group(3), "predicate": "range"})
+    return [p for p in predicates if p["column"].replace('"', '').split(".")[-1].upper() not in SQL_KEYWORDS]
+
+####################################################
+# Base table owning the column among the tables read by the query
+def resolveTable(column, sourceTables, columnsByTable):
+    columnName = column.replace('"', '').split(".")[-1].lower()
+    owners = [table for table in sourceTables if columnName in columnsByTable.get(table, [])]
+    if (len(owners) == 1):
+        return owners[0], columnName
+    return None, columnName
+
+####################################################
+def analyze(endpointName):
+    from services import apiServerService
+
+    registeredEndpoint = apiServerService.getRegisteredEndpoint(endpointName)
+    if (registeredEndpoint is None):
+        raise Exception("Endpoint not found: " + endpointName)
+    query = registeredEndpoint.endpoint.query
+
+    try:
+        sourceTables = [databaseService.normalizeTableName(t) for t in duckdb.get_table_names(registeredEndpoint.getParsableQuery())]
+    except Exception as e:
+        print("Could not get tables of endpoint " + endpointName + ": " + str(e))
+        sourceTables = []
+
+    columns = databaseService.runQuery("SELECT lower(c.table_name) table_name, lower(c.column_name) column_name FROM duckdb_columns() c JOIN duckdb_tables() t ON c.table_oid = t.table_oid", False)
+    columnsByTable = columns.groupby("table_name")["column_name"].apply(list).to_dict()
+    indexes = databaseService.runQuery("SELECT lower(table_name) table_name, lower(expressions) expressions FROM duckdb_indexes()", False)
+    indexed = set([(row["table_name"], row["expressions"].strip("[]'\" ")) for row in indexes.to_dict(orient="records")])
+
+    recommendations = []
+    seen = set()
+    for predicate in getPredicates(query):
+        table, column = resolveTable(predicate["column"], sourceTables, columnsByTable)
+        if ((table, column, predicate["predicate"]) in seen):
+            continue
+        seen.add((table, column, predicate["predicate"]))
+
+        recommendation = dict(predicate, table=table, column=column)
+        if (table is None):
+            recommendation["action"] = "none"
+            recommendation["reason"] = "Column not found in a single table of the query"
+        elif (predicate["predicate"] == "equality"):
+            recommendation["action"] = "index"
+            recommendation["exists"] = (table, column) in indexed
+            recommendation["reason"] = "Point lookups use an ART index instead of scanning the table"
+        elif (predicate["predicate"] in ["range", "prefix"]):
+            recommendation["action"] = "cluster"
+            recommendation["reason"] = "Sorting the table by " + column + " lets DuckDB skip row groups using min/max statistics"
+        elif (predicate["predicate"] == "pattern"):
+            recommendation["action"] = "none"
+            recommendation["reason"] = "LIKE with the pattern as parameter can't use indexes, use = to match exact values"
+        else:
+            recommendation["action"] = "none"
+            recommendation["reason"] = "LIKE '%...%' can't use indexes or sorting"
+        recommendations.append(recommendation)
+
+    return recommendations
+
+####################################################
+# Median latency running the endpoint with its example parameters
+def measure(endpointName):
+    from services import apiServerService
+
+    registeredEndpoint = apiServerService.getRegisteredEndpoint(endpointName)
+    parameters = apiServerService.getExampleParameters(registeredEndpoint.endpoint)
+    timings = []
+    for i in range(BENCHMARK_RUNS):
+        start = time.time()
+        apiServerService.getAndRunEndpoint(endpointName, parameters, None)
+        timings.append((time.time() - start) * 1000)
+    return round(statistics.median(timings), 3)
+
+####################################################
+# CREATE TABLE AS SELECT keeps only column names and types: constraints (NOT NULL, CHECK, keys), defaults and
+# comments would be lost
+def hasConstraints(table):
+    literal = databaseService.toSqlLiteral(table)
+    df = databaseService.runQuery("SELECT (SELECT COUNT(*) FROM duckdb_constraints() WHERE lower(table_name) = " + literal + ") + " +
+                                  "(SELECT COUNT(*) FROM duckdb_columns() WHERE lower(table_name) = " + literal + " AND (column_default IS NOT NULL OR comment IS NOT NULL)) + " +
+                                  "(SELECT COUNT(*) FROM duckdb_tables() WHERE lower(table_name) = " + literal + " AND comment IS NOT NULL) total", False)
+    return int(df["total"].values[0]) > 0
+
+####################################################
+# Create the recommended indexes and, if clustered, rewrite range/prefix filtered tables sorted by those columns
+def apply(endpointName, clustered = False):
+    print("Applying index advice to endpoint " + endpointName)
+    recommendations = analyze(endpointName)
+    result = {"endpoint": endpointName, "recommendations": recommendations, "applied": []}
+
+    try:
+        result["beforeMs"] = measure(endpointName)
+    except Exception as e:
+        print("Could not measure endpoint " + endpointName + ": " + str(e))
+        result["beforeMs"] = None
+
+    if (clustered):
+        sortColumns = {}
+        for r in recommendations:
+            if (r["action"] == "cluster"):
+                sortColumns.setdefault(r["table"], []).append(r["column"])
+        for table, columns in sortColumns.items():
+            if (hasConstraints(table)):
+                print("Table " + table + " has constraints, defaults or comments, not sorting it")
+                continue
+            # Rewriting the table drops its indexes, they are recreated below if recommended
+            databaseService.runQuery("CREATE OR REPLACE TABLE " + table + " AS SELECT * FROM " + table + " ORDER BY " + ", ".join(['"' + c + '"' for c in columns]))
+            result["applied"].append("Sorted " + table + " by " + ", ".join(columns))
+        if (len(sortColumns) > 0):
+            recommendations = analyze(endpointName)
+
+    for r in recommendations:
+        if (r["action"] == "index" and not r.get("exists")):
+            indexName = "__idx_" + r["table"] + "_" + r["column"]
+            databaseService.runQuery("CREATE INDEX IF NOT EXISTS " + indexName + " ON " + r["table"] + ' ("' + r["column"] + '")')
+            result["applied"].append("Created index " + indexName)
+
+    if (len(result["applied"]) > 0):
+        # Plans prepared before the changes are discarded
+        databaseService.preparedStatements.clear()
+
+    try:
+        result["afterMs"] = measure(endpointName)
+    except Exception as e:
+        print("Could not measure endpoint " + endpointName + ": " + str(e))
+        result["afterMs"] = None
+
+    print("Index advice for " + endpointName + ": " + str(result))
+    lastResults[endpointName] = result
+    return result
+
+####################################################
+# Run in background when an endpoint is published, so /apiserver/update doesn't wait for the benchmark
+def applyInBackground(endpointName, clustered = False):
+    def run():
+        try:
+            with admissionService.admit("BACKGROUND"):
+                apply(endpointName, clustered)
+        except Exception as e:
+            print("Error applying index advice to " + endpointName + ": " + str(e))
+    threading.Thread(target=run, name="indexAdvisor", daemon=True).start()
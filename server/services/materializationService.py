@@ -0,0 +1,274 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from services import databaseService
+from services import admissionService
+from services import apiCacheService
+from model.MaterializeQueryRequestDTO import MaterializeQueryRequestDTO
+
+# Saved queries (__queries) can be materialized into a table that is refreshed:
+#   MANUAL: only when /queries/refreshMaterialization is called
+#   INTERVAL: every intervalSeconds
+#   ON_CHANGE: when the source tables are written
+# Incremental refreshes (watermarkColumn) are append-only: rows newer than the max watermark already materialized
+# are appended. If the rows already materialized changed in the source (updated, deleted or inserted late) a full
+# refresh is done instead
+REFRESH_POLICIES = ["MANUAL", "INTERVAL", "ON_CHANGE"]
+
+# Write versions only live in memory, signatures of a previous run never match so sources are refreshed once after a restart
+signatureSession = uuid.uuid4().hex
+
+# id_query -> table_name of the refreshed materializations, loaded from __materializations on first use
+materializedTables = None
+materializedTablesLock = threading.Lock()
+
+executor = None
+schedulerStop = threading.Event()
+tickSeconds = 30
+
+# id_query of refreshes queued or running, so the same query is never refreshed twice at once
+pendingRefreshes = set()
+pendingLock = threading.Lock()
+
+####################################################
+def init(config):
+    global executor
+    global tickSeconds
+
+    workers = config.get("materializationWorkers", 2)
+    tickSeconds = config.get("materializationTickSeconds", 30)
+    print("Starting materialization scheduler with " + str(workers) + " workers")
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="materialization")
+
+    schedulerThread = threading.Thread(target=schedulerLoop, name="materializationScheduler", daemon=True)
+    schedulerThread.start()
+
+####################################################
+def createTable(connection=None):
+    tableList = databaseService.runQuery("SELECT table_name FROM duckdb_tables() WHERE table_name = '__materializations'", False, connection=connection)
+    if (len(tableList) == 0):
+        print("Creating table __materializations")
+        databaseService.runQuery("CREATE TABLE __materializations (id_query INTEGER PRIMARY KEY, table_name VARCHAR, refresh_policy VARCHAR, interval_seconds INTEGER, watermark_column VARCHAR, last_watermark VARCHAR, source_signature VARCHAR, last_refresh TIMESTAMP, last_duration_ms INTEGER, rows_written BIGINT, status VARCHAR, message VARCHAR)", connection=connection)
+
+####################################################
+def escape(value):
+    if (value is None):
+        return "NULL"
+    return "'" + str(value).replace("'", "''") + "'"
+
+####################################################
+def materialize(materializeQueryRequestDTO: MaterializeQueryRequestDTO):
+    print("Materializing query " + str(materializeQueryRequestDTO.id_query) + " with policy " + materializeQueryRequestDTO.refreshPolicy)
+    createTable()
+
+    refreshPolicy = materializeQueryRequestDTO.refreshPolicy.upper()
+    if (refreshPolicy not in REFRESH_POLICIES):
+        raise Exception("Unknown refresh policy " + refreshPolicy + ". Valid values: " + str(REFRESH_POLICIES))
+    if (refreshPolicy == "INTERVAL" and (materializeQueryRequestDTO.intervalSeconds is None or materializeQueryRequestDTO.intervalSeconds <= 0)):
+        raise Exception("intervalSeconds is required for INTERVAL refresh policy")
+
+    tableName = materializeQueryRequestDTO.tableName
+    if (tableName is None or tableName == ""):
+        tableName = "mv_" + str(materializeQueryRequestDTO.id_query)
+
+    intervalSeconds = "NULL" if materializeQueryRequestDTO.intervalSeconds is None else str(int(materializeQueryRequestDTO.intervalSeconds))
+
+    databaseService.runQuery("DELETE FROM __materializations WHERE id_query = " + str(materializeQueryRequestDTO.id_query))
+    databaseService.runQuery("INSERT INTO __materializations (id_query, table_name, refresh_policy, interval_seconds, watermark_column, status) VALUES (" +
+                             str(materializeQueryRequestDTO.id_query) + ", " + escape(tableName) + ", " + escape(refreshPolicy) + ", " + intervalSeconds + ", " +
+                             escape(materializeQueryRequestDTO.watermarkColumn) + ", 'PENDING')")
+
+    invalidateMaterializedTables()
+
+    # First load is always a full refresh
+    scheduleRefresh(materializeQueryRequestDTO.id_query, True)
+    return tableName
+
+####################################################
+def listMaterializations():
+    createTable()
+    df = databaseService.runQuery("SELECT m.*, q.name FROM __materializations m LEFT JOIN __queries q USING (id_query) ORDER BY id_query")
+    if (df is not None):
+        # Timestamps are not JSON serializable
+        df["last_refresh"] = df["last_refresh"].astype(str)
+        return df.to_dict(orient="records")
+    return []
+
+####################################################
+def getMaterialization(id_query, connection=None):
+    createTable(connection)
+    df = databaseService.runQuery("SELECT * FROM __materializations WHERE id_query = " + str(int(id_query)), False, connection=connection)
+    if (df is None or len(df) == 0):
+        return None
+    return df.to_dict(orient="records")[0]
+
+####################################################
+# Returns the table holding the precomputed results of a saved query, or None if it is not materialized (yet)
+def getMaterializedTable(id_query):
+    global materializedTables
+
+    with materializedTablesLock:
+        if (materializedTables is None):
+            try:
+                createTable()
+                df = databaseService.runQuery("SELECT id_query, table_name FROM __materializations WHERE last_refresh IS NOT NULL", False)
+                materializedTables = dict(zip(df["id_query"].to_list(), df["table_name"].to_list()))
+            except Exception as e:
+                print("Error getting materializations: " + str(e))
+                return None
+        return materializedTables.get(id_query)
+
+def invalidateMaterializedTables():
+    global materializedTables
+
+    with materializedTablesLock:
+        materializedTables = None
+
+####################################################
+def deleteMaterialization(id_query, dropTable=True):
+    print("Deleting materialization of query " + str(id_query))
+    materialization = getMaterialization(id_query)
+    if (materialization is None):
+        return False
+    databaseService.runQuery("DELETE FROM __materializations WHERE id_query = " + str(int(id_query)))
+    invalidateMaterializedTables()
+    if (dropTable):
+        databaseService.runQuery("DROP TABLE IF EXISTS " + materialization["table_name"])
+    return True
+
+####################################################
+def scheduleRefresh(id_query, full=False):
+    with pendingLock:
+        if (id_query in pendingRefreshes):
+            print("Refresh of query " + str(id_query) + " already scheduled")
+            return False
+        pendingRefreshes.add(id_query)
+
+    if (executor is None):
+        # Scheduler not started (e.g. scripts), refresh synchronously
+        refresh(id_query, full)
+    else:
+        executor.submit(refresh, id_query, full)
+    return True
+
+####################################################
+# Write versions of the tables read by the query, so any INSERT, UPDATE or DELETE changes it. If the tables are
+# unknown (views, table functions...) any write changes it
+def getSourceSignature(query):
+    sourceTables = apiCacheService.getSourceTables(query)
+    with databaseService.versionLock:
+        if (sourceTables is None):
+            return signatureSession + ";" + str(databaseService.dataVersion)
+        versions = [table + ":" + str(databaseService.tableVersions.get(table, 0)) for table in sorted(sourceTables)]
+        return signatureSession + ";" + str(databaseService.writeEpoch) + ";" + ",".join(versions)
+
+####################################################
+def countRows(tableName, connection):
+    df = databaseService.runQuery("SELECT COUNT(*) total FROM " + tableName, False, connection=connection)
+    return int(df["total"].values[0])
+
+####################################################
+# Row count and hash of the rows already materialized and of the same rows in the source. If they differ the
+# materialized rows are not an append-only prefix of the source anymore
+def appendOnly(query, tableName, watermarkColumn, connection):
+    materialized = databaseService.runQuery("SELECT COUNT(*) total, SUM(hash(m)) fingerprint FROM " + tableName + " AS m", False, connection=connection)
+    source = databaseService.runQuery("SELECT COUNT(*) total, SUM(hash(src)) fingerprint FROM (" + query + ") AS src WHERE src." + watermarkColumn +
+                                      " <= (SELECT MAX(" + watermarkColumn + ") FROM " + tableName + ")", False, connection=connection)
+    return materialized.to_dict(orient="records")[0] == source.to_dict(orient="records")[0]
+
+####################################################
+def refresh(id_query, full=False):
+    connection = databaseService.getCursor()
+    start = time.time()
+    try:
+        with admissionService.admit("BACKGROUND"):
+            return runRefresh(id_query, full, connection, start)
+    except Exception as e:
+        print("Error refreshing materialization of query " + str(id_query) + ": " + str(e))
+        try:
+            databaseService.runQuery("UPDATE __materializations SET status = 'ERROR', message = " + escape(str(e)) + " WHERE id_query = " + str(int(id_query)), False, connection=connection)
+        except Exception:
+            pass
+        return False
+    finally:
+        databaseService.closeCursor(connection)
+        with pendingLock:
+            pendingRefreshes.discard(id_query)
+
+####################################################
+def runRefresh(id_query, full, connection, start):
+    materialization = getMaterialization(id_query, connection)
+    if (materialization is None):
+        print("Query " + str(id_query) + " is not materialized")
+        return False
+
+    df = databaseService.runQuery("SELECT query FROM __queries WHERE id_query = " + str(int(id_query)), False, connection=connection)
+    if (df is None or len(df) == 0):
+        raise Exception("Saved query " + str(id_query) + " not found")
+    query = df["query"].values[0].strip()
+    if (query.endswith(";")):
+        query = query[:-1]
+
+    tableName = materialization["table_name"]
+    watermarkColumn = materialization["watermark_column"]
+    signature = getSourceSignature(query)
+    databaseService.runQuery("UPDATE __materializations SET status = 'REFRESHING' WHERE id_query = " + str(int(id_query)), False, connection=connection)
+
+    tableExists = len(databaseService.runQuery("SELECT table_name FROM duckdb_tables() WHERE table_name = " + escape(tableName), False, connection=connection)) > 0
+    incremental = not full and tableExists and watermarkColumn is not None and watermarkColumn != ""
+    if (incremental and not appendOnly(query, tableName, watermarkColumn, connection)):
+        print("Rows already materialized in " + tableName + " changed in the source, doing a full refresh")
+        incremental = False
+
+    rowsBefore = countRows(tableName, connection) if incremental else 0
+    if (incremental):
+        print("Incremental refresh of " + tableName + " using watermark " + watermarkColumn)
+        databaseService.runQuery("INSERT INTO " + tableName + " SELECT * FROM (" + query + ") AS src WHERE src." + watermarkColumn +
+                                 " > (SELECT MAX(" + watermarkColumn + ") FROM " + tableName + ") OR (SELECT MAX(" + watermarkColumn + ") FROM " + tableName + ") IS NULL", connection=connection)
+    else:
+        print("Full refresh of " + tableName)
+        databaseService.runQuery("CREATE OR REPLACE TABLE " + tableName + " AS (" + query + ")", connection=connection)
+    rowsWritten = countRows(tableName, connection) - rowsBefore
+
+    lastWatermark = None
+    if (watermarkColumn is not None and watermarkColumn != ""):
+        wm = databaseService.runQuery("SELECT CAST(MAX(" + watermarkColumn + ") AS VARCHAR) wm FROM " + tableName, False, connection=connection)
+        lastWatermark = wm["wm"].values[0]
+
+    duration = int((time.time() - start) * 1000)
+    databaseService.runQuery("UPDATE __materializations SET status = 'OK', message = NULL, last_refresh = CAST(now() AS TIMESTAMP), last_duration_ms = " + str(duration) +
+                             ", rows_written = " + str(rowsWritten) + ", source_signature = " + escape(signature) + ", last_watermark = " + escape(lastWatermark) +
+                             " WHERE id_query = " + str(int(id_query)), False, connection=connection)
+    invalidateMaterializedTables()
+    print("Refreshed " + tableName + " (" + str(rowsWritten) + " rows) in " + str(duration) + " ms")
+    return True
+
+####################################################
+def checkScheduledRefreshes():
+    connection = databaseService.getCursor()
+    try:
+        createTable(connection)
+        due = databaseService.runQuery("SELECT id_query FROM __materializations WHERE refresh_policy = 'INTERVAL' AND (last_refresh IS NULL OR last_refresh + to_seconds(interval_seconds) <= CAST(now() AS TIMESTAMP))", False, connection=connection)
+        for id_query in due["id_query"].to_list():
+            scheduleRefresh(id_query)
+
+        onChange = databaseService.runQuery("SELECT m.id_query, m.source_signature, q.query FROM __materializations m JOIN __queries q USING (id_query) WHERE m.refresh_policy = 'ON_CHANGE'", False, connection=connection)
+        for row in onChange.to_dict(orient="records"):
+            query = row["query"].strip()
+            if (query.endswith(";")):
+                query = query[:-1]
+            if (getSourceSignature(query) != row["source_signature"]):
+                print("Sources of query " + str(row["id_query"]) + " changed")
+                scheduleRefresh(row["id_query"])
+    finally:
+        databaseService.closeCursor(connection)
+
+####################################################
+def schedulerLoop():
+    while not schedulerStop.wait(tickSeconds):
+        try:
+            checkScheduledRefreshes()
+        except Exception as e:
+            print("Error checking scheduled refreshes: " + str(e))
@@ -1,4 +1,5 @@
 from services import databaseService
+from services import materializationService
 
 def saveSqlQuery(saveQueryRequestDTO):
     print("Saving query " + saveQueryRequestDTO.sqlQueryName + ": " + saveQueryRequestDTO.query + " (" + saveQueryRequestDTO.description + ")")
@@ -30,6 +31,7 @@ def searchQuery(query):
 def deleteQuery(id_query):
     print("Deleting query " + str(id_query))
     databaseService.runQuery("DELETE FROM __queries WHERE id_query = " + str(id_query))
+    materializationService.deleteMaterialization(id_query)
 
 ####################################################
 def getQuery(id_query):
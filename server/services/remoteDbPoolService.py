@@ -0,0 +1,261 @@
+import time
+import threading
+import psycopg2
+import psycopg2.extensions
+from contextlib import contextmanager
+
+from services import remoteDbService
+
+# Connection pools of remote PostgreSQL databases, one per pgpass entry ("host - port - db - user").
+# Every session (X-Session-Id header, one per browser tab) chooses its active database, so users
+# connected to different databases don't overwrite each other. Connections are validated when taken
+# from the pool, broken ones are discarded and replaced by new connections, and idle ones are closed
+# after idleTimeoutSeconds (keeping minSize). Schema and table listings are cached metadataCacheSeconds.
+
+DEFAULT_SESSION = "default"
+
+poolSettings = {
+    "minSize": 1,
+    "maxSize": 5,
+    "idleTimeoutSeconds": 300,
+    "acquireTimeoutSeconds": 30,
+    "validationQuery": "SELECT 1",
+}
+metadataCacheSeconds = 300
+# Sessions not used for this time forget their active database
+sessionTimeoutSeconds = 24 * 3600
+EVICT_INTERVAL_SECONDS = 30
+
+pools = {}
+poolsLock = threading.Lock()
+# {sessionId: {"target", "lastUsed"}}
+sessions = {}
+sessionsLock = threading.Lock()
+# {(target, name): (loadedAt, value)}
+metadataCache = {}
+metadataLock = threading.Lock()
+
+####################################################
+def init(config):
+    global metadataCacheSeconds
+
+    poolSettings["minSize"] = config.get("remoteDbPoolMinSize", poolSettings["minSize"])
+    poolSettings["maxSize"] = config.get("remoteDbPoolMaxSize", poolSettings["maxSize"])
+    poolSettings["idleTimeoutSeconds"] = config.get("remoteDbPoolIdleTimeoutSeconds", poolSettings["idleTimeoutSeconds"])
+    poolSettings["acquireTimeoutSeconds"] = config.get("remoteDbPoolAcquireTimeoutSeconds", poolSettings["acquireTimeoutSeconds"])
+    poolSettings["validationQuery"] = config.get("remoteDbValidationQuery", poolSettings["validationQuery"])
+    metadataCacheSeconds = config.get("remoteDbMetadataCacheSeconds", metadataCacheSeconds)
+    threading.Thread(target=evictLoop, name="remoteDbPoolEvict", daemon=True).start()
+
+####################################################
+class ConnectionPool:
+    def __init__(self, target, parameters):
+        self.target = target
+        self.parameters = parameters
+        # Idle connections as (connection, releasedAt), the last released is reused first
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+
+    # Without blocking, returns None if the pool has no free connection and can't open more
+    def acquire(self, blocking = True):
+        deadline = time.time() + poolSettings["acquireTimeoutSeconds"]
+        while True:
+            connection = None
+            with self.condition:
+                if (len(self.idle) > 0):
+                    connection, releasedAt = self.idle.pop()
+                elif (self.size < poolSettings["maxSize"]):
+                    self.size += 1
+                elif (not blocking):
+                    return None
+                else:
+                    remaining = deadline - time.time()
+                    if (remaining <= 0):
+                        raise Exception("No free connection to " + self.target + " after " + str(poolSettings["acquireTimeoutSeconds"]) + "s, " + str(self.size) + " in use")
+                    self.condition.wait(remaining)
+                    continue
+            if (connection is None):
+                break
+            # Validated out of the lock, it's a round trip to the database
+            if (self.validate(connection)):
+                return connection
+            print("Discarding broken connection to " + self.target)
+            with self.condition:
+                self.discard(connection)
+        try:
+            return remoteDbService.openConnection(self.parameters)
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def validate(self, connection):
+        if (connection.closed):
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute(poolSettings["validationQuery"])
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    # Called with the condition held
+    def discard(self, connection):
+        self.size -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def release(self, connection, broken = False):
+        if (not broken and not connection.closed):
+            try:
+                # Don't leave transactions open in the pool (e.g. after a SELECT)
+                if (connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    connection.rollback()
+            except Exception:
+                broken = True
+        with self.condition:
+            if (broken or connection.closed):
+                self.discard(connection)
+            else:
+                self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+    # Open connections until the pool has minSize. New ones are opened directly, acquire would reuse the idle ones
+    def fill(self):
+        while (True):
+            with self.condition:
+                if (self.size >= poolSettings["minSize"] or self.size >= poolSettings["maxSize"]):
+                    return
+                self.size += 1
+            try:
+                connection = remoteDbService.openConnection(self.parameters)
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                raise
+            self.release(connection)
+
+    def evictIdle(self):
+        with self.condition:
+            now = time.time()
+            for connection, releasedAt in list(self.idle):
+                if (self.size <= poolSettings["minSize"]):
+                    break
+                if (now - releasedAt > poolSettings["idleTimeoutSeconds"]):
+                    self.idle.remove((connection, releasedAt))
+                    self.discard(connection)
+
+    def close(self):
+        with self.condition:
+            for connection, releasedAt in self.idle:
+                self.discard(connection)
+            self.idle = []
+
+    def getStatus(self):
+        with self.condition:
+            return {"target": self.target, "size": self.size, "idle": len(self.idle), "inUse": self.size - len(self.idle)}
+
+####################################################
+# Pool of the target, created with the parameters the first time
+def getPool(target, parameters = None):
+    with poolsLock:
+        pool = pools.get(target)
+        if (pool is None):
+            if (parameters is None):
+                raise Exception("Database " + target + " is not connected")
+            pool = ConnectionPool(target, parameters)
+            pools[target] = pool
+        elif (parameters is not None and parameters != pool.parameters):
+            # The pgpass entry changed (e.g. a new password), new connections use it
+            pool.parameters = parameters
+            pool.close()
+        return pool
+
+####################################################
+# Connection of the pool of the target, returned to the pool at the end. Connections failing with
+# connection errors are discarded
+@contextmanager
+def pooledConnection(target):
+    pool = getPool(target)
+    connection = pool.acquire()
+    broken = False
+    try:
+        yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.release(connection, broken)
+
+####################################################
+# Run function(connection), once more with a new connection if the first one was broken
+def runWithConnection(target, function):
+    try:
+        with pooledConnection(target) as connection:
+            return function(connection)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        print("Connection to " + target + " failed, reconnecting: " + str(e))
+        with pooledConnection(target) as connection:
+            return function(connection)
+
+####################################################
+def setActiveTarget(sessionId, target):
+    with sessionsLock:
+        sessions[sessionId or DEFAULT_SESSION] = {"target": target, "lastUsed": time.time()}
+
+def getActiveTarget(sessionId):
+    with sessionsLock:
+        session = sessions.get(sessionId or DEFAULT_SESSION)
+        if (session is None):
+            return None
+        session["lastUsed"] = time.time()
+        return session["target"]
+
+####################################################
+# Cached result of loader(connection) for the target, e.g. its schemas
+def getCached(target, name, loader, refresh = False):
+    key = (target, name)
+    with metadataLock:
+        cached = metadataCache.get(key)
+    if (not refresh and cached is not None and time.time() - cached[0] < metadataCacheSeconds):
+        return cached[1]
+    value = runWithConnection(target, loader)
+    with metadataLock:
+        metadataCache[key] = (time.time(), value)
+    return value
+
+def clearCache(target = None):
+    with metadataLock:
+        for key in [key for key in metadataCache if target is None or key[0] == target]:
+            metadataCache.pop(key, None)
+
+####################################################
+def getStatus():
+    with poolsLock:
+        poolList = list(pools.values())
+    with sessionsLock:
+        sessionCount = len(sessions)
+    return {"pools": [pool.getStatus() for pool in poolList], "sessions": sessionCount, "settings": poolSettings}
+
+####################################################
+def evictLoop():
+    while True:
+        time.sleep(EVICT_INTERVAL_SECONDS)
+        try:
+            with poolsLock:
+                poolList = list(pools.values())
+            for pool in poolList:
+                pool.evictIdle()
+            with sessionsLock:
+                now = time.time()
+                for sessionId in [s for s, session in sessions.items() if now - session["lastUsed"] > sessionTimeoutSeconds]:
+                    sessions.pop(sessionId, None)
+        except Exception as e:
+            print("Error evicting idle remote connections: " + str(e))
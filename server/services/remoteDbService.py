@@ -1,76 +1,245 @@
 import psycopg2
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import re
+import bisect
+import decimal
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+from services import databaseService
 
+# Rows fetched per round trip when importing remote tables
+importBatchSize = 50000
+# Parallel connections used to import a query split in partitions
+importParallelism = 1
+# "copy" reads COPY (query) TO STDOUT as CSV, parsed by Arrow and cast by DuckDB, "cursor" fetches rows with psycopg2
+importMethod = "copy"
+IMPORT_METHODS = ["copy", "cursor"]
+# Bytes of CSV parsed in each Arrow batch
+COPY_BLOCK_SIZE = 16 * 1024 * 1024
+# Progress of imports by table name: {"status", "rows", "rowsPerSecond", "seconds"}
+importProgress = {}
+importLock = threading.Lock()
 
+# Arrow types of PostgreSQL type oids, other types are imported as text
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    26: pa.int64(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1700: pa.float64(),
+    18: pa.string(),
+    19: pa.string(),
+    25: pa.string(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1083: pa.time64("us"),
+    1114: pa.timestamp("us"),
+    1184: pa.timestamp("us", tz="UTC"),
+    17: pa.binary(),
+}
 
-def getDbList(database_search_text, pgpassfile):
-    databaseList = []
+# A whole table, as schema.table or SELECT * FROM schema.table
+WHOLE_TABLE_PATTERN = re.compile(r'^\s*(?:SELECT\s+\*\s+FROM\s+)?((?:"?\w+"?\.)?"?\w+"?)\s*;?\s*$', re.IGNORECASE)
 
-    try:
-        with open(pgpassfile, 'r') as f:
-            lines = f.readlines()
-    except:
-        print("pgpassfile not found in '"+ pgpassfile +"'. You must define pgpass_file in secrets.yml file")
-        return []
+# Connection that remembers its parameters, to open more connections to the same database
+class RemoteConnection(psycopg2.extensions.connection):
+    parameters = None
 
-    words = database_search_text.split(" ")
-    for line in lines:
-        # If line is a comment, skip it
-        if line.startswith('#'):
-            continue
-        try:
-            host, port, db, user, password = line.strip().split(':')
-            search_words = database_search_text.split(" ")
-            wordsFound=0
-            for word in search_words:
-                if (word in host or word in port or word in db or word in user):
-                    wordsFound+=1
-                    
-            if wordsFound == len(search_words):
-                databaseList.append(host + " - " + str(port) + " - " + db + " - "  + user)
-            
-        except Exception as e:
-            pass
-    print("Database List:"+ str(databaseList))
-    return databaseList  # Si no se encuentra la base de datos
+def init(config):
+    global importBatchSize
+    global importParallelism
+    global importMethod
+    importBatchSize = config.get("remoteImportBatchSize", importBatchSize)
+    importParallelism = config.get("remoteImportParallelism", importParallelism)
+    importMethod = config.get("remoteImportMethod", importMethod)
 
 #########################################################
+# pgpass entries, parsed when the file changes, with an index of the tokens of host, port, db and user
+class PgpassCatalog:
+    def __init__(self, pgpassfile, mtime, size, entries):
+        self.pgpassfile = pgpassfile
+        self.mtime = mtime
+        self.size = size
+        # [{"name", "host", "port", "dbname", "user", "password"}], name is "host - port - db - user"
+        self.entries = entries
+        self.byName = {entry["name"]: entry for entry in entries}
+        # token -> indexes of the entries having it, tokens sorted for prefix search
+        self.tokens = {}
+        for i, entry in enumerate(entries):
+            for token in getTokens(entry):
+                self.tokens.setdefault(token, set()).add(i)
+        self.sortedTokens = sorted(self.tokens)
+        # Fields of every entry in lower case, separated so a word can't match across them
+        self.texts = ["\n".join([entry["host"].lower(), entry["port"], entry["dbname"].lower(), entry["user"].lower()]) for entry in entries]
+        # trigram -> indexes of the entries whose text has it, to find the entries containing a word without scanning them all
+        self.trigrams = {}
+        for i, entryText in enumerate(self.texts):
+            for j in range(len(entryText) - 2):
+                self.trigrams.setdefault(entryText[j:j + 3], set()).add(i)
 
-def connectDatabase(database_name, pgpassfile):
+    # Indexes of the entries with a token starting with word, and the score of each one:
+    # 3 whole field, 2 whole token, 1 token prefix
+    def matchWord(self, word):
+        matches = {}
+        i = bisect.bisect_left(self.sortedTokens, word)
+        while (i < len(self.sortedTokens) and self.sortedTokens[i].startswith(word)):
+            token = self.sortedTokens[i]
+            for index in self.tokens[token]:
+                score = 2 if token == word else 1
+                if (matches.get(index, 0) < score):
+                    matches[index] = score
+            i += 1
+        for index in list(matches):
+            entry = self.entries[index]
+            if (word in [entry["host"].lower(), entry["port"], entry["dbname"].lower(), entry["user"].lower()]):
+                matches[index] = 3
+        return matches
+
+    # Indexes of the entries, among candidates (all if None), with word inside their fields. The entries having
+    # all the trigrams of the word are checked, words shorter than a trigram are checked in every candidate
+    def findWord(self, word, candidates):
+        if (len(word) >= 3):
+            postings = sorted([self.trigrams.get(word[j:j + 3], set()) for j in range(len(word) - 2)], key=len)
+            found = set(postings[0])
+            for posting in postings[1:]:
+                found &= posting
+            if (candidates is not None):
+                found &= candidates
+        else:
+            found = candidates if candidates is not None else range(len(self.texts))
+        return [i for i in found if word in self.texts[i]]
+
+    # Entries having every word inside their fields, best first. A word inside a field scores 0.5,
+    # the token index raises the score of the entries where it's a field, a token or a token prefix.
+    # Every word is only looked for in the entries matching the previous ones
+    def search(self, text):
+        words = [word.lower() for word in text.split(" ") if word != ""]
+        scores = None
+        for word in words:
+            matches = {i: 0.5 for i in self.findWord(word, None if scores is None else set(scores))}
+            for i, score in self.matchWord(word).items():
+                matches[i] = score
+            if (scores is None):
+                scores = matches
+            else:
+                scores = {i: score + matches[i] for i, score in scores.items() if i in matches}
+            if (len(scores) == 0):
+                return []
+        if (scores is None):
+            return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self.entries[item[0]]["name"]))
+        return [self.entries[i] for i, score in ranked]
+
+TOKEN_SEPARATOR_PATTERN = re.compile(r"[^0-9a-z]+")
+catalog = None
+catalogLock = threading.Lock()
+
+def getTokens(entry):
+    tokens = set([entry["port"]])
+    for field in [entry["host"], entry["dbname"], entry["user"]]:
+        field = field.lower()
+        tokens.add(field)
+        tokens.update([token for token in TOKEN_SEPARATOR_PATTERN.split(field) if token != ""])
+    return tokens
+
+# Fields of a pgpass line, ":" and "\" can be escaped with "\"
+def splitPgpassLine(line):
+    if ("\\" not in line):
+        return line.split(":")
+    fields = [""]
+    escaped = False
+    for c in line:
+        if (escaped):
+            fields[-1] += c
+            escaped = False
+        elif (c == "\\"):
+            escaped = True
+        elif (c == ":"):
+            fields.append("")
+        else:
+            fields[-1] += c
+    return fields
+
+def parsePgpass(pgpassfile):
+    entries = []
     with open(pgpassfile, 'r') as f:
-        lines = f.readlines()
+        for line in f:
+            line = line.rstrip("\r\n")
+            # If line is a comment, skip it
+            if (line.startswith('#') or line.strip() == ""):
+                continue
+            fields = splitPgpassLine(line)
+            if (len(fields) != 5):
+                continue
+            host, port, db, user, password = fields
+            entries.append({"name": host + " - " + port + " - " + db + " - " + user, "host": host, "port": port, "dbname": db, "user": user, "password": password})
+    return entries
 
-    host, port, db, user, password = None, None, None, None, None
-    for line in lines:
-        # If line is a comment, skip it
-        if line.startswith('#'):
-            continue
-        try:
-            host, port, db, user, password = line.strip().split(':')
-        except:
-            #print(" reading line:" + line)
-            continue
-        
-        try:
-            #print("Database:"+ db + " with host: " + host + " and port: " + port + " Database name to connect:" + database_name)
-            if host + " - " + port + " - " + db + " - " + user == database_name:
-                print("########Connecting to database::"+ db + " with host: " + host + " and port: " + port)
-                connection = psycopg2.connect(
-                    host=host,
-                    port=port,
-                    dbname=db,
-                    user=user,
-                    password=password
-                )
-                print("Connecting to database returned no error")
-                return connection
-            
-        except Exception as e:
-            print("Error connecting to database:" + str(e))
-            pass
+# Catalog of the pgpass file, parsed again only if the file changed
+def getCatalog(pgpassfile):
+    global catalog
+    stat = os.stat(pgpassfile)
+    with catalogLock:
+        if (catalog is None or catalog.pgpassfile != pgpassfile or catalog.mtime != stat.st_mtime_ns or catalog.size != stat.st_size):
+            start = time.time()
+            catalog = PgpassCatalog(pgpassfile, stat.st_mtime_ns, stat.st_size, parsePgpass(pgpassfile))
+            print("Loaded " + str(len(catalog.entries)) + " pgpass entries in " + str(round((time.time() - start) * 1000)) + "ms")
+        return catalog
+
+def getDbList(database_search_text, pgpassfile):
+    try:
+        pgpassCatalog = getCatalog(pgpassfile)
+    except Exception:
+        print("pgpassfile not found in '"+ str(pgpassfile) +"'. You must define pgpass_file in secrets.yml file")
+        return []
+    databaseList = [entry["name"] for entry in pgpassCatalog.search(database_search_text)]
+    print("Database List: " + str(len(databaseList)) + " entries")
+    return databaseList
+
+#########################################################
+
+def connectDatabase(database_name, pgpassfile):
+    parameters = getConnectionParameters(database_name, pgpassfile)
+    if (parameters is None):
+        return None
+    try:
+        print("########Connecting to database::"+ parameters["dbname"] + " with host: " + parameters["host"] + " and port: " + parameters["port"])
+        connection = openConnection(parameters)
+        print("Connecting to database returned no error")
+        return connection
+    except Exception as e:
+        print("Error connecting to database:" + str(e))
     return None  # Si no se encuentra la base de datos
 
+# Parameters of the pgpass entry named "host - port - db - user"
+def getConnectionParameters(database_name, pgpassfile):
+    entry = getCatalog(pgpassfile).byName.get(database_name)
+    if (entry is None):
+        return None
+    return {"host": entry["host"], "port": entry["port"], "dbname": entry["dbname"], "user": entry["user"], "password": entry["password"]}
+
+#########################################################
+# New connection with the parameters of a pgpass entry, or to the database of a connection
+def openConnection(parameters):
+    if (isinstance(parameters, RemoteConnection)):
+        parameters = parameters.parameters
+    connection = psycopg2.connect(connection_factory=RemoteConnection, **parameters)
+    connection.parameters = parameters
+    return connection
+
 #########################################################
 
 def getSchemas(connection):
@@ -120,23 +289,368 @@ def runRemoteQuery(connection, query):
 
     return None
 
-######################################################### PROBADAS
+#########################################################
+# Arrow type of a result column. Numeric with declared precision and scale keeps them
+def getArrowType(column):
+    if (column.type_code == 1700 and column.precision is not None and column.scale is not None and 0 < column.precision <= 38):
+        return pa.decimal128(column.precision, column.scale)
+    return ARROW_TYPES.get(column.type_code, pa.string())
 
-def getPassword(host, port, db, user):
-    with open(st.secrets["pgpass_file"], 'r') as f:
-        lines = f.readlines()
+def toArrowValue(value, arrowType):
+    if (value is None):
+        return None
+    if (pa.types.is_string(arrowType) and not isinstance(value, str)):
+        # json/jsonb come as dicts and lists, other types (uuid, arrays, intervals...) as their text
+        return json.dumps(value, default=str) if isinstance(value, (dict, list)) else str(value)
+    if (pa.types.is_floating(arrowType)):
+        return float(value)
+    if (pa.types.is_binary(arrowType)):
+        return bytes(value)
+    return value
 
-    for line in lines:
-        # If line is a comment, skip it
-        if line.startswith('#'):
-            continue
+# Rows of a fetchmany batch as an Arrow table
+def toArrowTable(rows, schema):
+    arrays = []
+    for i, field in enumerate(schema):
+        arrays.append(pa.array([toArrowValue(row[i], field.type) for row in rows], field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+#########################################################
+# Import the result of a remote query into a DuckDB table with constant memory: server side cursors
+# send batches of importBatchSize rows that are converted to Arrow and appended to a staging table,
+# renamed to tableName when all rows are loaded.
+# With parallelism > 1 the query is split in ranges of partitionColumn (or ctid ranges when the query
+# is a whole table) read by parallel connections sharing an exported snapshot, so all of them see the
+# same data. The connections are taken from the pool of the database, only the ones free, so imports
+# never open more than remoteDbPoolMaxSize. Queries that can't be split are read by a single cursor.
+def importRemoteQuery(connection, query, tableName, batchSize = None, parallelism = None, partitionColumn = None, method = None, pool = None):
+    query = getSelectQuery(query)
+    batchSize = batchSize or importBatchSize
+    parallelism = parallelism or importParallelism
+    method = method or importMethod
+    if (method not in IMPORT_METHODS):
+        raise Exception("Unknown import method " + method + ", it must be one of " + str(IMPORT_METHODS))
+    stagingTable = "__import_" + tableName
+    start = time.time()
+    setImportProgress(tableName, "RUNNING", 0, start)
+    try:
+        imported = False
+        if (parallelism > 1 and pool is not None):
+            imported = importPartitioned(pool, query, tableName, stagingTable, batchSize, parallelism, partitionColumn, method)
+        if (not imported):
+            try:
+                importStream(connection, query, None, tableName, stagingTable, batchSize, method)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        databaseService.runQuery("DROP TABLE IF EXISTS " + tableName + ";ALTER TABLE " + stagingTable + " RENAME TO " + tableName)
+        databaseService.registerWrite(tableName=tableName)
+        rows = importProgress[tableName]["rows"]
+        setImportProgress(tableName, "DONE", rows, start)
+        print("Imported " + str(rows) + " rows into " + tableName + " in " + str(importProgress[tableName]["seconds"]) + "s")
+        return rows
+    except Exception as e:
+        print("Error importing remote query:" + str(e))
+        setImportProgress(tableName, "ERROR", importProgress[tableName]["rows"], start, str(e))
         try:
-            hostFile, portFile, dbFile, userFile, password = line.strip().split(':')
-            if (hostFile == host and portFile == port and dbFile == db and userFile == user):
-                return password
-        except:
+            databaseService.runQuery("DROP TABLE IF EXISTS " + stagingTable, False)
+        except Exception:
             pass
-    return None  
+        raise
+
+# A bare table name (schema.table) is read whole. Trailing semicolons are removed, the query is wrapped
+# (COPY (query) TO STDOUT, SELECT * FROM (query) q) to be imported
+def getSelectQuery(query):
+    m = WHOLE_TABLE_PATTERN.match(query)
+    if (m is not None and not query.strip().upper().startswith("SELECT")):
+        return "SELECT * FROM " + m.group(1)
+    return re.sub(r"[\s;]+$", "", query)
+
+#########################################################
+# Read query and append its rows to stagingTable. The staging table is created from the result columns
+# unless the schema is given. duckdbCursor allows appending from several threads.
+# Queries COPY can't run are read with a cursor if COPY failed before sending rows
+def importStream(connection, query, parameters, tableName, stagingTable, batchSize, method, schema = None, duckdbCursor = None, stop = None):
+    if (method == "copy"):
+        copied = []
+        cursor = connection.cursor()
+        # A failed statement aborts the transaction, the savepoint keeps it (and its snapshot) usable
+        cursor.execute("SAVEPOINT datalake_copy")
+        try:
+            copyStream(connection, query, parameters, tableName, stagingTable, schema, duckdbCursor, stop, copied)
+            cursor.execute("RELEASE SAVEPOINT datalake_copy")
+            return
+        except Exception as e:
+            if (len(copied) > 0):
+                raise
+            print("COPY failed, importing with a cursor: " + str(e))
+            cursor.execute("ROLLBACK TO SAVEPOINT datalake_copy")
+        finally:
+            cursor.close()
+
+    cursor = connection.cursor(name="datalake_import_" + uuid.uuid4().hex)
+    cursor.itersize = batchSize
+    try:
+        cursor.execute(query, parameters)
+        while True:
+            data = cursor.fetchmany(batchSize)
+            if (schema is None):
+                # The description of a named cursor is known after the first fetch
+                schema = getArrowSchema(cursor.description)
+                appendBatch(toArrowTable([], schema), "CREATE OR REPLACE TABLE " + stagingTable + " AS", duckdbCursor)
+            if (len(data) == 0 or (stop is not None and stop.is_set())):
+                break
+            appendBatch(toArrowTable(data, schema), "INSERT INTO " + stagingTable, duckdbCursor)
+            addImportedRows(tableName, len(data))
+    finally:
+        if (not cursor.closed):
+            cursor.close()
+
+#########################################################
+# COPY (query) TO STDOUT streams CSV through a pipe to the Arrow CSV reader. Columns are read as text
+# and DuckDB casts them to the staging table types when inserting, so no Python objects are created per value.
+# Row counts of the batches appended are added to copied
+def copyStream(connection, query, parameters, tableName, stagingTable, schema, duckdbCursor, stop, copied):
+    cursor = connection.cursor()
+    try:
+        if (schema is None):
+            cursor.execute("SELECT * FROM (" + query + ") q LIMIT 0", parameters)
+            schema = getArrowSchema(cursor.description)
+            appendBatch(toArrowTable([], schema), "CREATE OR REPLACE TABLE " + stagingTable + " AS", duckdbCursor)
+        sql = cursor.mogrify(query, parameters).decode(psycopg2.extensions.encodings[connection.encoding])
+
+        names = ["c" + str(i) for i in range(len(schema))]
+        # bytea is sent in hex format (\x0a1b...)
+        columns = ", ".join(["unhex(substr(" + name + ", 3))" if pa.types.is_binary(field.type) else name for name, field in zip(names, schema)])
+
+        readFd, writeFd = os.pipe()
+        reader = os.fdopen(readFd, "rb")
+        writer = os.fdopen(writeFd, "wb")
+        errors = []
+
+        def copy():
+            try:
+                cursor.copy_expert("COPY (" + sql + ") TO STDOUT WITH (FORMAT csv)", writer)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+
+        copyThread = threading.Thread(target=copy, name="remoteCopy", daemon=True)
+        copyThread.start()
+        try:
+            # NULL is an unquoted empty value, empty strings are quoted
+            batches = pacsv.open_csv(reader,
+                                     read_options=pacsv.ReadOptions(column_names=names, block_size=COPY_BLOCK_SIZE),
+                                     parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                                     convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in names}, null_values=[""],
+                                                                          strings_can_be_null=True, quoted_strings_can_be_null=False))
+            for batch in batches:
+                if (stop is not None and stop.is_set()):
+                    break
+                appendBatch(pa.Table.from_batches([batch]), "INSERT INTO " + stagingTable, duckdbCursor, columns)
+                copied.append(batch.num_rows)
+                addImportedRows(tableName, batch.num_rows)
+        except Exception:
+            # Errors of COPY explain better why the stream ended
+            if (len(errors) == 0):
+                raise
+        finally:
+            # Closing the pipe stops a COPY still writing
+            reader.close()
+            copyThread.join()
+        if (len(errors) > 0 and not (stop is not None and stop.is_set())):
+            raise errors[0]
+    finally:
+        if (not cursor.closed):
+            cursor.close()
+
+# Repeated column names get a suffix (name_1, name_2...) like DuckDB does
+def getArrowSchema(description):
+    fields = []
+    names = set()
+    for column in description:
+        name = column.name
+        suffix = 0
+        while (name in names):
+            suffix += 1
+            name = column.name + "_" + str(suffix)
+        names.add(name)
+        fields.append(pa.field(name, getArrowType(column)))
+    return pa.schema(fields)
+
+def appendBatch(table, statement, duckdbCursor = None, columns = "*"):
+    query = statement + " SELECT " + columns + " FROM __import_batch"
+    if (duckdbCursor is None):
+        databaseService.queryDataFrame(table, "__import_batch", query)
+    else:
+        duckdbCursor.register("__import_batch", table)
+        try:
+            duckdbCursor.execute(query)
+        finally:
+            duckdbCursor.unregister("__import_batch")
+
+#########################################################
+# Returns False if the query can't be split, the snapshot can't be exported (e.g. on a standby) or the
+# pool has no free connections. The coordinator keeps the snapshot, up to parallelism workers read the partitions
+def importPartitioned(pool, query, tableName, stagingTable, batchSize, parallelism, partitionColumn, method):
+    coordinator = pool.acquire(blocking=False)
+    if (coordinator is None):
+        print("No free connections to import " + tableName + " in parallel, importing it with a single connection")
+        return False
+    workers = []
+    try:
+        # The snapshot stays valid while the transaction of the coordinator is open
+        cursor = coordinator.cursor()
+        try:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+            partitions = getPartitions(cursor, query, parallelism, partitionColumn)
+            if (partitions is None):
+                print("Query can't be split in partitions, importing it with a single connection")
+                return False
+            cursor.execute("SELECT * FROM (" + query + ") q LIMIT 0")
+            schema = getArrowSchema(cursor.description)
+        except Exception as e:
+            if (partitionColumn is not None):
+                raise
+            print("Can't import in parallel, importing with a single connection: " + str(e))
+            return False
+        finally:
+            cursor.close()
+
+        while (len(workers) < min(parallelism, len(partitions))):
+            worker = pool.acquire(blocking=False)
+            if (worker is None):
+                break
+            workers.append(worker)
+        if (len(workers) == 0):
+            print("No free connections to import " + tableName + " in parallel, importing it with a single connection")
+            return False
+
+        appendBatch(toArrowTable([], schema), "CREATE OR REPLACE TABLE " + stagingTable + " AS")
+        print("Importing " + tableName + " in " + str(len(partitions)) + " partitions with " + str(len(workers)) + " connections, snapshot " + snapshot)
+        stop = threading.Event()
+        freeWorkers = queue.Queue()
+        for worker in workers:
+            freeWorkers.put(worker)
+        with ThreadPoolExecutor(max_workers=len(workers), thread_name_prefix="remoteImport") as executor:
+            futures = [executor.submit(importPartition, freeWorkers, snapshot, partitionQuery, parameters, tableName, stagingTable, batchSize, method, schema, stop)
+                       for partitionQuery, parameters in partitions]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    # The other partitions stop after their current batch
+                    stop.set()
+                    raise
+        coordinator.commit()
+        return True
+    finally:
+        for worker in workers:
+            pool.release(worker)
+        pool.release(coordinator)
+
+# Read a partition with a free worker connection, in a transaction with the snapshot of the coordinator
+def importPartition(freeWorkers, snapshot, query, parameters, tableName, stagingTable, batchSize, method, schema, stop):
+    if (stop.is_set()):
+        return
+    worker = freeWorkers.get()
+    duckdbCursor = databaseService.getCursor()
+    try:
+        cursor = worker.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        cursor.close()
+        importStream(worker, query, parameters, tableName, stagingTable, batchSize, method, schema, duckdbCursor, stop)
+        worker.commit()
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        # Rolled back when it's returned to the pool
+        freeWorkers.put(worker)
+        duckdbCursor.close()
+
+#########################################################
+# Queries reading each partition as (query, parameters):
+#   partitionColumn: numeric or date ranges between its min and max, plus its nulls
+#   a whole table (schema.table or SELECT * FROM schema.table): ranges of pages read by ctid (TID range scans, PostgreSQL 14+)
+def getPartitions(cursor, query, parallelism, partitionColumn):
+    if (partitionColumn is not None):
+        column = '"' + partitionColumn.replace('"', '""') + '"'
+        source = "SELECT * FROM (" + query.replace("%", "%%") + ") q WHERE "
+        cursor.execute("SELECT min(" + column + "), max(" + column + ") FROM (" + query + ") q")
+        low, high = cursor.fetchone()
+        partitions = [(source + column + " IS NULL", None)]
+        if (low is None):
+            return partitions
+        if (not isinstance(low, (int, float, decimal.Decimal, datetime.date))):
+            raise Exception("Partition column " + partitionColumn + " must be numeric or a date, it is " + type(low).__name__)
+        bounds = []
+        for i in range(parallelism):
+            bound = low + (high - low) * i // parallelism if isinstance(low, int) else low + (high - low) * i / parallelism
+            if (len(bounds) == 0 or bound > bounds[-1]):
+                bounds.append(bound)
+        bounds.append(high)
+        for i in range(len(bounds) - 1):
+            last = i == len(bounds) - 2
+            partitions.append((source + column + " >= %s AND " + column + (" <= %s" if last else " < %s"), (bounds[i], bounds[i + 1])))
+        return partitions
+
+    m = WHOLE_TABLE_PATTERN.match(query)
+    if (m is None):
+        return None
+    table = m.group(1)
+    cursor.execute("SELECT c.relkind, pg_relation_size(c.oid) / current_setting('block_size')::bigint FROM pg_class c WHERE c.oid = %s::regclass", (table,))
+    kind, pages = cursor.fetchone()
+    if (kind not in ["r", "m"] or pages < parallelism):
+        return None
+    source = "SELECT * FROM " + table + " WHERE ctid >= %s::tid"
+    step = -(-pages // parallelism)
+    partitions = []
+    for low in range(0, pages, step):
+        # The last partition has no upper bound
+        if (low + step >= pages):
+            partitions.append((source, ("(" + str(low) + ",0)",)))
+        else:
+            partitions.append((source + " AND ctid < %s::tid", ("(" + str(low) + ",0)", "(" + str(low + step) + ",0)")))
+    return partitions
+
+#########################################################
+def setImportProgress(tableName, status, rows, start, message = None):
+    seconds = time.time() - start
+    with importLock:
+        importProgress[tableName] = {"status": status, "rows": rows, "rowsPerSecond": round(rows / seconds) if seconds > 0 else None, "seconds": round(seconds, 1), "message": message, "start": start}
+
+def addImportedRows(tableName, rows):
+    with importLock:
+        progress = importProgress[tableName]
+        progress["rows"] += rows
+        seconds = time.time() - progress["start"]
+        progress["seconds"] = round(seconds, 1)
+        progress["rowsPerSecond"] = round(progress["rows"] / seconds) if seconds > 0 else None
+        print("Importing " + tableName + ": " + str(progress["rows"]) + " rows, " + str(progress["rowsPerSecond"]) + " rows/s")
+
+def getImportProgress(tableName = None):
+    with importLock:
+        if (tableName is not None):
+            return importProgress.get(tableName)
+        return dict(importProgress)
+
+######################################################### PROBADAS
+
+def getPassword(host, port, db, user, pgpassfile = None):
+    if (pgpassfile is None):
+        from config import Config
+        pgpassfile = Config.get_instance().get_secrets.get("pgpass_file")
+    entry = getCatalog(pgpassfile).byName.get(host + " - " + str(port) + " - " + db + " - " + user)
+    return entry["password"] if entry is not None else None
 
 #########################################################
 
@@ -153,7 +667,7 @@ def getConnection(selectedDatabase):
         password=password
     )
     if (connection is None):
-        print("Error connecting to database with config:"+ str(databaseConfig))
+        print("Error connecting to database:"+ str(selectedDatabase))
     return connection
 
 #########################################################
@@ -0,0 +1,196 @@
+import json
+import time
+import threading
+
+from services import databaseService
+from services import remoteDbService
+from services import remoteDbPoolService
+
+# Tables imported from remote databases remember their query (__remote_imports), so they can be synced again:
+#   watermarkColumn and primaryKey: rows with watermark >= the last one imported are upserted
+#   watermarkColumn only: rows with watermark > the last one are appended
+#   otherwise: full import of the query
+# With detectDeletes, the primary keys of the query are read to delete rows removed in the source.
+# Every sync is recorded in __remote_sync_history
+
+syncLocks = {}
+syncLocksLock = threading.Lock()
+
+####################################################
+def createTables():
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __remote_imports (table_name VARCHAR PRIMARY KEY, target VARCHAR, query VARCHAR, " +
+                             "watermark_column VARCHAR, primary_key VARCHAR, detect_deletes BOOLEAN, last_watermark VARCHAR, imported_at TIMESTAMP, synced_at TIMESTAMP)", False)
+    databaseService.runQuery("CREATE SEQUENCE IF NOT EXISTS seq_id_remote_sync START 1", False)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __remote_sync_history (id_sync INTEGER, table_name VARCHAR, mode VARCHAR, status VARCHAR, " +
+                             "started_at TIMESTAMP, finished_at TIMESTAMP, watermark_from VARCHAR, watermark_to VARCHAR, rows_fetched BIGINT, rows_deleted BIGINT, message VARCHAR)", False)
+
+def quote(column):
+    return '"' + column.strip().replace('"', '""') + '"'
+
+def getKeyColumns(primaryKey):
+    return [column.strip() for column in primaryKey.split(",") if column.strip() != ""] if primaryKey else []
+
+####################################################
+# Called after createTableFromRemoteQuery imports the whole query
+def registerImport(target, query, tableName, watermarkColumn = None, primaryKey = None, detectDeletes = False, startedAt = None, rows = None):
+    createTables()
+    watermark = getWatermark(tableName, watermarkColumn)
+    databaseService.runQuery("INSERT OR REPLACE INTO __remote_imports VALUES (" + ", ".join([
+        databaseService.toSqlLiteral(tableName), databaseService.toSqlLiteral(target), databaseService.toSqlLiteral(query),
+        databaseService.toSqlLiteral(watermarkColumn), databaseService.toSqlLiteral(primaryKey), "true" if detectDeletes else "false",
+        databaseService.toSqlLiteral(watermark), "now()::TIMESTAMP", "now()::TIMESTAMP"]) + ")", False)
+    recordSync(tableName, "full", "DONE", startedAt or time.time(), None, watermark, rows, 0, None)
+
+# Highest value of the watermark column in the DuckDB table, as text to compare it in the source
+def getWatermark(tableName, watermarkColumn):
+    if (watermarkColumn is None):
+        return None
+    df = databaseService.runQuery("SELECT max(" + quote(watermarkColumn) + ")::VARCHAR watermark FROM " + tableName, False)
+    watermark = df["watermark"].values[0]
+    return None if watermark is None or watermark != watermark else str(watermark)
+
+####################################################
+def recordSync(tableName, mode, status, startedAt, watermarkFrom, watermarkTo, rowsFetched, rowsDeleted, message):
+    databaseService.runQuery("INSERT INTO __remote_sync_history VALUES (nextval('seq_id_remote_sync'), " + ", ".join([
+        databaseService.toSqlLiteral(tableName), databaseService.toSqlLiteral(mode), databaseService.toSqlLiteral(status),
+        "to_timestamp(" + str(startedAt) + ")::TIMESTAMP", "now()::TIMESTAMP", databaseService.toSqlLiteral(watermarkFrom), databaseService.toSqlLiteral(watermarkTo),
+        databaseService.toSqlLiteral(rowsFetched), databaseService.toSqlLiteral(rowsDeleted), databaseService.toSqlLiteral(message)]) + ")", False)
+
+def getImport(tableName):
+    createTables()
+    df = databaseService.runQuery("SELECT * FROM __remote_imports WHERE table_name = " + databaseService.toSqlLiteral(tableName), False)
+    if (len(df) == 0):
+        return None
+    return json.loads(df.to_json(orient="records", date_format="iso"))[0]
+
+def listImports():
+    createTables()
+    df = databaseService.runQuery("SELECT * FROM __remote_imports ORDER BY table_name", False)
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+def getHistory(tableName = None, limit = 100):
+    createTables()
+    where = "" if tableName is None else " WHERE table_name = " + databaseService.toSqlLiteral(tableName)
+    df = databaseService.runQuery("SELECT * FROM __remote_sync_history" + where + " ORDER BY id_sync DESC LIMIT " + str(int(limit)), False)
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+####################################################
+def getSyncLock(tableName):
+    with syncLocksLock:
+        return syncLocks.setdefault(tableName, threading.Lock())
+
+# Pool of the database the table was imported from, it may not be connected in this server run
+def getPool(target):
+    try:
+        return remoteDbPoolService.getPool(target)
+    except Exception:
+        from config import Config
+        parameters = remoteDbService.getConnectionParameters(target, Config.get_instance().get_secrets.get("pgpass_file"))
+        if (parameters is None):
+            raise Exception("Database " + target + " not found in pgpass file")
+        return remoteDbPoolService.getPool(target, parameters)
+
+####################################################
+def sync(tableName):
+    remoteImport = getImport(tableName)
+    if (remoteImport is None):
+        raise Exception("Table " + tableName + " was not imported from a remote database")
+    lock = getSyncLock(tableName)
+    if (not lock.acquire(blocking=False)):
+        raise Exception("Table " + tableName + " is already being synced")
+    try:
+        getPool(remoteImport["target"])
+        return runSync(remoteImport)
+    finally:
+        lock.release()
+
+####################################################
+def runSync(remoteImport):
+    tableName = remoteImport["table_name"]
+    watermarkColumn = remoteImport["watermark_column"]
+    keyColumns = getKeyColumns(remoteImport["primary_key"])
+    watermarkFrom = remoteImport["last_watermark"]
+    startedAt = time.time()
+    # Imports registered before trailing semicolons were removed can't be wrapped as they are
+    query = remoteDbService.getSelectQuery(remoteImport["query"])
+
+    if (watermarkColumn is None or watermarkFrom is None):
+        # Nothing to compare with, import everything again
+        print("Full sync of " + tableName)
+        try:
+            with remoteDbPoolService.pooledConnection(remoteImport["target"]) as connection:
+                rows = remoteDbService.importRemoteQuery(connection, query, tableName, pool=remoteDbPoolService.getPool(remoteImport["target"]))
+        except Exception as e:
+            recordSync(tableName, "full", "ERROR", startedAt, watermarkFrom, None, None, None, str(e))
+            raise
+        watermarkTo = getWatermark(tableName, watermarkColumn)
+        updateImport(tableName, watermarkTo)
+        recordSync(tableName, "full", "DONE", startedAt, watermarkFrom, watermarkTo, rows, 0, None)
+        return {"tableName": tableName, "mode": "full", "rowsFetched": rows, "rowsDeleted": 0, "watermark": watermarkTo}
+
+    mode = "upsert" if len(keyColumns) > 0 else "append"
+    changesTable = "__sync_changes_" + tableName
+    keysTable = "__sync_keys_" + tableName
+    source = query.replace("%", "%%")
+    # Rows with the last watermark may have changed after the last sync, upserting them again is harmless
+    changesQuery = "SELECT * FROM (" + source + ") q WHERE " + quote(watermarkColumn) + (" >= %s" if mode == "upsert" else " > %s")
+    print("Incremental sync (" + mode + ") of " + tableName + " from " + watermarkColumn + " " + watermarkFrom)
+
+    remoteDbService.setImportProgress(tableName, "RUNNING", 0, startedAt)
+    rowsDeleted = 0
+    try:
+        with remoteDbPoolService.pooledConnection(remoteImport["target"]) as connection:
+            try:
+                # Changes and keys are read from the same snapshot
+                cursor = connection.cursor()
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.close()
+                remoteDbService.importStream(connection, changesQuery, (watermarkFrom,), tableName, changesTable, remoteDbService.importBatchSize, remoteDbService.importMethod)
+                rowsFetched = remoteDbService.getImportProgress(tableName)["rows"]
+                if (remoteImport["detect_deletes"] and len(keyColumns) > 0):
+                    keysQuery = "SELECT " + ", ".join([quote(c) for c in keyColumns]) + " FROM (" + query + ") q"
+                    remoteDbService.importStream(connection, keysQuery, None, tableName, keysTable, remoteDbService.importBatchSize, remoteDbService.importMethod)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+        rowsDeleted = merge(tableName, changesTable, keysTable if remoteImport["detect_deletes"] and len(keyColumns) > 0 else None, keyColumns)
+        watermarkTo = getWatermark(tableName, watermarkColumn)
+        updateImport(tableName, watermarkTo)
+        databaseService.registerWrite(tableName=tableName)
+        remoteDbService.setImportProgress(tableName, "DONE", rowsFetched, startedAt)
+        recordSync(tableName, mode, "DONE", startedAt, watermarkFrom, watermarkTo, rowsFetched, rowsDeleted, None)
+        print("Synced " + tableName + ": " + str(rowsFetched) + " rows fetched, " + str(rowsDeleted) + " deleted in " + str(round(time.time() - startedAt, 1)) + "s")
+        return {"tableName": tableName, "mode": mode, "rowsFetched": rowsFetched, "rowsDeleted": rowsDeleted, "watermark": watermarkTo}
+    except Exception as e:
+        print("Error syncing " + tableName + ": " + str(e))
+        remoteDbService.setImportProgress(tableName, "ERROR", 0, startedAt, str(e))
+        recordSync(tableName, mode, "ERROR", startedAt, watermarkFrom, None, None, None, str(e))
+        raise
+    finally:
+        databaseService.runQuery("DROP TABLE IF EXISTS " + changesTable + ";DROP TABLE IF EXISTS " + keysTable, False)
+
+####################################################
+# Apply the changes in one transaction, on its own cursor so other queries don't join it. Returns the rows deleted
+def merge(tableName, changesTable, keysTable, keyColumns):
+    cursor = databaseService.getCursor()
+    try:
+        cursor.execute("BEGIN TRANSACTION")
+        sameKey = " AND ".join(["s." + quote(c) + " IS NOT DISTINCT FROM t." + quote(c) for c in keyColumns])
+        rowsDeleted = 0
+        if (keysTable is not None):
+            rowsDeleted = cursor.execute("DELETE FROM " + tableName + " t WHERE NOT EXISTS (SELECT 1 FROM " + keysTable + " s WHERE " + sameKey + ")").fetchone()[0]
+        if (len(keyColumns) > 0):
+            cursor.execute("DELETE FROM " + tableName + " t WHERE EXISTS (SELECT 1 FROM " + changesTable + " s WHERE " + sameKey + ")")
+        cursor.execute("INSERT INTO " + tableName + " BY NAME SELECT * FROM " + changesTable)
+        cursor.execute("COMMIT")
+        return rowsDeleted
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+
+def updateImport(tableName, watermark):
+    databaseService.runQuery("UPDATE __remote_imports SET last_watermark = " + databaseService.toSqlLiteral(watermark) + ", synced_at = now()::TIMESTAMP WHERE table_name = " + databaseService.toSqlLiteral(tableName), False)
@@ -1,108 +1,662 @@
+import io
+import bz2
+import csv
+import zlib
+import lzma
 import boto3
 import json
+import itertools
 import time
+import threading
+import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import OrderedDict
+from botocore.config import Config as BotoConfig
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-index = None
-indexBuildingTime = 0
-previousBucket = None
-
-def buildIndex(bucket_name):
-    print ("Building index...")
-    global index
-    s3 = boto3.client("s3")
-    indice = []
-
-    paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket_name):
-        #print("Page: " + str(page))
-        for obj in page.get("Contents", []):
-            fileName = "s3://" + bucket_name + "/" + obj["Key"]
-            indice.append(fileName)
-            #print("Added file: " + fileName)
-    print("S3 Index built")
-    return indice
+from services import databaseService
+
+# Keys of every bucket searched are stored in __s3_index (bucket, key, size, last_modified, etag).
+# A refresh lists the bucket and applies only the differences to the table, and rebuilds the search
+# index of the bucket in memory if something changed. Refreshes run in background every
+# indexRefreshSeconds, searches use the previous index meanwhile. Only the first search of a bucket
+# never indexed waits for the listing.
+# The search index splits the sorted keys in blocks of INDEX_BLOCK_SIZE keys. Every block keeps its keys
+# as one text and the sorted codes of the trigrams (3 bytes) in it, so a substring search only looks
+# into the blocks having all the trigrams of the searched text.
+
+INDEX_BLOCK_SIZE = 4096
+indexRefreshSeconds = 600
+# S3 compatible endpoint (e.g. MinIO or a local stand-in), None for AWS
+endpointUrl = None
+# Buckets are listed by prefixes in parallel, prefixes are discovered (delimiter listings) up to
+# MAX_PREFIX_DEPTH levels until there are PREFIXES_PER_WORKER for every worker
+listWorkers = 16
+PREFIXES_PER_WORKER = 4
+MAX_PREFIX_DEPTH = 3
+# {bucket: {"status", "prefixes", "prefixesDone", "objects", "seconds"}}
+listingProgress = {}
+progressLock = threading.Lock()
+client = None
+clientLock = threading.Lock()
+
+# Previews read the head of CSV, JSON and text files (decompressed if gzip, bz2 or xz) and the footer and
+# first pages of Parquet files with range requests. Parsed previews are kept by ETag, so previewing an
+# unchanged file again costs one HEAD request
+previewRows = 20
+previewBytes = 65536
+# Decompressed bytes parsed at most from the head of compressed files
+MAX_PREVIEW_TEXT = 1024 * 1024
+PREVIEW_CACHE_SIZE = 256
+FORMATS = {".parquet": "parquet", ".csv": "csv", ".tsv": "csv", ".json": "json", ".jsonl": "json", ".ndjson": "json"}
+COMPRESSIONS = {".gz": "gzip", ".gzip": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd", ".zip": "zip", ".snappy": "snappy", ".lz4": "lz4"}
+COMPRESSION_MAGIC = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"), (b"PK\x03\x04", "zip")]
+# Incremental decompressors, they decompress the head of a file
+DECOMPRESSORS = {"gzip": lambda: zlib.decompressobj(zlib.MAX_WBITS | 16), "bz2": bz2.BZ2Decompressor, "xz": lzma.LZMADecompressor}
+# {(bucket, path, rows): preview}, least recently used first
+previews = OrderedDict()
+previewsLock = threading.Lock()
+
+# Folders of the S3 explorer: {(bucket, path): (loadedAt, {"content", "metadata"})}, least recently used first
+contentCacheSeconds = 60
+prefetchFolders = 10
+PREFETCH_WORKERS = 4
+CONTENT_CACHE_SIZE = 1024
+contents = OrderedDict()
+# {(bucket, path): Future} of the folders being prefetched
+loadingContents = {}
+# {(bucket, path): time} of the last metadata update, loads started before it are not cached
+contentInvalidations = OrderedDict()
+contentsLock = threading.Lock()
+prefetchExecutor = None
+
+# {bucket: BucketIndex}
+indexes = {}
+indexesLock = threading.Lock()
+bucketLocks = {}
+bucketLocksLock = threading.Lock()
+
+############################################################################################################
+def init(config):
+    global indexRefreshSeconds
+    global endpointUrl
+    global listWorkers
+    global previewRows
+    global previewBytes
+    global contentCacheSeconds
+    global prefetchFolders
+    global prefetchExecutor
+    indexRefreshSeconds = config.get("s3IndexRefreshSeconds", indexRefreshSeconds)
+    endpointUrl = config.get("s3EndpointUrl", endpointUrl)
+    listWorkers = config.get("s3ListWorkers", listWorkers)
+    previewRows = config.get("s3PreviewRows", previewRows)
+    previewBytes = config.get("s3PreviewBytes", previewBytes)
+    contentCacheSeconds = config.get("s3ContentCacheSeconds", contentCacheSeconds)
+    prefetchFolders = config.get("s3PrefetchFolders", prefetchFolders)
+    prefetchExecutor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="s3Prefetch")
+
+# boto3 clients are thread safe, one is shared by every S3 call (listings, previews, explorer) and keeps a
+# pool of HTTP connections, one for each listing worker
+def getClient():
+    global client
+    with clientLock:
+        if (client is None):
+            client = boto3.client("s3", endpoint_url=endpointUrl, config=BotoConfig(max_pool_connections=max(10, listWorkers)))
+        return client
 
 ############################################################################################################
+def getTrigramCodes(data):
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    return (values[:-2] << 16) | (values[1:-1] << 8) | values[2:]
 
-def s3Search(bucket, fileName):
-    global index
-    global indexBuildingTime
-    global previousBucket
+class IndexBlock:
+    def __init__(self, keys):
+        self.keys = keys
+        self.text = "\n".join(keys).encode("utf-8")
+        # Offset of every key in text
+        self.offsets = np.cumsum([0] + [len(key.encode("utf-8")) + 1 for key in keys[:-1]])
+        self.trigrams = np.unique(getTrigramCodes(self.text))
 
-    if (bucket!=previousBucket):
-        index = None
-        previousBucket = bucket
-    
-    if (index == None) or time.time() - indexBuildingTime > 600:
-        index = buildIndex(bucket)
-        indexBuildingTime = time.time()
+    def hasTrigrams(self, codes):
+        positions = np.searchsorted(self.trigrams, codes)
+        if ((positions >= len(self.trigrams)).any()):
+            return False
+        return bool((self.trigrams[positions] == codes).all())
 
-    results = []
+    def search(self, text, results, limit):
+        position = self.text.find(text)
+        while (position != -1 and len(results) < limit):
+            i = int(np.searchsorted(self.offsets, position, side="right")) - 1
+            results.append(self.keys[i])
+            nextKey = int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else len(self.text)
+            position = self.text.find(text, nextKey)
 
-    for file in index:
-        if fileName in file:
-            results.append(file)
+class BucketIndex:
+    def __init__(self, bucket, keys, refreshedAt):
+        self.bucket = bucket
+        self.size = len(keys)
+        self.refreshedAt = refreshedAt
+        self.blocks = [IndexBlock(keys[i:i + INDEX_BLOCK_SIZE]) for i in range(0, len(keys), INDEX_BLOCK_SIZE)]
+        self.refreshing = False
 
-    return results
+    def search(self, fileName, limit):
+        text = fileName.encode("utf-8")
+        codes = np.unique(getTrigramCodes(text)) if len(text) >= 3 else None
+        results = []
+        for block in self.blocks:
+            if (codes is not None and not block.hasTrigrams(codes)):
+                continue
+            block.search(text, results, limit)
+            if (len(results) >= limit):
+                break
+        return results
 
 ############################################################################################################
-def getContent(bucket, path):
-    s3 = boto3.client("s3")
-    content = []
+# Times are stored in UTC (last_modified, refreshed_at)
+def createTables():
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __s3_index (bucket VARCHAR, key VARCHAR, size BIGINT, last_modified TIMESTAMP, etag VARCHAR, PRIMARY KEY (bucket, key))", False)
+    databaseService.runQuery("CREATE TABLE IF NOT EXISTS __s3_index_state (bucket VARCHAR PRIMARY KEY, refreshed_at TIMESTAMP, objects BIGINT, added BIGINT, changed BIGINT, deleted BIGINT, seconds DOUBLE)", False)
+    # Tables created without the primary key may have keys twice, they are rebuilt without them
+    constraints = databaseService.runQuery("SELECT count(*) total FROM duckdb_constraints() WHERE database_name = current_database() AND schema_name = 'main' " +
+                                           "AND table_name = '__s3_index' AND constraint_type = 'PRIMARY KEY'", False)
+    if (constraints["total"].values[0] == 0):
+        print("Adding the primary key of __s3_index")
+        databaseService.runQuery("CREATE OR REPLACE TABLE __s3_index_new (bucket VARCHAR, key VARCHAR, size BIGINT, last_modified TIMESTAMP, etag VARCHAR, PRIMARY KEY (bucket, key));" +
+                                 "INSERT INTO __s3_index_new SELECT DISTINCT ON (bucket, key) * FROM __s3_index;" +
+                                 "DROP TABLE __s3_index;ALTER TABLE __s3_index_new RENAME TO __s3_index", False)
 
-    
-    respuesta = s3.list_objects_v2(Bucket=bucket, Prefix=path, Delimiter='/')
+# Refreshes and the first load of a bucket run one at a time
+def getBucketLock(bucket):
+    with bucketLocksLock:
+        return bucketLocks.setdefault(bucket, threading.RLock())
 
-    # Get metadata.json  from bucket and path
+# Every object of the bucket as an Arrow table
+def listBucket(bucket):
+    start = time.time()
+    s3 = getClient()
+    columns = {"key": [], "size": [], "last_modified": [], "etag": []}
+    setListingProgress(bucket, status="DISCOVERING", prefixes=0, prefixesDone=0, objects=0, start=start)
     try:
-        response = s3.get_object(Bucket=bucket, Key=path + "metadata.json")
-        metadata = json.loads(response['Body'].read())
-        
+        with ThreadPoolExecutor(max_workers=listWorkers, thread_name_prefix="s3List") as executor:
+            prefixes = discoverPrefixes(s3, bucket, executor, columns)
+            setListingProgress(bucket, status="LISTING", prefixes=len(prefixes))
+            # Results are merged as every prefix finishes
+            futures = [executor.submit(listPrefix, s3, bucket, prefix, None) for prefix in prefixes]
+            for future in as_completed(futures):
+                for name, values in future.result().items():
+                    columns[name].extend(values)
+                addListingProgress(bucket, prefixesDone=1)
+        setListingProgress(bucket, status="DONE")
     except Exception as e:
-        metadata = None
+        setListingProgress(bucket, status="ERROR", message=str(e))
+        raise
+    print("Listed " + str(len(columns["key"])) + " objects of " + bucket + " in " + str(len(prefixes)) + " prefixes in " + str(round(time.time() - start, 1)) + "s")
+    return pa.table({"key": pa.array(columns["key"], pa.string()), "size": pa.array(columns["size"], pa.int64()),
+                     "last_modified": pa.array(columns["last_modified"], pa.timestamp("us")), "etag": pa.array(columns["etag"], pa.string())})
+
+# Prefixes to list in parallel. Objects found above them are added to columns
+def discoverPrefixes(s3, bucket, executor, columns):
+    prefixes = [""]
+    for depth in range(MAX_PREFIX_DEPTH):
+        if (len(prefixes) >= listWorkers * PREFIXES_PER_WORKER):
+            break
+        children = []
+        for result in executor.map(lambda prefix: listPrefix(s3, bucket, prefix, "/"), prefixes):
+            for name in columns:
+                columns[name].extend(result[name])
+            children.extend(result["prefixes"])
+        prefixes = children
+        if (len(prefixes) == 0):
+            break
+    return prefixes
+
+# Objects under prefix as columns. With delimiter, only the objects at this level and the prefixes below it
+def listPrefix(s3, bucket, prefix, delimiter):
+    result = {"key": [], "size": [], "last_modified": [], "etag": [], "prefixes": []}
+    parameters = {"Bucket": bucket, "Prefix": prefix}
+    if (delimiter is not None):
+        parameters["Delimiter"] = delimiter
+    for page in s3.get_paginator("list_objects_v2").paginate(**parameters):
+        contents = page.get("Contents", [])
+        for obj in contents:
+            result["key"].append(obj["Key"])
+            result["size"].append(obj.get("Size"))
+            result["last_modified"].append(toUtc(obj.get("LastModified")))
+            result["etag"].append(obj.get("ETag"))
+        result["prefixes"].extend([commonPrefix["Prefix"] for commonPrefix in page.get("CommonPrefixes", [])])
+        addListingProgress(bucket, objects=len(contents))
+    if (delimiter is None):
+        del result["prefixes"]
+    return result
 
+def setListingProgress(bucket, **values):
+    with progressLock:
+        progress = listingProgress.setdefault(bucket, {})
+        progress.update(values)
+        progress["seconds"] = round(time.time() - progress.get("start", time.time()), 1)
 
-    for objeto in respuesta.get('Contents', []):
-        print("Obj:" + objeto['Key'])
-        content.append(objeto['Key'])
+def addListingProgress(bucket, **counters):
+    with progressLock:
+        progress = listingProgress.setdefault(bucket, {})
+        for name, value in counters.items():
+            progress[name] = progress.get(name, 0) + value
+        progress["seconds"] = round(time.time() - progress.get("start", time.time()), 1)
 
-    for prefijo in respuesta.get('CommonPrefixes', []):
-        print("Pref:" + prefijo['Prefix'])
-        content.append(prefijo['Prefix'])
+def getListingProgress(bucket = None):
+    with progressLock:
+        if (bucket is not None):
+            return dict(listingProgress.get(bucket, {}))
+        return {bucket: dict(progress) for bucket, progress in listingProgress.items()}
 
-    return {"content": content, "metadata": metadata}
+def toUtc(value):
+    if (value is None or value.tzinfo is None):
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 ############################################################################################################
-def getFilePreview(bucket, path):
-    s3 = boto3.client("s3")
-    results = []
-    byte_range = 'bytes=0-1000'
-    response = s3.get_object(Bucket=bucket, Key=path)
-    response = s3.get_object(Bucket=bucket, Key=path, Range=byte_range)
+# List the bucket and apply the differences to __s3_index. Returns the number of objects added, changed and deleted
+def refreshIndex(bucket):
+    with getBucketLock(bucket):
+        return refreshBucketIndex(bucket)
 
-    results.append(response['Body'].read())
+def refreshBucketIndex(bucket):
+    print("Refreshing S3 index of bucket " + bucket)
+    start = time.time()
+    createTables()
+    listing = listBucket(bucket)
+    bucketLiteral = databaseService.toSqlLiteral(bucket)
+    sameObject = "i.bucket = " + bucketLiteral + " AND i.key = l.key"
+    cursor = databaseService.getCursor()
+    try:
+        cursor.register("__s3_listing", listing)
+        cursor.execute("BEGIN TRANSACTION")
+        deleted = cursor.execute("DELETE FROM __s3_index i WHERE i.bucket = " + bucketLiteral + " AND NOT EXISTS (SELECT 1 FROM __s3_listing l WHERE l.key = i.key)").fetchone()[0]
+        changed = cursor.execute("DELETE FROM __s3_index i WHERE i.bucket = " + bucketLiteral + " AND EXISTS (SELECT 1 FROM __s3_listing l WHERE l.key = i.key AND " +
+                                 "(l.etag IS DISTINCT FROM i.etag OR l.size IS DISTINCT FROM i.size OR l.last_modified IS DISTINCT FROM i.last_modified))").fetchone()[0]
+        inserted = cursor.execute("INSERT INTO __s3_index SELECT " + bucketLiteral + ", l.key, l.size, l.last_modified, l.etag FROM (SELECT DISTINCT ON (key) * FROM __s3_listing) l " +
+                                  "WHERE NOT EXISTS (SELECT 1 FROM __s3_index i WHERE " + sameObject + ")").fetchone()[0]
+        seconds = round(time.time() - start, 3)
+        cursor.execute("INSERT OR REPLACE INTO __s3_index_state VALUES (" + bucketLiteral + ", timezone('UTC', now()), " + str(listing.num_rows) + ", " +
+                       str(inserted - changed) + ", " + str(changed) + ", " + str(deleted) + ", " + str(seconds) + ")")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+    print("S3 index of " + bucket + ": " + str(listing.num_rows) + " objects, " + str(inserted - changed) + " added, " + str(changed) + " changed, " + str(deleted) + " deleted in " + str(seconds) + "s")
+    return {"objects": listing.num_rows, "added": inserted - changed, "changed": changed, "deleted": deleted}
+
+# Search index of the bucket from __s3_index
+def loadIndex(bucket):
+    createTables()
+    keys = databaseService.runQuery("SELECT key FROM __s3_index WHERE bucket = " + databaseService.toSqlLiteral(bucket) + " ORDER BY key", False, "arrow")["key"].to_pylist()
+    state = databaseService.runQuery("SELECT epoch(refreshed_at) refreshed_at FROM __s3_index_state WHERE bucket = " + databaseService.toSqlLiteral(bucket), False)
+    refreshedAt = float(state["refreshed_at"].values[0]) if len(state) > 0 else None
+    return BucketIndex(bucket, keys, refreshedAt)
 
-    return results
+def refreshInBackground(index):
+    def run():
+        try:
+            with getBucketLock(index.bucket):
+                changes = refreshIndex(index.bucket)
+                if (changes["added"] + changes["changed"] + changes["deleted"] > 0 or index.refreshedAt is None):
+                    newIndex = loadIndex(index.bucket)
+                else:
+                    newIndex = index
+                    newIndex.refreshedAt = time.time()
+                with indexesLock:
+                    indexes[index.bucket] = newIndex
+        except Exception as e:
+            print("Error refreshing S3 index of " + index.bucket + ": " + str(e))
+        finally:
+            index.refreshing = False
+    threading.Thread(target=run, name="s3Index", daemon=True).start()
 
 ############################################################################################################
-def updateMetadata(metadata):
-    # Create JSON file in bucket metadata.bucket and key metadata.path  with name metadata.json. The content of the file is metadata itself in JSON format
-    s3 = boto3.client("s3")
+def getIndex(bucket):
+    with indexesLock:
+        index = indexes.get(bucket)
+    if (index is None):
+        with getBucketLock(bucket):
+            # Loaded by another search while this one waited
+            with indexesLock:
+                index = indexes.get(bucket)
+            if (index is None):
+                index = loadIndex(bucket)
+                if (index.refreshedAt is None):
+                    # Never indexed, there is nothing to search until it's listed
+                    refreshIndex(bucket)
+                    index = loadIndex(bucket)
+                with indexesLock:
+                    indexes[bucket] = index
+    with indexesLock:
+        if (not index.refreshing and time.time() - index.refreshedAt > indexRefreshSeconds):
+            index.refreshing = True
+            refreshInBackground(index)
+    return index
 
-    # Create file in bucket
-    try:
-        s3.put_object(Bucket=metadata.bucket, Key=metadata.path + "metadata.json", Body=json.dumps(metadata.dict()))
-        print("Metadata updated in bucket: " + json.dumps(metadata.dict()))
+def s3Search(bucket, fileName, limit = 10):
+    index = getIndex(bucket)
+    return ["s3://" + bucket + "/" + key for key in index.search(fileName, limit)]
+
+def getIndexStatus():
+    createTables()
+    df = databaseService.runQuery("SELECT bucket, refreshed_at::VARCHAR refreshed_at, objects, added, changed, deleted, seconds FROM __s3_index_state ORDER BY bucket", False)
+    states = df.to_dict(orient="records")
+    with indexesLock:
+        for state in states:
+            index = indexes.get(state["bucket"])
+            state["loaded"] = index is not None
+            state["refreshing"] = index is not None and index.refreshing
+            state["listing"] = getListingProgress(state["bucket"])
+    return states
+
+############################################################################################################
+# Files and folders under path and its metadata.json, cached contentCacheSeconds. Reading a folder
+# prefetches its first subfolders in background, they are likely to be opened next
+def getContent(bucket, path, refresh = False):
+    key = (bucket, path)
+    content = None
+    loading = None
+    requested = time.time()
+    with contentsLock:
+        cached = contents.get(key)
+        if (not refresh and cached is not None and requested - cached[0] < contentCacheSeconds):
+            contents.move_to_end(key)
+            content = cached[1]
+        elif (not refresh):
+            loading = loadingContents.get(key)
+    if (content is None and loading is not None):
+        # Being prefetched, wait for it. Discarded if the metadata was updated meanwhile
+        try:
+            content = loading.result()
+        except Exception:
+            content = None
+        with contentsLock:
+            if (contentInvalidations.get(key, 0) >= requested):
+                content = None
+    if (content is None):
+        content = loadContent(bucket, path)
+    prefetchContent(bucket, path, content["content"])
+    return content
+
+def loadContent(bucket, path):
+    start = time.time()
+    s3 = getClient()
+    content = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=path, Delimiter="/"):
+        content.extend([obj["Key"] for obj in page.get("Contents", [])])
+        content.extend([commonPrefix["Prefix"] for commonPrefix in page.get("CommonPrefixes", [])])
+
+    # Get metadata.json from bucket and path, only if the listing has it
+    metadata = None
+    if (path + "metadata.json" in content):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=path + "metadata.json")
+            metadata = json.loads(response["Body"].read())
+        except Exception as e:
+            print("Error reading metadata of s3://" + bucket + "/" + path + ": " + str(e))
+
+    result = {"content": content, "metadata": metadata}
+    with contentsLock:
+        # Not cached if the metadata was updated while loading
+        if (contentInvalidations.get((bucket, path), 0) < start):
+            contents[(bucket, path)] = (time.time(), result)
+            contents.move_to_end((bucket, path))
+            while (len(contents) > CONTENT_CACHE_SIZE):
+                contents.popitem(last=False)
+    return result
+
+def prefetchContent(bucket, path, content):
+    if (prefetchExecutor is None):
+        return
+    now = time.time()
+    submitted = []
+    with contentsLock:
+        for child in [item for item in content if item.endswith("/") and item != path][:prefetchFolders]:
+            key = (bucket, child)
+            cached = contents.get(key)
+            if (key in loadingContents or (cached is not None and now - cached[0] < contentCacheSeconds)):
+                continue
+            loadingContents[key] = prefetchExecutor.submit(loadContent, bucket, child)
+            submitted.append(key)
+    # Out of the lock, the callback runs now if the load already finished
+    for key in submitted:
+        future = loadingContents.get(key)
+        if (future is not None):
+            future.add_done_callback(lambda future, key=key: forgetLoading(key, future))
+
+def forgetLoading(key, future):
+    with contentsLock:
+        if (loadingContents.get(key) is future):
+            loadingContents.pop(key, None)
+
+# The cached content and the prefetch in flight are dropped, the next getContent reads the folder again
+def invalidateContent(bucket, path):
+    key = (bucket, path)
+    with contentsLock:
+        contents.pop(key, None)
+        loadingContents.pop(key, None)
+        contentInvalidations[key] = time.time()
+        contentInvalidations.move_to_end(key)
+        while (len(contentInvalidations) > CONTENT_CACHE_SIZE):
+            contentInvalidations.popitem(last=False)
+
+############################################################################################################
+# Read only file of an S3 object for pyarrow. Every read is a range request of at least previewBytes,
+# ranges already read are served again from memory
+class RangedFile(io.RawIOBase):
+    def __init__(self, s3, bucket, key, size, etag):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+        # [(start, data)]
+        self.chunks = []
+        self.requests = 0
+        self.bytesRead = 0
+
+    def readable(self):
         return True
-    except Exception as e:
-        print("Error creating file in bucket: " + str(e))
-        return False
 
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset += self.position
+        elif (whence == io.SEEK_END):
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.readRange(self.position, min(len(buffer), self.size - self.position))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readRange(self, start, length):
+        if (length <= 0):
+            return b""
+        end = start + length
+        for chunkStart, chunk in self.chunks:
+            if (chunkStart <= start and end <= chunkStart + len(chunk)):
+                return chunk[start - chunkStart:end - chunkStart]
+        fetchEnd = min(self.size, max(end, start + previewBytes))
+        parameters = {"Bucket": self.bucket, "Key": self.key, "Range": "bytes=" + str(start) + "-" + str(fetchEnd - 1)}
+        if (self.etag is not None):
+            # The object must not change between the reads of the preview
+            parameters["IfMatch"] = self.etag
+        chunk = self.s3.get_object(**parameters)["Body"].read()
+        self.requests += 1
+        self.bytesRead += len(chunk)
+        self.chunks.append((start, chunk))
+        return chunk[:length]
+
+############################################################################################################
+# Format (parquet, csv, json or text) and compression of the file, from its name, Content-Encoding or first bytes
+def getFileFormat(path, head = None, contentEncoding = None):
+    name = path.lower()
+    compression = None
+    for extension, extensionCompression in COMPRESSIONS.items():
+        if (name.endswith(extension)):
+            compression = extensionCompression
+            name = name[:-len(extension)]
+            break
+    if (compression is None and contentEncoding in ["gzip", "x-gzip"]):
+        compression = "gzip"
+    if (compression is None and head is not None):
+        compression = next((magicCompression for magic, magicCompression in COMPRESSION_MAGIC if head.startswith(magic)), None)
+    fileFormat = next((extensionFormat for extension, extensionFormat in FORMATS.items() if name.endswith(extension)), None)
+    if (fileFormat is None and head is not None and head.startswith(b"PAR1")):
+        fileFormat = "parquet"
+    return fileFormat or "text", compression
+
+############################################################################################################
+# Schema and first rows of the file, reading only the bytes needed. Previews are cached by ETag
+def getFilePreview(bucket, path, rows = None):
+    rows = rows or previewRows
+    s3 = getClient()
+    head = s3.head_object(Bucket=bucket, Key=path)
+    etag = head.get("ETag")
+    cacheKey = (bucket, path, rows)
+    with previewsLock:
+        cached = previews.get(cacheKey)
+        if (cached is not None and etag is not None and cached["etag"] == etag):
+            previews.move_to_end(cacheKey)
+            return dict(cached, cached=True, requests=1, bytesRead=0)
 
+    start = time.time()
+    rangedFile = RangedFile(s3, bucket, path, head.get("ContentLength", 0), etag)
+    fileFormat, compression = getFileFormat(path, None, head.get("ContentEncoding"))
+    preview = {"bucket": bucket, "path": path, "etag": etag, "size": rangedFile.size, "format": fileFormat, "compression": compression,
+               "columns": [], "rows": [], "rowCount": None, "rowGroups": None, "text": None, "truncated": False, "message": None}
+    if (fileFormat == "parquet" and compression is None):
+        getParquetPreview(rangedFile, rows, preview)
+    else:
+        data = rangedFile.readRange(0, min(rangedFile.size, previewBytes))
+        fileFormat, compression = getFileFormat(path, data, head.get("ContentEncoding"))
+        preview["format"] = fileFormat
+        preview["compression"] = compression
+        if (fileFormat == "parquet" and compression is None):
+            getParquetPreview(rangedFile, rows, preview)
+        else:
+            getTextPreview(data, len(data) >= rangedFile.size, rows, preview)
+    preview["seconds"] = round(time.time() - start, 3)
+    print("Preview of s3://" + bucket + "/" + path + " (" + preview["format"] + "): " + str(rangedFile.requests) + " range requests, " +
+          str(rangedFile.bytesRead) + " bytes of " + str(rangedFile.size) + " in " + str(preview["seconds"]) + "s")
 
+    with previewsLock:
+        previews[cacheKey] = preview
+        while (len(previews) > PREVIEW_CACHE_SIZE):
+            previews.popitem(last=False)
+    return dict(preview, cached=False, requests=rangedFile.requests + 1, bytesRead=rangedFile.bytesRead)
 
+# Footer (schema, row groups) and the first rows of the first row group. The tail of the file is read first,
+# it has the footer unless it's bigger than previewBytes. Only the first pages of the columns are read
+def getParquetPreview(rangedFile, rows, preview):
+    rangedFile.readRange(max(0, rangedFile.size - previewBytes), min(rangedFile.size, previewBytes))
+    parquetFile = pq.ParquetFile(rangedFile, buffer_size=previewBytes, pre_buffer=False)
+    metadata = parquetFile.metadata
+    schema = parquetFile.schema_arrow
+    preview["columns"] = [{"name": field.name, "type": str(field.type)} for field in schema]
+    preview["rowCount"] = metadata.num_rows
+    preview["rowGroups"] = metadata.num_row_groups
+    if (metadata.num_row_groups > 0):
+        batch = next(parquetFile.iter_batches(batch_size=rows, row_groups=[0], use_threads=False), None)
+        if (batch is not None):
+            df = pa.Table.from_batches([batch]).to_pandas()
+            preview["rows"] = json.loads(df.to_json(orient="values", date_format="iso", default_handler=str))
+    preview["truncated"] = metadata.num_rows > len(preview["rows"])
 
+# Rows of the first bytes of a CSV or JSON file (lines of other files). complete is True if data is the whole file
+def getTextPreview(data, complete, rows, preview):
+    compression = preview["compression"]
+    if (compression is not None):
+        if (compression not in DECOMPRESSORS):
+            preview["message"] = "Preview not available for " + compression + " compressed files"
+            return
+        decompressor = DECOMPRESSORS[compression]()
+        try:
+            data = decompressor.decompress(data, MAX_PREVIEW_TEXT)
+        except Exception as e:
+            preview["message"] = "Could not decompress the file: " + str(e)
+            return
+        complete = complete and len(data) < MAX_PREVIEW_TEXT
+        if (len(data) == 0 and not complete):
+            # e.g. bz2 blocks are up to 900 KB
+            preview["message"] = "The first compressed block is bigger than the " + str(previewBytes) + " bytes read"
+            return
 
+    text = data.decode("utf-8", errors="replace")
+    preview["truncated"] = not complete
+    if (preview["format"] == "json"):
+        records = parseJsonRecords(text, rows)
+        if (all(isinstance(record, dict) for record in records)):
+            names = list(dict.fromkeys([name for record in records for name in record]))
+            preview["columns"] = [{"name": name, "type": None} for name in names]
+            preview["rows"] = [[record.get(name) for name in names] for record in records]
+        else:
+            preview["columns"] = [{"name": "value", "type": None}]
+            preview["rows"] = [[record] for record in records]
+        return
 
+    # The last line may be cut
+    lines = text.splitlines() if complete else text.splitlines()[:-1]
+    if (preview["format"] == "csv"):
+        sample = "\n".join(lines)
+        try:
+            dialect = csv.Sniffer().sniff(sample[:8192], delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(io.StringIO(sample), dialect)
+        header = next(reader, [])
+        preview["columns"] = [{"name": name, "type": None} for name in header]
+        preview["rows"] = list(itertools.islice(reader, rows))
+    else:
+        preview["text"] = "\n".join(lines[:rows])
 
+# JSON values of a JSON array, JSON lines or concatenated documents, stopping at the first one cut
+def parseJsonRecords(text, rows):
+    decoder = json.JSONDecoder()
+    position = len(text) - len(text.lstrip())
+    if (text.startswith("[", position)):
+        position += 1
+    records = []
+    while (len(records) < rows):
+        while (position < len(text) and (text[position].isspace() or text[position] == ",")):
+            position += 1
+        if (position >= len(text) or text[position] == "]"):
+            break
+        try:
+            value, position = decoder.raw_decode(text, position)
+        except ValueError:
+            break
+        records.append(value)
+    return records
 
+############################################################################################################
+def updateMetadata(metadata):
+    # Create JSON file in bucket metadata.bucket and key metadata.path  with name metadata.json. The content of the file is metadata itself in JSON format
+    s3 = getClient()
+
+    # Create file in bucket
+    try:
+        s3.put_object(Bucket=metadata.bucket, Key=metadata.path + "metadata.json", Body=json.dumps(metadata.dict()))
+        print("Metadata updated in bucket: " + json.dumps(metadata.dict()))
+        return True
+    except Exception as e:
+        print("Error creating file in bucket: " + str(e))
+        return False
+    finally:
+        # The folder is read again, with the new metadata.json or the one the put could not replace
+        invalidateContent(metadata.bucket, metadata.path)